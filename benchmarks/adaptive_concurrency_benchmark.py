@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Benchmark: fixed vs adaptive (--threads auto) download concurrency
+Serves synthetic files from a local server that throttles bandwidth and caps connections
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+from pathlib import Path
+
+from servers import start_http_server
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "epfl_hippocampus"))
+from epfl_downloader import EPFLDownloader
+from em_utils.cache import disable_cache
+from em_utils.segmented import PLANNER
+from em_utils.adaptive import AIMDController
+
+def run(downloader, threads) -> tuple:
+    """Time one download pass; returns (seconds, workers used), or (error, workers used) on failure."""
+    controller = AIMDController(interval=1.0) if threads == 'auto' else threads
+    start = time.perf_counter()
+    try:
+        downloader.download(len(downloader.files), controller)
+        elapsed = time.perf_counter() - start
+    except Exception as exc:
+        elapsed = f'{type(exc).__name__}: {exc}'
+    shutil.rmtree(downloader.download_dir)
+    downloader.download_dir.mkdir()
+    if threads == 'auto':
+        return elapsed, f"auto -> {controller.limit} (max {controller.summary()['max_workers_used']}, {controller.errors} errors)"
+    return elapsed, str(threads)
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare fixed and adaptive download concurrency")
+    parser.add_argument('--files', '-f', type=int, default=24)
+    parser.add_argument('--file-mb', type=float, default=4)
+    parser.add_argument('--stream-mbps', type=float, default=2, help='Per-connection server rate (MB/s)')
+    parser.add_argument('--link-mbps', type=float, default=12, help='Aggregate server rate (MB/s)')
+    parser.add_argument('--max-connections', type=int, default=8, help='Server connection cap (503 beyond it)')
+    parser.add_argument('--threads', nargs='+', default=['1', '4', '16', 'auto'])
+    args = parser.parse_args()
+    disable_cache()
+    PLANNER.max_segments = 1
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        (tmp / "www").mkdir()
+        files = [f"volume_{i:03d}.tif" for i in range(args.files)]
+        for name in files:
+            (tmp / "www" / name).write_bytes(os.urandom(int(args.file_mb * 1024 * 1024)))
+        server = start_http_server(tmp / "www", stream_mbps=args.stream_mbps, link_mbps=args.link_mbps,
+                                   max_connections=args.max_connections)
+        
+        downloader = EPFLDownloader()
+        downloader.download_dir = tmp / "out"
+        downloader.download_dir.mkdir()
+        downloader.files = files
+        downloader.urls = [f"{server.url}/{name}" for name in files]
+        
+        total_mb = args.files * args.file_mb
+        print(f"{args.files} files x {args.file_mb:g} MB, {args.stream_mbps:g} MB/s per stream, "
+              f"{args.link_mbps:g} MB/s link, {args.max_connections} connections max")
+        for threads in args.threads:
+            elapsed, label = run(downloader, threads if threads == 'auto' else int(threads))
+            if isinstance(elapsed, str):
+                print(f"{label:<40} failed: {elapsed}")
+            else:
+                print(f"{label:<40} {elapsed:8.2f} s  {total_mb / elapsed:8.2f} MB/s")
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+"""
+Offline benchmark suite: every downloader against local HTTP, FTP and file:// stand-ins
+Each scenario runs in its own process so peak RSS is per scenario; results are written as JSON
+and can be compared with a previous run (--compare) to catch regressions between commits
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import resource
+import argparse
+import platform
+import subprocess
+import tempfile
+from pathlib import Path
+from datetime import datetime
+from functools import partial
+
+BENCH_DIR = Path(__file__).resolve().parent
+ROOT = BENCH_DIR.parent
+sys.path.insert(0, str(ROOT))
+for dataset_dir in ['epfl_hippocampus', 'flyem_hemibrain', 'empiar_11759', 'idr_0086', 'openorganelle_jrc']:
+    sys.path.insert(0, str(ROOT / dataset_dir))
+
+from servers import (start_http_server, start_ftp_server, write_tiff, write_blob, make_zarr_array,
+                     make_precomputed)
+from em_utils.cache import disable_cache
+from em_utils.instrument import METRICS
+from em_utils import retry
+
+# Injected by the *_faults scenarios: 10% 503s, 5% dropped bodies, 2% stalls past the read timeout
+FAULTS = {'error_rate': 0.10, 'drop_rate': 0.05, 'stall_rate': 0.02, 'stall_seconds': 3.0, 'seed': 1}
+
+# Metrics checked by --compare; latency quantiles are recorded but too noisy locally to gate on
+HIGHER_IS_BETTER = ('mb_s', 'files_s', 'chunks_s')
+LOWER_IS_BETTER = ('seconds', 'peak_rss_mb')
+
+def reset_peak_rss():
+    """Reset the kernel's peak-RSS mark so synthetic data generation is not counted (Linux only)."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process since the last reset_peak_rss."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss cannot be reset; it is KB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+def latency_fields() -> dict:
+    """Connect / time-to-first-byte quantiles (ms) collected by em_utils.instrument."""
+    fields = {}
+    for name, hist in METRICS.summary()['run']['latency_s'].items():
+        if hist['count']:
+            key = name.replace('_seconds', '')
+            fields[f'{key}_p50_ms'] = round(hist['p50'] * 1000, 2)
+            fields[f'{key}_p95_ms'] = round(hist['p95'] * 1000, 2)
+    return fields
+
+def fault_fields(server, failed: int) -> dict:
+    """Injected faults, retries and files that still failed (should be 0 with default retries)."""
+    return {'faults_injected': sum(server.handler.faults.values()), 'retries': METRICS.summary()['run']['retries'],
+            'failed': failed}
+
+def with_faults(scenario):
+    """Run a scenario against a server injecting FAULTS, with a short read timeout so stalls retry."""
+    def run(tmp: Path, args):
+        retry.POLICY.read_timeout = 1.0
+        retry.POLICY.base = 0.05
+        return scenario(tmp, args, faults=FAULTS)
+    return run
+
+def timed(run) -> tuple:
+    """Run the measured part of a scenario; peak RSS is tracked from here."""
+    reset_peak_rss()
+    start = time.perf_counter()
+    result = run()
+    return result, time.perf_counter() - start
+
+def epfl(tmp: Path, args, stream_mbps=None, link_mbps=None, faults=None) -> dict:
+    """EPFLDownloader over HTTP with Range (segmented) against a local server."""
+    from epfl_downloader import EPFLDownloader
+    files = [f"volume_{i:03d}.tif" for i in range(args.epfl_files)]
+    for i, name in enumerate(files):
+        write_tiff(tmp / "www" / name, (args.epfl_pages, 512, 512), seed=i)
+    server = start_http_server(tmp / "www", stream_mbps=stream_mbps, link_mbps=link_mbps, **(faults or {}))
+    
+    downloader = EPFLDownloader()
+    downloader.download_dir = tmp / "out"
+    downloader.download_dir.mkdir()
+    downloader.files = files
+    downloader.urls = [f"{server.url}/{name}" for name in files]
+    _, seconds = timed(lambda: downloader.download(len(files), 3))
+    server.shutdown()
+    
+    mb = sum(p.stat().st_size for p in downloader.download_dir.glob('*.tif')) / 1024 ** 2
+    result = {'files': len(files), 'mb': round(mb, 2), 'seconds': seconds, 'mb_s': mb / seconds}
+    if faults:
+        result.update(fault_fields(server, len(downloader.failures)))
+    return result
+
+def empiar(tmp: Path, args, num_files: int, size: int) -> dict:
+    """EMPIARDownloader over pooled FTP sessions against pyftpdlib."""
+    from empiar_downloader import EMPIARDownloader
+    from em_utils.ftp_pool import FTPPool
+    from em_utils.ftp_index import FTPIndex
+    for i in range(num_files):
+        write_blob(tmp / "ftp" / "data" / f"synthetic_{i:05d}.dm3", size, seed=i)
+    server = start_ftp_server(tmp / "ftp")
+    
+    downloader = EMPIARDownloader(index=FTPIndex(tmp / "ftp_index.sqlite"))
+    downloader.download_dir = tmp / "out"
+    downloader.download_dir.mkdir()
+    downloader.ftp_path = "/data"
+    downloader.pool = FTPPool('127.0.0.1', server.address[1], max_sessions=4)
+    _, seconds = timed(lambda: downloader.download(num_files, 4))
+    downloader.pool.close()
+    server.close_all()
+    
+    mb = num_files * size / 1024 ** 2
+    return {'files': num_files, 'mb': round(mb, 2), 'seconds': seconds, 'mb_s': mb / seconds,
+            'files_s': num_files / seconds}
+
+def idr(tmp: Path, args) -> dict:
+    """IDR download_file for crawled TIFFs over FTP, two files at a time as download() does."""
+    import idr_downloader
+    from em_utils.scheduler import run_tasks
+    names = [f"Figure_S3B_{i:02d}.tif" for i in range(args.idr_files)]
+    for i, name in enumerate(names):
+        write_tiff(tmp / "ftp" / "idr" / name, (args.idr_pages, 512, 512), seed=i)
+    server = start_ftp_server(tmp / "ftp")
+    
+    idr_downloader.FTP_HOST = '127.0.0.1'
+    idr_downloader.FTP_PORT = server.address[1]
+    idr_downloader.DOWNLOAD_DIR = tmp / "out"
+    items = [(name, f"/idr/{name}") for name in names]
+    results, seconds = timed(lambda: run_tasks(idr_downloader.download_file, items, 2, 'idr', '127.0.0.1'))
+    server.close_all()
+    
+    mb = sum(r['size_bytes'] for r in results) / 1024 ** 2
+    return {'files': len(results), 'mb': round(mb, 2), 'seconds': seconds, 'mb_s': mb / seconds}
+
+def hemibrain(tmp: Path, args, target_nm=None, http=False, decode_workers=None) -> dict:
+    """HemibrainDownloader streaming one crop from a local JPEG precomputed volume (mip 0 or the target's).
+    
+    From file:// CloudVolume fetches and decodes; over HTTP the pipelined reader does, unless decode_workers is 0.
+    """
+    from hemibrain_downloader import HemibrainDownloader
+    from em_utils.precomputed import close_decoders
+    downloader = HemibrainDownloader(str(tmp / "out"))
+    downloader.data_url = make_precomputed(tmp / "www" / "precomputed", [args.hemibrain_volume] * 3,
+                                           mips=3 if target_nm else 1)
+    downloader.host = None
+    downloader.decode_workers = decode_workers
+    if http:
+        server = start_http_server(tmp / "www", latency_ms=args.latency_ms)
+        downloader.data_url = f"precomputed://{server.url}/precomputed"
+    random.seed(0)
+    path, seconds = timed(lambda: downloader.download(args.hemibrain_crop, args.hemibrain_budget_mb, 4, target_nm))
+    close_decoders()
+    if http:
+        server.shutdown()
+    
+    mb = Path(path).stat().st_size / 1024 ** 2
+    result = {'crop': args.hemibrain_crop, 'mb': round(mb, 2), 'seconds': seconds, 'mb_s': mb / seconds}
+    with open(downloader.output_dir / "metadata.json") as f:
+        pipeline = json.load(f)['pipeline']
+    if pipeline:
+        result.update(chunks_s=pipeline['chunks_s'], decode_workers=pipeline['decode_workers'],
+                      decode_utilization=pipeline['decode_utilization'])
+    return result
+
+def openorganelle_setup(tmp: Path, args):
+    from openorganelle_downloader import OpenOrganelleDownloader
+    container = tmp / "www" / "jrc_mus-liver.zarr"
+    downloader = OpenOrganelleDownloader()
+    downloader.raw_em_dims = tuple(make_zarr_array(container / "em/fibsem-uint8/s0", [args.oo_volume] * 3, [64] * 3))
+    downloader.nuclei_dims = tuple(make_zarr_array(container / "labels/nuclei-cc/s2", [128] * 3, [64] * 3))
+    downloader.output_dir = tmp / "out"
+    downloader.output_dir.mkdir()
+    return downloader
+
+def openorganelle_chunks(tmp: Path, args, faults=None) -> dict:
+    """OpenOrganelleDownloader fetching random chunks asynchronously with per-request latency."""
+    downloader = openorganelle_setup(tmp, args)
+    server = start_http_server(tmp / "www", latency_ms=args.latency_ms, **(faults or {}))
+    downloader.base_url = server.url
+    count, seconds = timed(lambda: downloader.download(args.oo_chunks, 64))
+    server.shutdown()
+    result = {'chunks': count, 'latency_ms': args.latency_ms, 'seconds': seconds, 'chunks_s': count / seconds}
+    if faults:
+        result.update(fault_fields(server, len(downloader.failures)))
+    return result
+
+def openorganelle_region(tmp: Path, args) -> dict:
+    """OpenOrganelleDownloader decoding a bounding box into one memory-mapped array."""
+    downloader = openorganelle_setup(tmp, args)
+    server = start_http_server(tmp / "www", latency_ms=args.latency_ms)
+    downloader.base_url = server.url
+    size = args.oo_volume
+    _, seconds = timed(lambda: downloader.download_region([0, 0, 0], [size] * 3, concurrency=64))
+    server.shutdown()
+    
+    mb = size ** 3 / 1024 ** 2
+    return {'mb': round(mb, 2), 'seconds': seconds, 'mb_s': mb / seconds}
+
+SCENARIOS = {
+    'epfl_http': epfl,
+    'epfl_http_throttled': partial(epfl, stream_mbps=8, link_mbps=48),
+    'empiar_ftp_large': lambda tmp, args: empiar(tmp, args, args.empiar_files, args.empiar_mb * 1024 * 1024),
+    'empiar_ftp_small': lambda tmp, args: empiar(tmp, args, 200, 64 * 1024),
+    'idr_ftp': idr,
+    'hemibrain_precomputed': hemibrain,
+    'hemibrain_precomputed_32nm': partial(hemibrain, target_nm=32),
+    'hemibrain_http_cloudvolume': partial(hemibrain, http=True, decode_workers=0),
+    'hemibrain_http_pipelined': partial(hemibrain, http=True),
+    'openorganelle_chunks': openorganelle_chunks,
+    'openorganelle_region': openorganelle_region,
+    'epfl_http_faults': with_faults(epfl),
+    'openorganelle_chunks_faults': with_faults(openorganelle_chunks),
+}
+
+def run_scenario(name: str, args) -> dict:
+    """Run one scenario in this process and return its metrics."""
+    disable_cache()
+    with tempfile.TemporaryDirectory() as tmp:
+        result = SCENARIOS[name](Path(tmp), args)
+        result['peak_rss_mb'] = round(peak_rss_mb(), 1)
+    result.update(latency_fields())
+    return {k: round(v, 3) if isinstance(v, float) else v for k, v in result.items()}
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """Return (scenario, metric, old, new, change, regressed) rows for shared numeric metrics."""
+    rows = []
+    for name, metrics in results['scenarios'].items():
+        old_metrics = baseline['scenarios'].get(name, {})
+        for metric, new in metrics.items():
+            old = old_metrics.get(metric)
+            tracked = metric in HIGHER_IS_BETTER or metric in LOWER_IS_BETTER
+            if not tracked or not isinstance(new, (int, float)) or not isinstance(old, (int, float)) or not old:
+                continue
+            change = (new - old) / old
+            worse = -change if metric in HIGHER_IS_BETTER else change
+            rows.append((name, metric, old, new, change, worse > tolerance))
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the offline downloader benchmarks and save JSON results")
+    parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument('--output', '-o', help='Results file (default: benchmark_<commit>.json)')
+    parser.add_argument('--compare', help='Earlier results file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.10, help='Relative change reported as a regression')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per scenario; the fastest is kept')
+    parser.add_argument('--epfl-files', type=int, default=6)
+    parser.add_argument('--epfl-pages', type=int, default=96, help='512x512 pages per synthetic TIFF')
+    parser.add_argument('--empiar-files', type=int, default=8)
+    parser.add_argument('--empiar-mb', type=int, default=24)
+    parser.add_argument('--idr-files', type=int, default=4)
+    parser.add_argument('--idr-pages', type=int, default=64)
+    parser.add_argument('--hemibrain-volume', type=int, default=384)
+    parser.add_argument('--hemibrain-crop', type=int, default=256)
+    parser.add_argument('--hemibrain-budget-mb', type=int, default=64)
+    parser.add_argument('--oo-volume', type=int, default=512, help='Edge of the synthetic zarr array')
+    parser.add_argument('--oo-chunks', type=int, default=300)
+    parser.add_argument('--latency-ms', type=float, default=10, help='Added server latency per HTTP request')
+    parser.add_argument('--run-scenario', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    
+    if args.run_scenario:
+        # Child process: print one JSON line for the parent
+        print(json.dumps(run_scenario(args.run_scenario, args)))
+        return
+    
+    passthrough = sys.argv[1:]
+    results = {
+        'commit': git_commit(),
+        'created': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'scenarios': {}
+    }
+    for name in args.scenarios:
+        runs = []
+        for _ in range(args.repeat):
+            proc = subprocess.run([sys.executable, __file__, *passthrough, '--run-scenario', name],
+                                  capture_output=True, text=True)
+            if proc.returncode != 0:
+                runs.append({'error': proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else 'failed'})
+                break
+            runs.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+        best = min(runs, key=lambda r: r.get('seconds', float('inf')))
+        results['scenarios'][name] = best
+        if 'error' in best:
+            print(f"{name:<28} failed: {best['error']}", flush=True)
+        else:
+            rate = next((f"{best[k]:9.2f} {k.replace('_', '/')}" for k in ('mb_s', 'chunks_s') if k in best), '')
+            faults = f"   {best['retries']} retries, {best['failed']} failed" if 'failed' in best else ''
+            print(f"{name:<28} {best['seconds']:8.2f} s {rate}   peak RSS {best['peak_rss_mb']:7.1f} MB{faults}",
+                  flush=True)
+    
+    output = Path(args.output or f"benchmark_{results['commit']}.json")
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
+    
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        rows = compare(results, baseline, args.tolerance)
+        print(f"\nCompared with {baseline.get('commit', args.compare)}:")
+        for name, metric, old, new, change, regressed in rows:
+            flag = 'REGRESSION' if regressed else ''
+            print(f"{name:<28} {metric:<16} {old:10.2f} -> {new:10.2f} {change:+8.1%} {flag}")
+        if any(row[-1] for row in rows):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Benchmark: per-file FTP connections vs pooled sessions
+Runs against a local pyftpdlib server (pip install pyftpdlib)
+"""
+
+import sys
+import time
+import ftplib
+import argparse
+import tempfile
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+from servers import start_ftp_server
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "empiar_11759"))
+from em_utils.ftp_pool import FTPPool
+from em_utils.ftp_index import FTPIndex
+from empiar_downloader import EMPIARDownloader
+from em_utils.cache import disable_cache
+
+def make_files(data_dir: Path, num_files: int, size_kb: int) -> list:
+    """Write synthetic DM3-named files."""
+    data_dir.mkdir(parents=True)
+    payload = bytes(range(256)) * (size_kb * 4)
+    names = [f"synthetic_{i:05d}.dm3" for i in range(num_files)]
+    for name in names:
+        (data_dir / name).write_bytes(payload)
+    return names
+
+def per_file_connect(port: int, ftp_path: str, out_dir: Path, filename: str):
+    """Baseline: connect, login and cwd for every file."""
+    ftp = ftplib.FTP()
+    ftp.connect('127.0.0.1', port)
+    ftp.login()
+    ftp.cwd(ftp_path)
+    with open(out_dir / filename, 'wb') as f:
+        ftp.retrbinary(f'RETR {filename}', f.write)
+    ftp.quit()
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare per-file FTP connect with pooled sessions")
+    parser.add_argument('--files', '-f', type=int, default=200)
+    parser.add_argument('--size-kb', type=int, default=64)
+    parser.add_argument('--threads', '-t', type=int, default=4)
+    args = parser.parse_args()
+    disable_cache()
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        names = make_files(tmp / "root" / "data", args.files, args.size_kb)
+        server = start_ftp_server(tmp / "root")
+        port = server.address[1]
+        
+        baseline_dir = tmp / "baseline"
+        baseline_dir.mkdir()
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.threads) as executor:
+            list(executor.map(lambda name: per_file_connect(port, "/data", baseline_dir, name), names))
+        baseline = time.perf_counter() - start
+        
+        downloader = EMPIARDownloader(index=FTPIndex(tmp / "ftp_index.sqlite"))
+        downloader.download_dir = tmp / "pooled"
+        downloader.download_dir.mkdir()
+        downloader.ftp_path = "/data"
+        downloader.pool = FTPPool('127.0.0.1', port, max_sessions=args.threads)
+        start = time.perf_counter()
+        downloader.download(args.files, args.threads)
+        pooled = time.perf_counter() - start
+        connects = downloader.pool.connects
+        downloader.pool.close()
+        server.close_all()
+    
+    print(f"{args.files} files x {args.size_kb} KB, {args.threads} threads")
+    print(f"{'per-file connect':<20} {baseline:8.2f} s  {args.files / baseline:8.1f} files/s  {args.files} logins")
+    print(f"{'pooled sessions':<20} {pooled:8.2f} s  {args.files / pooled:8.1f} files/s  {connects} logins")
+    print(f"speedup: {baseline / pooled:.2f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Benchmark: aggregate throughput of 1..N worker processes sharing one work manifest
+Each process stands in for a node with its own connection limit; all fetch OpenOrganelle
+chunks from one local latency-bound server and claim shards from the same manifest directory
+"""
+
+import sys
+import time
+import random
+import argparse
+import tempfile
+import multiprocessing
+from pathlib import Path
+
+from servers import start_http_server, make_zarr_tree
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "openorganelle_jrc"))
+from openorganelle_downloader import OpenOrganelleDownloader
+from em_utils.cache import disable_cache
+from em_utils.manifest import Manifest, work
+
+def worker(manifest_dir: str, base_url: str, output_dir: str, concurrency: int):
+    """One node: claim shards until the manifest is drained."""
+    disable_cache()
+    downloader = OpenOrganelleDownloader()
+    downloader.base_url = base_url
+    downloader.output_dir = Path(output_dir)
+    work(Manifest(manifest_dir), lambda items: downloader.download_items(items, concurrency), heartbeat_seconds=5)
+
+def run(tmp: Path, items, base_url: str, processes: int, shard_size: int, concurrency: int) -> dict:
+    """Drain a fresh manifest with this many processes and return the merged manifest summary."""
+    manifest_dir = tmp / f"manifest_{processes}"
+    output_dir = tmp / f"out_{processes}"
+    output_dir.mkdir()
+    manifest = Manifest.create(manifest_dir, 'openorganelle', items, shard_size)
+    
+    context = multiprocessing.get_context('spawn')
+    procs = [context.Process(target=worker, args=(str(manifest_dir), base_url, str(output_dir), concurrency))
+             for _ in range(processes)]
+    start = time.perf_counter()
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+    wall = time.perf_counter() - start
+    
+    metadata = manifest.merge()
+    return dict(metadata['manifest'], wall_s=wall, files=len(metadata['files']), status=metadata['status'])
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure manifest-mode scaling with worker processes")
+    parser.add_argument('--chunks', '-c', type=int, default=1200)
+    parser.add_argument('--chunk-kb', type=int, default=64)
+    parser.add_argument('--processes', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--concurrency', type=int, default=8, help='Concurrent requests per process (per-node cap)')
+    parser.add_argument('--shard-size', type=int, default=50)
+    parser.add_argument('--latency-ms', type=float, default=50, help='Added server latency per request')
+    args = parser.parse_args()
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        downloader = OpenOrganelleDownloader()
+        downloader.raw_em_dims = (12, 16, 16)
+        downloader.nuclei_dims = (4, 8, 10)
+        zarr_root = tmp / "www" / "jrc_mus-liver.zarr"
+        make_zarr_tree(zarr_root, downloader.raw_em_dims, "em/fibsem-uint8/s0", args.chunk_kb)
+        make_zarr_tree(zarr_root, downloader.nuclei_dims, "labels/nuclei-cc/s2", args.chunk_kb)
+        server = start_http_server(tmp / "www", latency_ms=args.latency_ms)
+        random.seed(0)
+        items = [list(chunk) for chunk in downloader.get_random_chunks(args.chunks)]
+        
+        print(f"{len(items)} chunks x {args.chunk_kb} KB, {args.latency_ms:g} ms latency, "
+              f"{args.concurrency} requests per process")
+        base = None
+        for processes in args.processes:
+            result = run(tmp, items, server.url, processes, args.shard_size, args.concurrency)
+            rate = result['files'] / result['elapsed_s']
+            base = base or rate / processes
+            print(f"{processes:3d} processes {result['elapsed_s']:8.2f} s  {rate:8.1f} chunks/s  "
+                  f"{result['aggregate_mb_s']:7.1f} MB/s  {rate / base:5.2f}x  "
+                  f"({result['wall_s']:.2f} s with startup, {result['status']})")
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+Benchmark: sequential vs asynchronous OpenOrganelle chunk fetching
+Serves a synthetic zarr tree from a local static file server
+"""
+
+import sys
+import time
+import argparse
+import tempfile
+import requests
+from pathlib import Path
+
+from servers import start_http_server, make_zarr_tree
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "openorganelle_jrc"))
+from openorganelle_downloader import OpenOrganelleDownloader
+from em_utils.cache import disable_cache
+from em_utils.resume import http_download
+
+def fetch_sequential(downloader, chunk_type, z, y, x):
+    """Baseline: fetch one chunk with a blocking request, as the downloader did before async fetching."""
+    url, filename = downloader.chunk_source(chunk_type, z, y, x)
+    try:
+        http_download(url, downloader.output_dir / filename)
+    except requests.HTTPError as e:
+        # Zarr stores omit chunks that only contain the fill value
+        if e.response.status_code != 404:
+            raise
+
+def run(downloader, num_chunks, concurrency=None) -> float:
+    """Time one download pass and clear its output."""
+    start = time.perf_counter()
+    if concurrency is None:
+        for chunk in downloader.get_random_chunks(num_chunks):
+            fetch_sequential(downloader, *chunk)
+    else:
+        downloader.download(num_chunks, concurrency)
+    elapsed = time.perf_counter() - start
+    for path in downloader.output_dir.iterdir():
+        path.unlink()
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare sequential and async zarr chunk fetching")
+    parser.add_argument('--chunks', '-c', type=int, default=2000)
+    parser.add_argument('--chunk-kb', type=int, default=16)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[8, 32, 64])
+    parser.add_argument('--latency-ms', type=float, default=20, help='Added server latency per request')
+    args = parser.parse_args()
+    disable_cache()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        downloader = OpenOrganelleDownloader()
+        zarr_root = tmp / "www" / "jrc_mus-liver.zarr"
+        make_zarr_tree(zarr_root, downloader.raw_em_dims, "em/fibsem-uint8/s0", args.chunk_kb)
+        make_zarr_tree(zarr_root, downloader.nuclei_dims, "labels/nuclei-cc/s2", args.chunk_kb)
+        server = start_http_server(tmp / "www", latency_ms=args.latency_ms)
+
+        downloader.base_url = server.url
+        downloader.output_dir = tmp / "out"
+        downloader.output_dir.mkdir()
+
+        print(f"{args.chunks} chunks x {args.chunk_kb} KB, {args.latency_ms:g} ms latency")
+        elapsed = run(downloader, args.chunks)
+        print(f"{'sequential':<16} {elapsed:8.2f} s  {args.chunks / elapsed * 60:10.0f} chunks/min")
+        for concurrency in args.concurrency:
+            elapsed = run(downloader, args.chunks, concurrency)
+            print(f"{f'async x{concurrency}':<16} {elapsed:8.2f} s  {args.chunks / elapsed * 60:10.0f} chunks/min")
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Benchmark: random-patch sampling through the memory-mapped reader vs eager loading
+Writes a synthetic volume as .npy, uncompressed TIFF, compressed TIFF and OME-Zarr
+"""
+
+import sys
+import time
+import argparse
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import tifffile
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from em_utils.reader import open_array
+from em_utils.convert import convert_to_zarr
+
+def make_volume(shape) -> np.ndarray:
+    """Smooth uint8 noise, so compressed formats behave roughly like EM data."""
+    rng = np.random.default_rng(0)
+    coarse = rng.integers(0, 256, size=[max(1, n // 8) for n in shape], dtype=np.uint8)
+    volume = coarse.repeat(8, 0).repeat(8, 1).repeat(8, 2)[:shape[0], :shape[1], :shape[2]]
+    return volume + rng.integers(0, 16, size=volume.shape, dtype=np.uint8)
+
+def eager_load(path: Path) -> np.ndarray:
+    """What consumers did before: read the whole file."""
+    if path.suffix == '.npy':
+        return np.load(path)
+    if path.suffix == '.tif':
+        return tifffile.imread(path)
+    import zarr
+    return zarr.open(str(path), mode='r')['0'][:]
+
+def sample(open_fn, path: Path, shape, patch: int, count: int, reopen: bool) -> float:
+    """Patches per second; reopen opens the file for every patch like a fresh loader worker."""
+    rng = np.random.default_rng(1)
+    corners = [[int(rng.integers(0, n - patch + 1)) for n in shape] for _ in range(count)]
+    start = time.perf_counter()
+    array = None
+    for z, y, x in corners:
+        if reopen or array is None:
+            array = open_fn(path)
+        np.asarray(array[z:z + patch, y:y + patch, x:x + patch]).sum()
+    return count / (time.perf_counter() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare lazy and eager random-patch sampling")
+    parser.add_argument('--shape', type=int, nargs=3, default=[256, 1024, 1024], metavar=('Z', 'Y', 'X'))
+    parser.add_argument('--patch', type=int, default=64)
+    parser.add_argument('--patches', type=int, default=100)
+    parser.add_argument('--eager-patches', type=int, default=10, help='Patches for the slow eager runs')
+    args = parser.parse_args()
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        volume = make_volume(args.shape)
+        files = {
+            'npy': tmp / 'volume.npy',
+            'tiff (raw)': tmp / 'volume.tif',
+            'tiff (zlib)': tmp / 'volume_zlib.tif',
+            'ome-zarr': tmp / 'volume.ome.zarr',
+        }
+        np.save(files['npy'], volume)
+        tifffile.imwrite(files['tiff (raw)'], volume)
+        tifffile.imwrite(files['tiff (zlib)'], volume, compression='zlib')
+        convert_to_zarr(files['tiff (raw)'], files['ome-zarr'])
+        del volume
+        
+        print(f"volume {args.shape}, {args.patch}^3 patches (patches/s)")
+        print(f"{'format':<14} {'eager/patch':>12} {'lazy/patch':>12} {'lazy, open once':>16}")
+        for label, path in files.items():
+            eager = sample(eager_load, path, args.shape, args.patch, args.eager_patches, reopen=True)
+            lazy = sample(open_array, path, args.shape, args.patch, args.patches, reopen=True)
+            held = sample(open_array, path, args.shape, args.patch, args.patches, reopen=False)
+            print(f"{label:<14} {eager:12.1f} {lazy:12.1f} {held:16.1f}")
+
+if __name__ == "__main__":
+    main()
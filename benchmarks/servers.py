@@ -0,0 +1,300 @@
+"""
+Local stand-ins for the remote data sources, shared by the benchmarks
+HTTP with Range, throttling and a connection cap; anonymous FTP; synthetic EM-like volumes
+"""
+
+import os
+import re
+import sys
+import time
+import random
+import socket
+import threading
+from pathlib import Path
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from em_utils.scheduler import BandwidthLimiter
+
+BLOCK = 64 * 1024
+
+class ThrottledHandler(SimpleHTTPRequestHandler):
+    """Static handler with Range support, added latency, a per-stream rate, a shared link rate
+    and a connection cap (503 beyond it).
+    
+    Faults can be injected per GET: error_rate answers 503 (with Retry-After: 0), drop_rate closes
+    the connection halfway through the body and stall_rate pauses stall_seconds before the body.
+    
+    Limits are class attributes; start_http_server makes a subclass per server.
+    """
+    protocol_version = "HTTP/1.1"
+    latency = 0.0
+    stream_rate = None
+    link = None
+    max_connections = None
+    error_rate = 0.0
+    drop_rate = 0.0
+    stall_rate = 0.0
+    stall_seconds = 0.0
+    rng = random.Random(0)
+    faults = None
+    active = 0
+    lock = threading.Lock()
+    
+    def _resolve(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404, "Not found")
+            return None, None
+        return path, os.stat(path)
+    
+    @staticmethod
+    def _etag(st) -> str:
+        return f'"{st.st_size:x}-{int(st.st_mtime):x}"'
+    
+    def _headers(self, status, length, st, content_range=None):
+        self.send_response(status)
+        self.send_header('Content-Length', str(length))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', self._etag(st))
+        if content_range:
+            self.send_header('Content-Range', content_range)
+        self.end_headers()
+    
+    def do_HEAD(self):
+        time.sleep(self.latency)
+        path, st = self._resolve()
+        if path is not None:
+            self._headers(200, st.st_size, st)
+    
+    def _fault(self):
+        """Pick the fault for this request, if any (seeded, so runs are repeatable)."""
+        cls = type(self)
+        with cls.lock:
+            roll = cls.rng.random()
+        for name, rate in (('error', cls.error_rate), ('drop', cls.drop_rate), ('stall', cls.stall_rate)):
+            if roll < rate:
+                with cls.lock:
+                    cls.faults[name] = cls.faults.get(name, 0) + 1
+                return name
+            roll -= rate
+        return None
+    
+    def do_GET(self):
+        cls = type(self)
+        with cls.lock:
+            over = cls.max_connections is not None and cls.active >= cls.max_connections
+            if not over:
+                cls.active += 1
+        if over:
+            # What a throttling mirror does once too many streams are open
+            self.send_error(503, "Too many connections")
+            return
+        try:
+            # Emulate the round trip to a remote server
+            time.sleep(self.latency)
+            path, st = self._resolve()
+            if path is None:
+                return
+            fault = self._fault()
+            if fault == 'error':
+                self.send_response(503)
+                self.send_header('Retry-After', '0')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            if self.headers.get('If-None-Match') == self._etag(st):
+                # Revalidation of a cached copy
+                self.send_response(304)
+                self.send_header('ETag', self._etag(st))
+                self.end_headers()
+                return
+            start, end = 0, st.st_size
+            match = re.fullmatch(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+            if match and self.headers.get('If-Range', self._etag(st)) != self._etag(st):
+                # The file changed since the partial copy was taken: send all of it
+                match = None
+            if match:
+                start = int(match.group(1))
+                end = min(end, int(match.group(2)) + 1) if match.group(2) else end
+                if start >= st.st_size:
+                    self.send_response(416)
+                    self.send_header('Content-Range', f'bytes */{st.st_size}')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self._headers(206, end - start, st, f'bytes {start}-{end - 1}/{st.st_size}')
+            else:
+                self._headers(200, st.st_size, st)
+            if fault == 'stall':
+                time.sleep(self.stall_seconds)
+            
+            with open(path, 'rb') as f:
+                f.seek(start)
+                remaining = end - start
+                # A dropped transfer sends half the body, then closes the socket
+                cutoff = remaining // 2 if fault == 'drop' else -1
+                while remaining > 0:
+                    if remaining <= cutoff:
+                        self.close_connection = True
+                        self.wfile.flush()
+                        self.connection.shutdown(socket.SHUT_RDWR)
+                        return
+                    block = f.read(min(BLOCK, remaining))
+                    if not block:
+                        break
+                    delay = self.link.reserve(len(block)) if self.link else 0
+                    delay = max(delay, len(block) / self.stream_rate if self.stream_rate else 0)
+                    if delay:
+                        time.sleep(delay)
+                    self.wfile.write(block)
+                    remaining -= len(block)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            with cls.lock:
+                cls.active -= 1
+    
+    def log_message(self, format, *args):
+        pass
+
+class BenchHTTPServer(ThreadingHTTPServer):
+    # Hundreds of concurrent chunk requests overflow the default backlog of 5 (SYN retries cost 1 s)
+    request_queue_size = 256
+    daemon_threads = True
+
+def start_http_server(root: Path, latency_ms: float = 0, stream_mbps: float = None, link_mbps: float = None,
+                      max_connections: int = None, error_rate: float = 0.0, drop_rate: float = 0.0,
+                      stall_rate: float = 0.0, stall_seconds: float = 0.0, seed: int = 0) -> BenchHTTPServer:
+    """Serve root on a free localhost port with the given limits (MB/s) and fault rates.
+    
+    server.handler.faults counts the faults injected so far.
+    """
+    limits = {
+        'latency': latency_ms / 1000,
+        'stream_rate': stream_mbps * 1024 * 1024 if stream_mbps else None,
+        'link': BandwidthLimiter(link_mbps * 1024 * 1024, burst_seconds=0.1) if link_mbps else None,
+        'max_connections': max_connections,
+        'error_rate': error_rate,
+        'drop_rate': drop_rate,
+        'stall_rate': stall_rate,
+        'stall_seconds': stall_seconds,
+        'rng': random.Random(seed),
+        'faults': {},
+        'active': 0,
+        'lock': threading.Lock()
+    }
+    handler = type('Handler', (ThrottledHandler,), limits)
+    
+    def factory(*args, **kwargs):
+        return handler(*args, directory=str(root), **kwargs)
+    
+    server = BenchHTTPServer(('127.0.0.1', 0), factory)
+    server.handler = handler
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def start_ftp_server(root: Path):
+    """Serve root anonymously over FTP on a free localhost port (pip install pyftpdlib)."""
+    import logging
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler
+    from pyftpdlib.servers import ThreadedFTPServer
+    
+    logging.getLogger('pyftpdlib').setLevel(logging.WARNING)
+    authorizer = DummyAuthorizer()
+    authorizer.add_anonymous(str(root))
+    handler = type('Handler', (FTPHandler,), {'authorizer': authorizer})
+    server = ThreadedFTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, kwargs={'handle_exit': False}, daemon=True).start()
+    return server
+
+def synthetic_em(shape, seed: int = 0) -> np.ndarray:
+    """uint8 volume with smooth membrane-like structure plus noise.
+    
+    Compresses roughly like real EM, unlike random bytes.
+    """
+    rng = np.random.default_rng(seed)
+    coarse_shape = [max(1, -(-s // 8)) for s in shape]
+    coarse = rng.normal(128, 40, coarse_shape).astype(np.float32)
+    for axis in range(len(shape)):
+        coarse = np.repeat(coarse, 8, axis=axis)
+    volume = coarse[tuple(slice(0, s) for s in shape)] + rng.normal(0, 12, shape).astype(np.float32)
+    return np.clip(volume, 0, 255).astype(np.uint8)
+
+def write_tiff(path: Path, shape, seed: int = 0):
+    """Write a synthetic multi-page TIFF."""
+    import tifffile
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tifffile.imwrite(path, synthetic_em(shape, seed))
+
+def write_blob(path: Path, size: int, seed: int = 0):
+    """Write size bytes of synthetic image data (stands in for DM3 files)."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    side = int(np.ceil(np.sqrt(size)))
+    path.write_bytes(synthetic_em((side, side), seed).tobytes()[:size])
+
+def make_zarr_tree(root: Path, dims, array_path: str, chunk_kb: int):
+    """Write one synthetic chunk file per grid position (no .zarray; for raw chunk fetches)."""
+    for z in range(dims[0]):
+        for y in range(dims[1]):
+            chunk_dir = root / array_path / str(z) / str(y)
+            chunk_dir.mkdir(parents=True, exist_ok=True)
+            for x in range(dims[2]):
+                (chunk_dir / str(x)).write_bytes(os.urandom(chunk_kb * 1024))
+
+def make_zarr_array(path: Path, shape, chunks, seed: int = 0, data: np.ndarray = None):
+    """Write a Blosc-compressed zarr v2 array with '/'-separated chunk keys, as OpenOrganelle serves."""
+    import zarr
+    from numcodecs import Blosc
+    array = zarr.open_array(str(path), mode='w', shape=shape, chunks=chunks, dtype='uint8',
+                            compressor=Blosc(cname='zstd', clevel=3), dimension_separator='/')
+    array[...] = synthetic_em(shape, seed) if data is None else data
+    return [-(-s // c) for s, c in zip(shape, chunks)]
+
+def downsample(data: np.ndarray, factor: int = 2) -> np.ndarray:
+    """Mean-pool a 3D uint8 volume by factor along every axis."""
+    shape = [s // factor * factor for s in data.shape]
+    data = data[:shape[0], :shape[1], :shape[2]].astype(np.float32)
+    pooled = data.reshape(shape[0] // factor, factor, shape[1] // factor, factor, shape[2] // factor, factor)
+    return pooled.mean(axis=(1, 3, 5)).astype(np.uint8)
+
+def make_precomputed(path: Path, shape, chunk_size=(64, 64, 64), encoding: str = 'jpeg', seed: int = 0,
+                     mips: int = 1) -> str:
+    """Write a Neuroglancer precomputed volume (x, y, z) with mips 2x downsampled levels.
+    
+    Returns its precomputed://file:// URL.
+    """
+    from cloudvolume import CloudVolume
+    info = CloudVolume.create_new_info(num_channels=1, layer_type='image', data_type='uint8', encoding=encoding,
+                                       resolution=[8, 8, 8], voxel_offset=[0, 0, 0], chunk_size=list(chunk_size),
+                                       volume_size=list(shape))
+    url = f"file://{path}"
+    volume = CloudVolume(url, info=info, progress=False, compress=False)
+    for mip in range(1, mips):
+        volume.meta.add_scale([2 ** mip] * 3, chunk_size=list(chunk_size))
+    volume.commit_info()
+    data = synthetic_em(shape, seed)
+    for mip in range(mips):
+        CloudVolume(url, mip=mip, progress=False, compress=False)[:, :, :] = data[..., np.newaxis]
+        data = downsample(data)
+    return f"precomputed://{url}"
+
+def make_zarr_multiscale(path: Path, shape, chunks, levels: int = 3, resolution_nm=(4, 4, 4), seed: int = 0):
+    """Write a multiscale zarr group (s0, s1, ... each 2x coarser) with OME-NGFF multiscales metadata."""
+    import json
+    data = synthetic_em(shape, seed)
+    datasets = []
+    for level in range(levels):
+        make_zarr_array(path / f"s{level}", data.shape, chunks, data=data)
+        factor = 2 ** level
+        datasets.append({'path': f"s{level}", 'coordinateTransformations': [
+            {'type': 'scale', 'scale': [r * factor for r in resolution_nm]},
+            {'type': 'translation', 'translation': [r * (factor - 1) / 2 for r in resolution_nm]}]})
+        data = downsample(data)
+    axes = [{'name': name, 'type': 'space', 'unit': 'nanometer'} for name in 'zyx']
+    (path / ".zattrs").write_text(json.dumps({'multiscales': [{'version': '0.4', 'axes': axes, 'datasets': datasets}]}))
+    (path / ".zgroup").write_text(json.dumps({'zarr_format': 2}))
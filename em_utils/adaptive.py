@@ -0,0 +1,171 @@
+"""
+AIMD concurrency control for per-file download pools (--threads auto)
+"""
+
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from em_utils.scheduler import active, add_byte_hook, remove_byte_hook, failure_record
+from em_utils.instrument import METRICS
+
+
+def threads_arg(value: str):
+    """argparse type for --threads: a worker count or 'auto'."""
+    return value if value == 'auto' else int(value)
+
+
+class AIMDController:
+    """Sizes a download pool from measured throughput, errors and per-stream rate.
+    
+    Every interval the aggregate rate is compared with the previous one:
+    while adding a worker pays off the limit grows by one; errors (failed
+    items and the transient failures retry_call retried), or
+    per-stream rate falling below 1/latency_factor of the best seen
+    (streams queueing behind a saturated link or throttling server), cut
+    it multiplicatively. An increase that does not raise throughput is
+    undone and probing pauses for a few intervals.
+    """
+    
+    def __init__(self, initial: int = 2, minimum: int = 1, maximum: int = 32, interval: float = 2.0,
+                 decrease: float = 0.5, latency_factor: float = 2.0, tolerance: float = 0.05,
+                 hold_intervals: int = 3):
+        self.initial = self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.interval = interval
+        self.decrease = decrease
+        self.latency_factor = latency_factor
+        self.tolerance = tolerance
+        self.hold_intervals = hold_intervals
+        
+        self.history = []
+        self.errors = 0
+        self.total_bytes = 0
+        self._lock = threading.Lock()
+        self._window_bytes = 0
+        self._window_errors = 0
+        self._retries_seen = 0
+        self._prev_rate = 0.0
+        self._best_per_stream = 0.0
+        self._last_action = None
+        self._cooldown = 0
+    
+    def add_bytes(self, nbytes: int):
+        with self._lock:
+            self._window_bytes += nbytes
+            self.total_bytes += nbytes
+    
+    def record_error(self):
+        with self._lock:
+            self._window_errors += 1
+            self.errors += 1
+    
+    def _adjust(self, active: int, elapsed: float):
+        """Apply one AIMD step from the last interval's measurements."""
+        retries = METRICS.total('retries')
+        with self._lock:
+            rate = self._window_bytes / elapsed
+            errors = self._window_errors + retries - self._retries_seen
+            self._window_bytes = self._window_errors = 0
+            self._retries_seen = retries
+        per_stream = rate / max(1, active)
+        
+        if errors:
+            action = 'decrease'
+        elif self._best_per_stream and per_stream * self.latency_factor < self._best_per_stream:
+            action = 'decrease'
+        elif self._last_action == 'increase' and rate < self._prev_rate * (1 + self.tolerance):
+            action = 'undo'
+        elif self._cooldown:
+            self._cooldown -= 1
+            action = 'hold'
+        elif active >= self.limit and self.limit < self.maximum:
+            action = 'increase'
+        else:
+            action = 'hold'
+        
+        if action == 'decrease':
+            self.limit = max(self.minimum, int(self.limit * self.decrease))
+        elif action == 'undo':
+            self.limit = max(self.minimum, self.limit - 1)
+            self._cooldown = self.hold_intervals
+        elif action == 'increase':
+            self.limit += 1
+        
+        self._last_action = action
+        self._prev_rate = rate
+        if active:
+            self._best_per_stream = max(self._best_per_stream, per_stream)
+        self.history.append({'t': round(time.monotonic() - self._started, 2), 'active': active,
+                             'mb_s': round(rate / (1024 * 1024), 3), 'errors': errors,
+                             'action': action, 'workers': self.limit})
+    
+    def map(self, fn, items, failures: list = None) -> list:
+        """Run fn over items, keeping `limit` calls in flight; results are in order.
+        
+        items may be a generator; it is only advanced when a slot is free.
+        Retrying is left to retry_call inside fn: a failed item cuts the
+        limit and its exception is raised, or recorded in failures if a
+        list is given (as in run_tasks).
+        """
+        items = enumerate(items)
+        results = {}
+        in_flight = {}
+        self._started = time.monotonic()
+        self._retries_seen = METRICS.total('retries')
+        window_start = self._started
+        
+        add_byte_hook(self.add_bytes)
+        try:
+            with ThreadPoolExecutor(max_workers=self.maximum) as executor:
+                while True:
+                    while len(in_flight) < self.limit:
+                        # New items are drawn as the iterable produces them
+                        entry = next(items, None)
+                        if entry is None:
+                            break
+                        in_flight[executor.submit(fn, entry[1])] = entry
+                    if not in_flight:
+                        break
+                    
+                    done, _ = wait(in_flight, timeout=self.interval, return_when=FIRST_COMPLETED)
+                    active = len(in_flight)
+                    for future in done:
+                        index, item = in_flight.pop(future)
+                        try:
+                            results[index] = future.result()
+                        except Exception as exc:
+                            self.record_error()
+                            if failures is None:
+                                raise
+                            failures.append(failure_record(item, exc))
+                    
+                    now = time.monotonic()
+                    if now - window_start >= self.interval:
+                        self._adjust(active, now - window_start)
+                        window_start = now
+        finally:
+            remove_byte_hook(self.add_bytes)
+            self.elapsed = time.monotonic() - self._started
+        return [results[index] for index in sorted(results)]
+    
+    def summary(self) -> dict:
+        """Chosen concurrency and how it was reached, for metadata.json."""
+        return {
+            'mode': 'auto',
+            'workers': self.limit,
+            'max_workers_used': max([self.initial] + [h['workers'] for h in self.history]),
+            'throughput_mb_s': round(self.total_bytes / max(self.elapsed, 1e-9) / (1024 * 1024), 3),
+            'errors': self.errors,
+            'history': self.history
+        }
+
+
+def concurrency_report(max_workers) -> dict:
+    """metadata.json record of how many workers a download used."""
+    if active() is not None:
+        return {'mode': 'scheduled', 'workers': active().workers}
+    if hasattr(max_workers, 'summary'):
+        return max_workers.summary()
+    return {'mode': 'fixed', 'workers': max_workers}
@@ -0,0 +1,162 @@
+"""
+Asynchronous fetcher for large numbers of small HTTP objects (zarr chunks)
+"""
+
+import os
+import asyncio
+from pathlib import Path
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from em_utils.integrity import Digester, check, etag_md5
+from em_utils.scheduler import async_throttle
+from em_utils.instrument import METRICS, aiohttp_trace
+from em_utils.retry import POLICY, is_transient
+
+BLOCK_SIZE = 64 * 1024
+
+
+class AsyncChunkFetcher:
+    """Fetch many small objects over keep-alive connections with bounded concurrency."""
+    
+    def __init__(self, concurrency: int = 64, timeout: float = None, retries: int = None):
+        self.concurrency = concurrency
+        # Defaults come from the shared retry policy
+        self.timeout = timeout or POLICY.read_timeout
+        self.retries = POLICY.attempts - 1 if retries is None else retries
+    
+    async def _retrying(self, url: str, attempt):
+        """Await attempt() under the shared backoff policy and the host's circuit breaker."""
+        host = urlsplit(url).netloc
+        for n in range(self.retries + 1):
+            POLICY.breaker.check(host)
+            try:
+                result = await attempt()
+            except Exception as exc:
+                if not is_transient(exc):
+                    raise
+                POLICY.breaker.failure(host)
+                if n == self.retries:
+                    raise
+                METRICS.count('retries', host=host)
+                await asyncio.sleep(POLICY.delay(n, exc))
+            else:
+                POLICY.breaker.success(host)
+                return result
+    
+    @staticmethod
+    async def _off_loop(fn, *args):
+        """Run a blocking cache call in a worker thread."""
+        return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+    
+    async def _conditional(self, cache, url: str) -> dict:
+        """If-None-Match headers for url's cached copy, if there is one to revalidate."""
+        validators = await self._off_loop(cache.validators, url) if cache is not None else None
+        return {'If-None-Match': validators['etag']} if validators else {}
+    
+    async def _stream(self, session, url: str, dest: Path, cache=None) -> dict:
+        """One attempt at streaming an object to dest through a .part file.
+        
+        With a cache, a cached copy is revalidated with If-None-Match and
+        linked to dest when unchanged; new bodies are added to the cache.
+        """
+        headers = await self._conditional(cache, url)
+        async with session.get(url, headers=headers) as response:
+            if response.status == 404:
+                return {'url': url, 'path': dest, 'size_bytes': 0, 'missing': True, 'cached': False}
+            if response.status == 304:
+                entry = await self._off_loop(cache.fetch, url, dest, headers['If-None-Match'])
+                if entry is not None:
+                    return dict(entry['digests'], url=url, path=dest, size_bytes=entry['size'], missing=False,
+                                cached=True)
+                # Evicted since the conditional request was sent
+                return await self._stream(session, url, dest)
+            response.raise_for_status()
+            
+            etag = response.headers.get('ETag')
+            digester = Digester(md5=etag_md5(etag) is not None)
+            tmp_path = dest.with_name(dest.name + '.part')
+            size = 0
+            with open(tmp_path, 'wb') as f:
+                async for block in response.content.iter_chunked(BLOCK_SIZE):
+                    await async_throttle(len(block))
+                    f.write(block)
+                    digester.update(block)
+                    size += len(block)
+            
+            digests = digester.hexdigests()
+            encoded = 'Content-Encoding' in response.headers
+            verified = check(tmp_path, digests, None if encoded else response.content_length, etag)
+            os.replace(tmp_path, dest)
+            if cache is not None:
+                cache.miss()
+                await self._off_loop(cache.put, url, dest, etag, digests)
+            return dict(digests, url=url, path=dest, size_bytes=size, missing=False, verified=verified, cached=False)
+    
+    async def _read(self, session, url: str, cache=None):
+        """One attempt at reading an object into memory; (data, cached), data None if it does not exist."""
+        headers = await self._conditional(cache, url)
+        async with session.get(url, headers=headers) as response:
+            if response.status == 404:
+                return None, False
+            if response.status == 304:
+                data = await self._off_loop(cache.read, url, headers['If-None-Match'])
+                # None if evicted since the conditional request was sent
+                return (data, True) if data is not None else await self._read(session, url)
+            response.raise_for_status()
+            data = await response.read()
+            await async_throttle(len(data))
+            if cache is not None:
+                cache.miss()
+                await self._off_loop(cache.put_bytes, url, data, response.headers.get('ETag'))
+            return data, False
+    
+    async def _fetch(self, session, semaphore, url: str, dest: Path, cache=None) -> dict:
+        """Stream one object to dest, writing through a .part file."""
+        async with semaphore:
+            return await self._retrying(url, lambda: self._stream(session, url, dest, cache))
+    
+    async def _fetch_bytes(self, session, semaphore, key, url: str, callback, cache=None) -> dict:
+        """Read one object into memory and hand it to callback in a worker thread."""
+        async with semaphore:
+            data, cached = await self._retrying(url, lambda: self._read(session, url, cache))
+            # Decoding runs off the event loop; holding the slot bounds buffered bytes
+            await asyncio.get_running_loop().run_in_executor(None, callback, key, data)
+            return {'url': url, 'size_bytes': len(data or b''), 'missing': data is None, 'cached': cached}
+    
+    def _session(self):
+        connector = aiohttp.TCPConnector(limit=self.concurrency, keepalive_timeout=30)
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=self.timeout, sock_read=self.timeout)
+        return aiohttp.ClientSession(connector=connector, timeout=timeout, trace_configs=[aiohttp_trace()])
+    
+    async def fetch_all(self, items, return_exceptions: bool = False, cache=None) -> list:
+        """Fetch (url, dest) pairs; results are returned in input order.
+        
+        With return_exceptions, an object that still fails after retries
+        yields its exception in place of a result instead of aborting the rest.
+        With a cache, unchanged cached objects are served from it (`cached`).
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
+        async with self._session() as session:
+            tasks = [self._fetch(session, semaphore, url, Path(dest), cache) for url, dest in items]
+            return await asyncio.gather(*tasks, return_exceptions=return_exceptions)
+    
+    async def fetch_into(self, items, callback, cache=None) -> list:
+        """Fetch (key, url) pairs and call callback(key, data) as each arrives.
+        
+        data is None for objects that do not exist (404). With a cache,
+        unchanged cached objects are read from it instead of transferred.
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
+        async with self._session() as session:
+            tasks = [self._fetch_bytes(session, semaphore, key, url, callback, cache) for key, url in items]
+            return await asyncio.gather(*tasks)
+    
+    def run(self, items, return_exceptions: bool = False, cache=None) -> list:
+        """Blocking wrapper around fetch_all."""
+        return asyncio.run(self.fetch_all(items, return_exceptions, cache))
+    
+    def run_into(self, items, callback, cache=None) -> list:
+        """Blocking wrapper around fetch_into."""
+        return asyncio.run(self.fetch_into(items, callback, cache))
@@ -0,0 +1,259 @@
+"""
+Local file cache with LRU eviction shared by all downloaders
+"""
+
+import os
+import json
+import fcntl
+import shutil
+import sqlite3
+import hashlib
+import threading
+import time
+from pathlib import Path
+
+DEFAULT_CACHE_DIR = Path(os.environ.get('EM_CACHE_DIR', Path.home() / '.cache' / 'em-dataset-downloaders'))
+DEFAULT_MAX_BYTES = int(float(os.environ.get('EM_CACHE_MAX_GB', 50)) * 1024 ** 3)
+
+# ioctl(FICLONE) shares extents on btrfs/XFS without copying data
+FICLONE = 0x40049409
+
+# Eviction frees space down to this fraction of the budget, so it runs once per batch of puts
+EVICT_TARGET = 0.9
+
+
+def link_or_copy(src: Path, dest: Path):
+    """Materialize src at dest by hardlink, then reflink, then plain copy."""
+    tmp_path = dest.with_name(dest.name + '.cache-tmp')
+    tmp_path.unlink(missing_ok=True)
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        try:
+            with open(src, 'rb') as fsrc, open(tmp_path, 'wb') as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, dest)
+
+
+class FileCache:
+    """On-disk cache keyed by source URL/path plus ETag and size.
+    
+    Objects live under `objects/` named by content digest when known (so
+    identical files are stored once) or by a digest of the key otherwise.
+    """
+    
+    def __init__(self, root=DEFAULT_CACHE_DIR, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.objects_dir = self.root / 'objects'
+        self.objects_dir.mkdir(parents=True, exist_ok=True)
+        
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.root / 'index.sqlite', timeout=60, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS entries (
+                source TEXT PRIMARY KEY,
+                etag TEXT,
+                size INTEGER NOT NULL,
+                object TEXT NOT NULL,
+                last_access REAL NOT NULL,
+                digests TEXT
+            )""")
+        try:
+            # Caches created before digests were recorded
+            self._db.execute('ALTER TABLE entries ADD COLUMN digests TEXT')
+        except sqlite3.OperationalError:
+            pass
+        self._db.execute('CREATE INDEX IF NOT EXISTS entries_lru ON entries (last_access)')
+        self._db.commit()
+        
+        self.hits = 0
+        self.misses = 0
+        self.bytes_hit = 0
+        # Running estimate of the bytes stored; other processes' puts are picked up by the next full scan
+        self._total = self._stored_bytes()
+    
+    def _stored_bytes(self) -> int:
+        return self._db.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM (SELECT DISTINCT object, size FROM entries)').fetchone()[0]
+    
+    def _object_path(self, name: str) -> Path:
+        return self.objects_dir / name[:2] / name
+    
+    def lookup(self, source: str, etag: str = None, size: int = None):
+        """Return the cache entry for source ({path, size, etag, digests}), or None on a miss."""
+        with self._lock:
+            row = self._db.execute(
+                'SELECT etag, size, object, digests FROM entries WHERE source = ?', (source,)).fetchone()
+            entry = None
+            if row is not None:
+                cached_etag, cached_size, name, digests = row
+                stale = (etag is not None and cached_etag is not None and etag != cached_etag) or \
+                        (size is not None and size != cached_size)
+                if not stale and self._object_path(name).exists():
+                    entry = {
+                        'path': self._object_path(name),
+                        'size': cached_size,
+                        'etag': cached_etag,
+                        'digests': json.loads(digests) if digests else {}
+                    }
+                    self._db.execute('UPDATE entries SET last_access = ? WHERE source = ?',
+                                     (time.time(), source))
+                    self._db.commit()
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.bytes_hit += entry['size']
+            return entry
+    
+    def validators(self, source: str):
+        """{etag, size} recorded for source, for a conditional request; None if there is nothing to revalidate.
+        
+        Unlike lookup this is not counted as a hit or a miss.
+        """
+        with self._lock:
+            row = self._db.execute('SELECT etag, size, object FROM entries WHERE source = ?', (source,)).fetchone()
+        if row is None or row[0] is None or not self._object_path(row[2]).exists():
+            return None
+        return {'etag': row[0], 'size': row[1]}
+    
+    def miss(self):
+        """Count a request the cache could not serve (e.g. a failed revalidation)."""
+        with self._lock:
+            self.misses += 1
+    
+    def fetch(self, source: str, dest, etag: str = None, size: int = None):
+        """Link a cached copy of source to dest; returns the entry, or None on a miss."""
+        entry = self.lookup(source, etag, size)
+        if entry is not None:
+            link_or_copy(entry['path'], Path(dest))
+        return entry
+    
+    def read(self, source: str, etag: str = None, size: int = None):
+        """Return the cached bytes for source, or None on a miss."""
+        entry = self.lookup(source, etag, size)
+        return entry['path'].read_bytes() if entry is not None else None
+    
+    def put(self, source: str, path, etag: str = None, digests: dict = None):
+        """Add a downloaded file to the cache and evict down to the byte budget.
+        
+        With a sha256 digest the object is stored by content, so identical
+        files from different sources share one copy.
+        """
+        path = Path(path)
+        size = path.stat().st_size
+        if size > self.max_bytes:
+            return
+        digests = {k: v for k, v in (digests or {}).items() if k in ('sha256', 'xxh64', 'md5')}
+        name = digests.get('sha256') or hashlib.sha256(f'{source}\0{etag}\0{size}'.encode()).hexdigest()
+        obj = self._object_path(name)
+        added = 0
+        if not obj.exists():
+            obj.parent.mkdir(exist_ok=True)
+            link_or_copy(path, obj)
+            added = size
+        
+        with self._lock:
+            previous = self._db.execute('SELECT object, size FROM entries WHERE source = ?', (source,)).fetchone()
+            self._db.execute(
+                'INSERT OR REPLACE INTO entries (source, etag, size, object, last_access, digests) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (source, etag, size, name, time.time(), json.dumps(digests) if digests else None))
+            if previous is not None and previous[0] != name and \
+                    self._db.execute('SELECT 1 FROM entries WHERE object = ?', (previous[0],)).fetchone() is None:
+                # The source changed upstream; its old copy is no longer referenced
+                self._object_path(previous[0]).unlink(missing_ok=True)
+                added -= previous[1]
+            self._db.commit()
+            self._total += added
+            if self._total > self.max_bytes:
+                self._evict()
+    
+    def put_bytes(self, source: str, data: bytes, etag: str = None):
+        """Add an in-memory object (e.g. a zarr chunk) to the cache."""
+        tmp_path = self.objects_dir / f'.tmp-{os.getpid()}-{threading.get_ident()}'
+        tmp_path.write_bytes(data)
+        try:
+            self.put(source, tmp_path, etag)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+    
+    def _evict(self):
+        """Drop least recently used entries until the cache fits EVICT_TARGET of max_bytes.
+        
+        Called once the running estimate passes max_bytes; the exact total
+        is only scanned here, not on every put.
+        """
+        total = self._stored_bytes()
+        target = self.max_bytes * EVICT_TARGET
+        if total > self.max_bytes:
+            for source, size, name in self._db.execute(
+                    'SELECT source, size, object FROM entries ORDER BY last_access').fetchall():
+                self._db.execute('DELETE FROM entries WHERE source = ?', (source,))
+                shared = self._db.execute('SELECT 1 FROM entries WHERE object = ?', (name,)).fetchone()
+                if shared is None:
+                    self._object_path(name).unlink(missing_ok=True)
+                    total -= size
+                if total <= target:
+                    break
+            self._db.commit()
+        self._total = total
+    
+    def stats(self) -> dict:
+        """Hit/miss counters for this process and the current cache footprint."""
+        with self._lock:
+            entries, total = self._db.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'bytes_from_cache': self.bytes_hit,
+            'entries': entries,
+            'cache_size_mb': total / (1024 * 1024),
+            'max_size_mb': self.max_bytes / (1024 * 1024)
+        }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+_disabled = os.environ.get('EM_CACHE_DISABLE') == '1'
+
+
+def get_cache():
+    """Return the process-wide cache, or None if caching is disabled."""
+    global _cache
+    with _cache_lock:
+        if _cache is None and not _disabled:
+            _cache = FileCache()
+        return _cache
+
+
+def disable_cache():
+    """Turn off caching for this process (used by --no-cache)."""
+    global _cache, _disabled
+    with _cache_lock:
+        _cache = None
+        _disabled = True
+
+
+def cached_download(source: str, dest, download, etag: str = None, size: int = None) -> dict:
+    """Serve dest from the cache, or call download() and cache the result.
+    
+    download() returns a transfer record (size and digests); the record is
+    returned with `cached` set, using the stored digests on a hit. etag
+    and size are the source's current validators (HTTP HEAD, FTP listing);
+    a cached copy that no longer matches them is downloaded again.
+    """
+    cache = get_cache()
+    if cache is not None:
+        entry = cache.fetch(source, dest, etag, size)
+        if entry is not None:
+            return dict(entry['digests'], size_bytes=entry['size'], cached=True)
+    transfer = download()
+    if cache is not None:
+        cache.put(source, dest, etag, transfer)
+    return dict(transfer, cached=False)
@@ -0,0 +1,210 @@
+"""
+Convert downloaded TIFF/DM3 volumes to chunked, Blosc-compressed OME-Zarr pyramids
+"""
+
+import time
+import threading
+import multiprocessing
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# Chunk shape per dimensionality; z is kept short so slabs stay small in memory
+CHUNKS = {2: (512, 512), 3: (64, 256, 256)}
+
+# Stop adding pyramid levels once the smallest in-plane axis is below this
+MIN_LEVEL_SIZE = 256
+MAX_LEVELS = 6
+
+
+def compressor():
+    from numcodecs import Blosc
+    return Blosc(cname='zstd', clevel=5, shuffle=Blosc.BITSHUFFLE)
+
+
+def read_slabs(path: Path, depth: int):
+    """Return (shape, dtype, slabs) where slabs yields consecutive z-slabs of up to depth planes.
+    
+    TIFFs are decoded page by page with tifffile; DM3/DM4 files are read
+    lazily through hyperspy.
+    """
+    if path.suffix.lower() in ('.tif', '.tiff'):
+        import tifffile
+        tif = tifffile.TiffFile(path)
+        series = tif.series[0]
+        shape, dtype = tuple(series.shape), series.dtype
+        
+        def slabs():
+            with tif:
+                if len(shape) == 2:
+                    yield series.asarray()
+                    return
+                pages = iter(series.pages)
+                for z0 in range(0, shape[0], depth):
+                    yield np.stack([next(pages).asarray() for _ in range(min(depth, shape[0] - z0))])
+        return shape, dtype, slabs()
+    
+    if path.suffix.lower() in ('.dm3', '.dm4'):
+        try:
+            import hyperspy.api as hs
+        except ImportError:
+            raise ImportError("hyperspy is required to convert DM3/DM4 files") from None
+        data = hs.load(str(path), lazy=True).data
+        shape, dtype = tuple(data.shape), data.dtype
+        
+        def slabs():
+            if len(shape) == 2:
+                yield np.asarray(data)
+                return
+            for z0 in range(0, shape[0], depth):
+                yield np.asarray(data[z0:z0 + depth])
+        return shape, dtype, slabs()
+    
+    raise ValueError(f"Don't know how to convert {path.name}")
+
+
+def downsample(block: np.ndarray, method: str = 'mean') -> np.ndarray:
+    """Halve every axis; odd edges are padded by repetition."""
+    pad = [(0, n % 2) for n in block.shape]
+    if any(p for _, p in pad):
+        block = np.pad(block, pad, mode='edge')
+    if method == 'nearest':
+        return block[tuple(slice(None, None, 2) for _ in block.shape)]
+    shape = []
+    for n in block.shape:
+        shape += [n // 2, 2]
+    reduced = block.reshape(shape).mean(axis=tuple(range(1, 2 * block.ndim, 2)))
+    if np.issubdtype(block.dtype, np.integer):
+        reduced = np.rint(reduced)
+    return reduced.astype(block.dtype)
+
+
+def pyramid_shapes(shape, chunks) -> list:
+    """Shapes of each level, halving until the in-plane size would drop below MIN_LEVEL_SIZE."""
+    shapes = [tuple(shape)]
+    while len(shapes) < MAX_LEVELS and min(shapes[-1][-2:]) // 2 >= MIN_LEVEL_SIZE:
+        shapes.append(tuple((n + 1) // 2 for n in shapes[-1]))
+    return shapes
+
+
+class _Level:
+    """One pyramid level, buffering z-slabs until a whole chunk depth can be written."""
+    
+    def __init__(self, array):
+        self.array = array
+        self.depth = array.chunks[0] if array.ndim == 3 else array.shape[0]
+        self.z = 0
+        self.buffer = []
+    
+    def write(self, slab: np.ndarray, final: bool = False):
+        if self.array.ndim == 2:
+            if slab is not None:
+                self.array[...] = slab
+            return
+        if slab is not None and len(slab):
+            self.buffer.append(slab)
+        buffered = sum(len(b) for b in self.buffer)
+        if buffered >= self.depth or (final and buffered):
+            data = np.concatenate(self.buffer)
+            # Write whole chunks only; keep the remainder for the next slab
+            n = len(data) if final else len(data) - len(data) % self.depth
+            self.array[self.z:self.z + n] = data[:n]
+            self.z += n
+            self.buffer = [data[n:]] if n < len(data) else []
+
+
+def convert_to_zarr(path, dest, resolution_nm=None, method: str = None, chunks=None) -> dict:
+    """Write path as an OME-Zarr (v0.4) multiscale group at dest.
+    
+    Planes are decoded slab by slab and every pyramid level is built from
+    the slab in memory, so the source is read once. resolution_nm is
+    (x, y, z) as recorded in metadata.json. Label volumes (file names
+    containing 'groundtruth' or 'label') are downsampled by striding rather
+    than averaging unless method is given.
+    """
+    import zarr
+    
+    start = time.time()
+    path, dest = Path(path), Path(dest)
+    if method is None:
+        method = 'nearest' if any(key in path.name.lower() for key in ('groundtruth', 'label')) else 'mean'
+    
+    # A slab depth divisible by 2**(levels - 1) downsamples exactly like the whole volume
+    shape, dtype, slabs = read_slabs(path, (chunks or CHUNKS[3])[0])
+    ndim = len(shape)
+    chunks = tuple(chunks or CHUNKS[ndim])
+    shapes = pyramid_shapes(shape, chunks)
+    
+    group = zarr.open_group(str(dest), mode='w')
+    levels = [_Level(group.create_dataset(str(i), shape=level_shape, dtype=dtype,
+                                          chunks=tuple(min(c, n) for c, n in zip(chunks, level_shape)),
+                                          compressor=compressor(), dimension_separator='/'))
+              for i, level_shape in enumerate(shapes)]
+    
+    for slab in slabs:
+        for i, level in enumerate(levels):
+            if i:
+                slab = downsample(slab, method)
+            level.write(slab)
+    for level in levels:
+        level.write(None, final=True)
+    
+    # OME-Zarr axes are ordered like the array: (z,) y, x
+    axes = ['z', 'y', 'x'][-ndim:]
+    voxel = list(reversed(resolution_nm or [1, 1, 1]))[-ndim:]
+    group.attrs['multiscales'] = [{
+        'version': '0.4',
+        'name': path.stem,
+        'axes': [{'name': axis, 'type': 'space', 'unit': 'nanometer'} for axis in axes],
+        'datasets': [{'path': str(i), 'coordinateTransformations': [
+            {'type': 'scale', 'scale': [v * 2 ** i for v in voxel]}]} for i in range(len(levels))],
+        'metadata': {'method': f'2x {method}'}
+    }]
+    
+    stored = sum(f.stat().st_size for f in dest.rglob('*') if f.is_file())
+    return {
+        'path': str(dest),
+        'shape': list(shape),
+        'dtype': str(dtype),
+        'chunks': list(chunks),
+        'levels': len(levels),
+        'stored_mb': stored / (1024 * 1024),
+        'seconds': round(time.time() - start, 2)
+    }
+
+
+class Converter:
+    """Runs conversions in a process pool so they overlap with downloads."""
+    
+    def __init__(self, output_dir, resolution_nm=None, workers: int = None):
+        self.output_dir = Path(output_dir)
+        self.resolution_nm = resolution_nm
+        # Downloader threads are running, so workers are spawned rather than forked
+        self._executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+        self._futures = {}
+        self._lock = threading.Lock()
+    
+    def submit(self, path, key: str = None):
+        """Queue conversion of a completed download to <output_dir>/<key>.ome.zarr."""
+        path = Path(path)
+        key = key or path.name
+        dest = self.output_dir / f"{Path(key).with_suffix('')}.ome.zarr"
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            self._futures[key] = self._executor.submit(convert_to_zarr, path, dest, self.resolution_nm)
+    
+    def results(self) -> dict:
+        """Wait for the conversions queued so far; returns key -> record (or error)."""
+        with self._lock:
+            futures, self._futures = self._futures, {}
+        records = {}
+        for key, future in futures.items():
+            try:
+                records[key] = future.result()
+            except Exception as exc:
+                records[key] = {'error': f'{type(exc).__name__}: {exc}'}
+        return records
+    
+    def close(self):
+        self._executor.shutdown()
@@ -0,0 +1,127 @@
+"""
+Parallel recursive FTP crawl over pooled sessions
+"""
+
+import re
+import queue
+import fnmatch
+import posixpath
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from em_utils.ftp_index import list_directory
+from em_utils.instrument import METRICS
+from em_utils.retry import retry_call
+
+_DONE = object()
+
+
+class FTPCrawler:
+    """Walk an FTP tree with several pooled sessions, yielding files as they are found.
+    
+    Iterating yields (relative_path, remote_path, size) for every file under
+    root whose relative path matches any include glob (or regex) and whose
+    size is within [min_size, max_size]. Directories are listed in parallel
+    and files stream out while the crawl is still running, so downloads can
+    start before the listing finishes.
+    """
+    
+    def __init__(self, pool, root: str, include=None, regex: str = None, min_size: int = None,
+                 max_size: int = None, max_files: int = None, workers: int = 4):
+        self.pool = pool
+        self.root = root.rstrip('/') or '/'
+        self.include = list(include or [])
+        self.regex = re.compile(regex) if regex else None
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_files = max_files
+        self.workers = workers
+        
+        self.dirs_listed = 0
+        self.files_seen = 0
+        self.files_matched = 0
+        self.dirs_failed = []
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._stop = threading.Event()
+    
+    def matches(self, relative_path: str, size) -> bool:
+        if self.include and not any(fnmatch.fnmatch(relative_path, pattern) for pattern in self.include):
+            return False
+        if self.regex is not None and not self.regex.search(relative_path):
+            return False
+        if size is not None and self.min_size is not None and size < self.min_size:
+            return False
+        if size is not None and self.max_size is not None and size > self.max_size:
+            return False
+        return True
+    
+    def _list(self, executor, path: str):
+        """List one directory, queue its matching files and schedule its subdirectories."""
+        try:
+            if not self._stop.is_set():
+                with METRICS.phase('listing'):
+                    entries = retry_call(lambda: self.pool.run(lambda ftp: list_directory(ftp, path)), self.pool.host)
+                with self._lock:
+                    self.dirs_listed += 1
+                for name, kind, size, _ in sorted(entries):
+                    remote_path = posixpath.join(path, name)
+                    if kind == 'dir':
+                        self._submit(executor, remote_path)
+                    elif kind == 'file':
+                        relative_path = posixpath.relpath(remote_path, self.root)
+                        with self._lock:
+                            self.files_seen += 1
+                        if self.matches(relative_path, size):
+                            self._queue.put((relative_path, remote_path, size))
+        except Exception as exc:
+            if path == self.root:
+                self._queue.put(exc)
+            else:
+                # One unreadable subdirectory does not end the crawl; it is reported in summary()
+                with self._lock:
+                    self.dirs_failed.append({'path': path, 'error': f'{type(exc).__name__}: {exc}'})
+        finally:
+            with self._lock:
+                self._pending -= 1
+                finished = self._pending == 0
+            if finished:
+                self._queue.put(_DONE)
+    
+    def _submit(self, executor, path: str):
+        with self._lock:
+            self._pending += 1
+        executor.submit(self._list, executor, path)
+    
+    def __iter__(self):
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            self._submit(executor, self.root)
+            try:
+                while True:
+                    item = self._queue.get()
+                    if item is _DONE:
+                        return
+                    if isinstance(item, Exception):
+                        raise item
+                    if self.max_files is not None and self.files_matched >= self.max_files:
+                        # Enough files; let in-flight listings drain without descending further
+                        self._stop.set()
+                        continue
+                    self.files_matched += 1
+                    yield item
+            finally:
+                self._stop.set()
+    
+    def summary(self) -> dict:
+        return {
+            'root': self.root,
+            'include': self.include,
+            'regex': self.regex.pattern if self.regex else None,
+            'min_size': self.min_size,
+            'max_size': self.max_size,
+            'dirs_listed': self.dirs_listed,
+            'files_seen': self.files_seen,
+            'files_matched': self.files_matched,
+            'dirs_failed': self.dirs_failed
+        }
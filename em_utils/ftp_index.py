@@ -0,0 +1,163 @@
+"""
+Persisted FTP directory listings (names, sizes, mtimes) for offline queries
+"""
+
+import re
+import time
+import ftplib
+import sqlite3
+import threading
+from pathlib import Path
+
+from em_utils.cache import DEFAULT_CACHE_DIR
+from em_utils.instrument import METRICS
+
+DEFAULT_INDEX_PATH = DEFAULT_CACHE_DIR / 'ftp_index.sqlite'
+
+# Listings younger than this are trusted without contacting the server
+DEFAULT_MAX_AGE = 24 * 3600
+
+# drwxr-xr-x  2 owner group  12345 Jan 01  2020 name
+LIST_LINE = re.compile(r'^([\-dl])\S*\s+\d+\s+\S+\s+\S+\s+(\d+)\s+(\w{3}\s+\d+\s+[\d:]+)\s+(.+)$')
+
+
+def parse_list_line(line: str):
+    """Parse one Unix-style LIST line into (name, type, size, modify), or None."""
+    match = LIST_LINE.match(line)
+    if match is None:
+        return None
+    kind, size, modify, name = match.groups()
+    if kind == 'l':
+        name = name.split(' -> ')[0]
+    return name, {'d': 'dir', 'l': 'link'}.get(kind, 'file'), int(size), modify
+
+
+def list_directory(ftp: ftplib.FTP, path: str) -> list:
+    """List path as (name, type, size, modify) with MLSD, falling back to LIST."""
+    try:
+        return [(name, facts.get('type', 'file'), int(facts['size']) if 'size' in facts else None, facts.get('modify'))
+                for name, facts in ftp.mlsd(path, facts=['type', 'size', 'modify'])
+                if facts.get('type') not in ('cdir', 'pdir')]
+    except ftplib.error_perm as exc:
+        if not str(exc).startswith('50'):
+            raise
+    lines = []
+    ftp.retrlines(f'LIST {path}', lines.append)
+    entries = [parse_list_line(line) for line in lines]
+    return [entry for entry in entries if entry is not None and entry[0] not in ('.', '..')]
+
+
+def directory_modify(ftp: ftplib.FTP, path: str):
+    """The directory's own modify fact from MLST, or None if unsupported."""
+    try:
+        reply = ftp.sendcmd(f'MLST {path}')
+    except ftplib.error_perm:
+        return None
+    match = re.search(r'modify=(\d+(?:\.\d+)?);', reply, re.IGNORECASE)
+    return match.group(1) if match else None
+
+
+class FTPIndex:
+    """SQLite index of remote directory listings, refreshed incrementally.
+    
+    A directory is re-listed only when its listing is older than max_age
+    and its MLST modify time has changed since it was last listed; entries
+    are then updated in place rather than rebuilt.
+    """
+    
+    def __init__(self, path=DEFAULT_INDEX_PATH):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS dirs (
+                host TEXT NOT NULL,
+                path TEXT NOT NULL,
+                modify TEXT,
+                listed_at REAL NOT NULL,
+                PRIMARY KEY (host, path)
+            )""")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                host TEXT NOT NULL,
+                dir TEXT NOT NULL,
+                name TEXT NOT NULL,
+                type TEXT NOT NULL,
+                size INTEGER,
+                modify TEXT,
+                PRIMARY KEY (host, dir, name)
+            )""")
+        self._db.execute('CREATE INDEX IF NOT EXISTS files_size ON files (host, dir, size)')
+        self._db.commit()
+    
+    @staticmethod
+    def host_key(pool) -> str:
+        return f'{pool.host}:{pool.port}'
+    
+    def listed(self, host: str, path: str):
+        """Return (modify, listed_at) for a directory, or None if never listed."""
+        with self._lock:
+            return self._db.execute('SELECT modify, listed_at FROM dirs WHERE host = ? AND path = ?',
+                                    (host, path)).fetchone()
+    
+    def refresh(self, pool, path: str, max_age: float = DEFAULT_MAX_AGE, force: bool = False) -> dict:
+        """Bring the listing of path up to date; returns counts of what changed."""
+        host = self.host_key(pool)
+        previous = self.listed(host, path)
+        if previous is not None and not force and time.time() - previous[1] < max_age:
+            return {'listed': False, 'added': 0, 'changed': 0, 'removed': 0}
+        
+        def fetch(ftp):
+            modify = directory_modify(ftp, path)
+            if previous is not None and not force and modify is not None and modify == previous[0]:
+                return modify, None
+            return modify, list_directory(ftp, path)
+        
+        with METRICS.phase('listing'):
+            modify, entries = pool.run(fetch)
+        with self._lock:
+            if entries is None:
+                # Unchanged on the server; only the check time moves
+                self._db.execute('UPDATE dirs SET listed_at = ? WHERE host = ? AND path = ?', (time.time(), host, path))
+                self._db.commit()
+                return {'listed': False, 'added': 0, 'changed': 0, 'removed': 0}
+            
+            known = {row[0]: row[1:] for row in self._db.execute(
+                'SELECT name, type, size, modify FROM files WHERE host = ? AND dir = ?', (host, path))}
+            current = {name: (kind, size, mtime) for name, kind, size, mtime in entries}
+            changed = [(host, path, name, *facts) for name, facts in current.items() if known.get(name) != facts]
+            removed = [(host, path, name) for name in known.keys() - current.keys()]
+            self._db.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)', changed)
+            self._db.executemany('DELETE FROM files WHERE host = ? AND dir = ? AND name = ?', removed)
+            self._db.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?)', (host, path, modify, time.time()))
+            self._db.commit()
+        added = len(current.keys() - known.keys())
+        return {'listed': True, 'added': added, 'changed': len(changed) - added, 'removed': len(removed)}
+    
+    def files(self, host: str, path: str, suffix: str = None, max_size: int = None,
+              limit: int = None, order: str = 'name') -> list:
+        """Query indexed files in path without contacting the server.
+        
+        Returns dicts with name, size and modify; order is 'name' or 'size'
+        (largest first).
+        """
+        sql = "SELECT name, size, modify FROM files WHERE host = ? AND dir = ? AND type = 'file'"
+        params = [host, path]
+        if suffix:
+            sql += ' AND substr(name, -?) = ?'
+            params += [len(suffix), suffix]
+        if max_size is not None:
+            sql += ' AND size <= ?'
+            params.append(max_size)
+        sql += ' ORDER BY size DESC, name' if order == 'size' else ' ORDER BY name'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        with self._lock:
+            rows = self._db.execute(sql, params).fetchall()
+        return [{'name': name, 'size': size, 'modify': modify} for name, size, modify in rows]
+    
+    def close(self):
+        self._db.close()
@@ -0,0 +1,189 @@
+"""
+Pooled FTP sessions shared by the FTP-based downloaders
+"""
+
+import ftplib
+import threading
+import time
+from contextlib import contextmanager
+
+from em_utils.scheduler import connection_slot
+from em_utils.instrument import METRICS
+from em_utils.retry import POLICY
+
+# Errors after which a session is considered dead and is replaced
+RECONNECT_ERRORS = (EOFError, OSError, ftplib.error_reply, ftplib.error_proto)
+
+
+def is_reconnect_error(exc: BaseException) -> bool:
+    """Return True if the error means the session should be reopened."""
+    if isinstance(exc, ftplib.error_temp):
+        return str(exc).startswith('421')
+    return isinstance(exc, RECONNECT_ERRORS)
+
+
+class FTPPool:
+    """Thread-safe pool of logged-in FTP sessions for a single host."""
+    
+    def __init__(self, host: str, port: int = 21, user: str = '', passwd: str = '',
+                 max_sessions: int = 4, timeout: float = None, keepalive: float = 30):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.passwd = passwd
+        self.max_sessions = max_sessions
+        self.timeout = timeout
+        self.keepalive = keepalive
+        
+        self._slots = threading.BoundedSemaphore(max_sessions)
+        self._lock = threading.Lock()
+        self._idle = []  # (ftp, last_used) pairs, most recently used last
+        self._closed = threading.Event()
+        self._keepalive_thread = None
+        self.connects = 0
+    
+    def _connect(self) -> ftplib.FTP:
+        """Open and log in a new session."""
+        started = time.perf_counter()
+        # Control and data sockets; a stalled transfer raises instead of hanging
+        ftp = ftplib.FTP(timeout=self.timeout or POLICY.read_timeout)
+        ftp.connect(self.host, self.port)
+        ftp.login(self.user, self.passwd)
+        METRICS.observe('connect_seconds', time.perf_counter() - started, host=self.host)
+        ftp.pool_cwd = None
+        ftp.pool_reused = False
+        with self._lock:
+            self.connects += 1
+        return ftp
+    
+    @staticmethod
+    def _close(ftp: ftplib.FTP):
+        """Close a session, ignoring errors from an already dead connection."""
+        try:
+            ftp.quit()
+        except ftplib.all_errors:
+            ftp.close()
+    
+    def _checkout(self, fresh: bool = False) -> ftplib.FTP:
+        """Take an idle session, or open one if none is available (or fresh is set)."""
+        self._slots.acquire()
+        try:
+            while not fresh:
+                with self._lock:
+                    if not self._idle:
+                        break
+                    ftp, last_used = self._idle.pop()
+                ftp.pool_reused = True
+                if time.monotonic() - last_used < self.keepalive:
+                    return ftp
+                # Idle long enough that the server may have dropped it
+                try:
+                    ftp.voidcmd('NOOP')
+                    return ftp
+                except ftplib.all_errors:
+                    ftp.close()
+            return self._connect()
+        except BaseException:
+            self._slots.release()
+            raise
+    
+    def _checkin(self, ftp: ftplib.FTP, healthy: bool = True):
+        """Return a session to the pool, or drop it if it is broken."""
+        if healthy and not self._closed.is_set():
+            with self._lock:
+                self._idle.append((ftp, time.monotonic()))
+            self._start_keepalive()
+        else:
+            self._close(ftp)
+        self._slots.release()
+    
+    def _start_keepalive(self):
+        """Start the background thread that keeps idle sessions alive."""
+        with self._lock:
+            if self._keepalive_thread is not None or self.keepalive <= 0:
+                return
+            self._keepalive_thread = threading.Thread(target=self._keepalive_loop, daemon=True)
+        self._keepalive_thread.start()
+    
+    def _keepalive_loop(self):
+        """Send NOOP on sessions that have been idle for a keepalive interval."""
+        while not self._closed.wait(self.keepalive):
+            now = time.monotonic()
+            with self._lock:
+                stale = [entry for entry in self._idle if now - entry[1] >= self.keepalive]
+                self._idle = [entry for entry in self._idle if now - entry[1] < self.keepalive]
+            for ftp, _ in stale:
+                try:
+                    ftp.voidcmd('NOOP')
+                except ftplib.all_errors:
+                    ftp.close()
+                    continue
+                with self._lock:
+                    self._idle.insert(0, (ftp, time.monotonic()))
+    
+    @contextmanager
+    def session(self, cwd: str = None, fresh: bool = False):
+        """Borrow a logged-in session, changing to cwd if given; fresh skips the idle sessions."""
+        with connection_slot(self.host):
+            ftp = self._checkout(fresh)
+            healthy = True
+            try:
+                if cwd is not None and ftp.pool_cwd != cwd:
+                    ftp.cwd(cwd)
+                    ftp.pool_cwd = cwd
+                yield ftp
+            except BaseException as exc:
+                # Only a permanent reply (e.g. 550) leaves the session in a known state
+                healthy = isinstance(exc, ftplib.error_perm)
+                raise
+            finally:
+                self._checkin(ftp, healthy)
+    
+    def run(self, func, cwd: str = None):
+        """Call func(ftp) on a pooled session.
+        
+        If a reused session turns out to have been dropped by the server
+        (421, reset, timeout), func is called once more on a new session.
+        Any other failure is raised; retrying is left to retry_call.
+        """
+        reused = False
+        try:
+            with self.session(cwd) as ftp:
+                reused = ftp.pool_reused
+                return func(ftp)
+        except ftplib.all_errors as exc:
+            if not reused or not is_reconnect_error(exc):
+                raise
+        with self.session(cwd, fresh=True) as ftp:
+            return func(ftp)
+    
+    def close(self):
+        """Close all idle sessions and stop the keepalive thread."""
+        self._closed.set()
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for ftp, _ in idle:
+            self._close(ftp)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(host: str, port: int = 21, **kwargs) -> FTPPool:
+    """Return the process-wide pool for host, creating it on first use."""
+    with _pools_lock:
+        pool = _pools.get((host, port))
+        if pool is None or pool._closed.is_set():
+            pool = FTPPool(host, port, **kwargs)
+            _pools[(host, port)] = pool
+        return pool
+
+
+def close_all():
+    """Close every pool created through get_pool."""
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
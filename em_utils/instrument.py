@@ -0,0 +1,341 @@
+"""
+Counters, latency histograms, rate timelines and event logs shared by all downloaders
+"""
+
+import sys
+import json
+import time
+import atexit
+import threading
+from pathlib import Path
+from contextlib import contextmanager
+from collections import defaultdict
+
+from em_utils.scheduler import add_byte_hook
+
+# Upper bounds (seconds) of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Samples kept per histogram for exact quantiles in summaries
+MAX_SAMPLES = 10000
+
+# Points kept in the rate timeline written to metadata.json
+TIMELINE_POINTS = 120
+
+
+class Histogram:
+    """Cumulative-bucket histogram (Prometheus style) plus a bounded sample for quantiles."""
+    
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.samples = []
+    
+    def observe(self, value: float):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+        if len(self.samples) < MAX_SAMPLES:
+            self.samples.append(value)
+    
+    def summary(self) -> dict:
+        ordered = sorted(self.samples)
+        pick = lambda q: round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 4) if ordered else None
+        return {'count': self.count, 'mean': round(self.sum / self.count, 4) if self.count else None,
+                'p50': pick(0.5), 'p95': pick(0.95), 'max': round(ordered[-1], 4) if ordered else None}
+
+
+class Metrics:
+    """Process-wide instrumentation.
+    
+    Bytes arrive through the transfer layers' byte hook; connect and
+    time-to-first-byte latencies, retries, listing and write time are
+    reported by the transfer code; per-file timings come from track_file.
+    A sampler thread turns byte counts into a rate timeline and, when
+    configured, appends to a JSON-lines event log, rewrites a Prometheus
+    textfile and redraws a one-line progress view.
+    """
+    
+    def __init__(self):
+        self.started = time.monotonic()
+        self.bytes_total = 0
+        self.counters = defaultdict(int)
+        self.histograms = defaultdict(Histogram)
+        self.phases = defaultdict(float)
+        self.timeline = []
+        self.files = []
+        self.active = 0
+        
+        self.event_path = None
+        self.prometheus_path = None
+        self.progress = False
+        self.interval = 1.0
+        self._events = None
+        self._lock = threading.Lock()
+        self._sampler = None
+        add_byte_hook(self.add_bytes)
+    
+    def configure(self, events=None, prometheus=None, progress: bool = False, interval: float = 1.0):
+        """Enable the event log, Prometheus textfile and/or live progress view."""
+        self.event_path = Path(events) if events else None
+        self.prometheus_path = Path(prometheus) if prometheus else None
+        self.progress = progress
+        self.interval = interval
+        if self.event_path is not None:
+            self._events = open(self.event_path, 'a', buffering=1)
+        self._start_sampler()
+        atexit.register(self.close)
+    
+    def close(self):
+        """Write the final Prometheus textfile and close the event log."""
+        if self.prometheus_path is not None:
+            self.write_prometheus(self.prometheus_path)
+        if self.progress:
+            sys.stderr.write('\n')
+        if self._events is not None:
+            self.event('summary', **self.summary())
+            with self._lock:
+                self._events.close()
+                self._events = None
+    
+    def add_bytes(self, nbytes: int):
+        with self._lock:
+            self.bytes_total += nbytes
+    
+    def count(self, name: str, value: int = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] += value
+        if name == 'retries':
+            self.event('retry', **labels)
+    
+    def total(self, name: str) -> int:
+        """Sum of a counter over all of its labels."""
+        with self._lock:
+            return sum(v for (key, _), v in self.counters.items() if key == name)
+    
+    def observe(self, name: str, seconds: float, **labels):
+        """Record a latency, e.g. 'connect_seconds' or 'ttfb_seconds'."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.histograms[key].observe(seconds)
+    
+    def add_phase(self, phase: str, seconds: float):
+        with self._lock:
+            self.phases[phase] += seconds
+    
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.perf_counter() - start)
+    
+    def event(self, kind: str, **fields):
+        if self._events is not None:
+            record = dict(ts=round(time.time(), 3), event=kind, **fields)
+            with self._lock:
+                self._events.write(json.dumps(record, default=str) + '\n')
+    
+    @contextmanager
+    def track_file(self, dataset: str, filename: str):
+        """Time one file; the caller may set record['bytes'] and record['cached'].
+        
+        record['started'] (seconds since the process started) and
+        record['seconds'] are filled in by this block.
+        """
+        self._start_sampler()
+        record = {'dataset': dataset, 'filename': filename, 'bytes': 0, 'cached': False,
+                  'started': round(time.monotonic() - self.started, 3)}
+        with self._lock:
+            self.active += 1
+        self.event('file_start', dataset=dataset, filename=filename)
+        start = time.perf_counter()
+        try:
+            yield record
+            record['status'] = 'ok'
+        except BaseException as exc:
+            record['status'] = 'failed'
+            record['error'] = f'{type(exc).__name__}: {exc}'
+            raise
+        finally:
+            record['seconds'] = round(time.perf_counter() - start, 3)
+            self.add_phase('transfer', record['seconds'])
+            with self._lock:
+                self.active -= 1
+                self.files.append(record)
+            self.event('file_done' if record['status'] == 'ok' else 'file_error', **record)
+    
+    def _start_sampler(self):
+        with self._lock:
+            if self._sampler is not None:
+                return
+            self._sampler = threading.Thread(target=self._sample_loop, daemon=True)
+        self._sampler.start()
+    
+    def _sample_loop(self):
+        last_bytes, last_time = self.bytes_total, time.monotonic()
+        while True:
+            time.sleep(self.interval)
+            now = time.monotonic()
+            rate = (self.bytes_total - last_bytes) / (now - last_time)
+            last_bytes, last_time = self.bytes_total, now
+            with self._lock:
+                self.timeline.append((round(now - self.started, 2), rate))
+            self.event('rate', bytes_per_s=round(rate), bytes_total=self.bytes_total, active=self.active)
+            if self.prometheus_path is not None:
+                self.write_prometheus(self.prometheus_path)
+            if self.progress:
+                self._draw(rate)
+    
+    def _draw(self, rate: float):
+        done = sum(1 for f in self.files if f['status'] == 'ok')
+        failed = len(self.files) - done
+        line = (f"\r{done} files done, {failed} failed, {self.active} active | "
+                f"{self.bytes_total / 1024 ** 2:10.1f} MB | {rate / 1024 ** 2:8.2f} MB/s ")
+        sys.stderr.write(line)
+        sys.stderr.flush()
+    
+    def write_prometheus(self, path):
+        """Write all metrics in the Prometheus text exposition format (atomically)."""
+        label = lambda labels: '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}' if labels else ''
+        lines = ['# TYPE em_download_bytes_total counter', f'em_download_bytes_total {self.bytes_total}',
+                 '# TYPE em_download_active_files gauge', f'em_download_active_files {self.active}']
+        with self._lock:
+            counters = dict(self.counters)
+            histograms = {key: (list(h.counts), h.count, h.sum) for key, h in self.histograms.items()}
+            phases = dict(self.phases)
+            statuses = [f['status'] for f in self.files]
+        lines.append('# TYPE em_download_files_total counter')
+        for status in ('ok', 'failed'):
+            lines.append(f'em_download_files_total{{status="{status}"}} {statuses.count(status)}')
+        for (name, labels), value in sorted(counters.items()):
+            lines.append(f'em_download_{name}_total{label(labels)} {value}')
+        for phase, seconds in sorted(phases.items()):
+            lines.append(f'em_download_phase_seconds_total{label([("phase", phase)])} {seconds:.3f}')
+        previous = None
+        for (name, labels), (counts, count, total) in sorted(histograms.items()):
+            if name != previous:
+                lines.append(f'# TYPE em_download_{name} histogram')
+                previous = name
+            for bound, n in zip(BUCKETS, counts):
+                lines.append(f'em_download_{name}_bucket{label(labels + (("le", bound),))} {n}')
+            lines.append(f'em_download_{name}_bucket{label(labels + (("le", "+Inf"),))} {count}')
+            lines.append(f'em_download_{name}_sum{label(labels)} {total:.6f}')
+            lines.append(f'em_download_{name}_count{label(labels)} {count}')
+        path = Path(path)
+        tmp = path.with_name(path.name + '.tmp')
+        tmp.write_text('\n'.join(lines) + '\n')
+        tmp.replace(path)
+    
+    def summary(self, dataset: str = None) -> dict:
+        """Instrumentation summary for metadata.json.
+        
+        File counts, bytes, elapsed time and rates cover the files tracked
+        for dataset (all files if None). Latencies, retries, phases and the
+        rate timeline are not attributed to datasets, so they are reported
+        for the whole process under 'run'; under run_all.py they include
+        every dataset downloading alongside this one.
+        """
+        with self._lock:
+            files = [f for f in self.files if dataset is None or f['dataset'] == dataset]
+            histograms = {}
+            for (name, labels), hist in self.histograms.items():
+                merged = histograms.setdefault(name, Histogram())
+                merged.counts = [a + b for a, b in zip(merged.counts, hist.counts)]
+                merged.count += hist.count
+                merged.sum += hist.sum
+                merged.samples += hist.samples
+            timeline = list(self.timeline)
+            phases = dict(self.phases)
+        retries = self.total('retries')
+        
+        # Downsample the timeline by averaging neighbouring points
+        step = max(1, -(-len(timeline) // TIMELINE_POINTS))
+        timeline = [[timeline[i][0], round(sum(r for _, r in timeline[i:i + step]) / len(timeline[i:i + step])
+                                           / 1024 ** 2, 3)] for i in range(0, len(timeline), step)]
+        
+        transferred = [f for f in files if not f['cached'] and f['seconds'] > 0]
+        rates = sorted(f['bytes'] / f['seconds'] / 1024 ** 2 for f in transferred)
+        nbytes = sum(f['bytes'] for f in files if not f['cached'])
+        # Wall time from the first file starting to the last one finishing
+        span = max(f['started'] + f['seconds'] for f in files) - min(f['started'] for f in files) if files else 0
+        elapsed = time.monotonic() - self.started
+        return {
+            'elapsed_s': round(span, 2),
+            'bytes': nbytes,
+            'mean_mb_s': round(nbytes / span / 1024 ** 2, 3) if span else None,
+            'files': {'completed': sum(1 for f in files if f['status'] == 'ok'),
+                      'failed': sum(1 for f in files if f['status'] != 'ok'),
+                      'cached': sum(1 for f in files if f['cached'])},
+            'per_file_mb_s': {'p50': round(rates[len(rates) // 2], 3), 'min': round(rates[0], 3),
+                              'max': round(rates[-1], 3)} if rates else None,
+            'run': {
+                'elapsed_s': round(elapsed, 2),
+                'bytes_total': self.bytes_total,
+                'mean_mb_s': round(self.bytes_total / elapsed / 1024 ** 2, 3),
+                'retries': retries,
+                'phases_s': {phase: round(seconds, 3) for phase, seconds in phases.items()},
+                'latency_s': {name: hist.summary() for name, hist in histograms.items()},
+                'rate_timeline_mb_s': timeline
+            }
+        }
+
+
+METRICS = Metrics()
+
+
+def add_arguments(parser):
+    """Add the shared instrumentation options to a downloader's argument parser."""
+    parser.add_argument('--events', help='Append a JSON-lines event log to this file')
+    parser.add_argument('--prometheus', help='Rewrite this Prometheus textfile every second')
+    parser.add_argument('--progress', action='store_true', help='Show a live progress line on stderr')
+
+
+def configure(args):
+    """Apply the options added by add_arguments."""
+    if args.events or args.prometheus or args.progress:
+        METRICS.configure(args.events, args.prometheus, args.progress)
+
+
+def aiohttp_trace():
+    """aiohttp TraceConfig that records connect and time-to-first-byte latencies."""
+    import aiohttp
+    
+    async def connect_start(session, ctx, params):
+        ctx.connect_start = time.perf_counter()
+    
+    async def connect_end(session, ctx, params):
+        METRICS.observe('connect_seconds', time.perf_counter() - ctx.connect_start, host=ctx.host)
+    
+    async def request_start(session, ctx, params):
+        ctx.request_start = time.perf_counter()
+        ctx.host = params.url.host
+    
+    async def request_end(session, ctx, params):
+        # Fires once the response headers have arrived
+        METRICS.observe('ttfb_seconds', time.perf_counter() - ctx.request_start, host=ctx.host)
+    
+    trace = aiohttp.TraceConfig()
+    trace.on_request_start.append(request_start)
+    trace.on_connection_create_start.append(connect_start)
+    trace.on_connection_create_end.append(connect_end)
+    trace.on_request_end.append(request_end)
+    return trace
+
+
+def first_byte(callback, host: str):
+    """Wrap a data callback so its first call records time-to-first-byte from now."""
+    started = time.perf_counter()
+    pending = [True]
+    
+    def wrapped(data):
+        if pending:
+            pending.clear()
+            METRICS.observe('ttfb_seconds', time.perf_counter() - started, host=host)
+        return callback(data)
+    return wrapped
@@ -0,0 +1,119 @@
+"""
+Digests computed while bytes are written, and parallel re-verification
+"""
+
+import os
+import re
+import json
+import hashlib
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+HASH_BLOCK = 4 * 1024 * 1024
+
+
+class IntegrityError(IOError):
+    """A downloaded file does not match the size or checksum reported by the server."""
+
+
+def etag_md5(etag: str):
+    """Return the MD5 hex digest carried by an ETag, if it is a plain MD5."""
+    if not etag:
+        return None
+    value = etag.strip().removeprefix('W/').strip('"').lower()
+    return value if re.fullmatch(r'[0-9a-f]{32}', value) else None
+
+
+class Digester:
+    """Incremental SHA-256, xxh64 (if installed) and optionally MD5."""
+    
+    def __init__(self, md5: bool = False):
+        self._hashes = {'sha256': hashlib.sha256()}
+        if xxhash is not None:
+            self._hashes['xxh64'] = xxhash.xxh64()
+        if md5:
+            self._hashes['md5'] = hashlib.md5()
+    
+    def update(self, data):
+        for h in self._hashes.values():
+            h.update(data)
+    
+    def update_from_file(self, f, length: int, offset: int = 0):
+        """Hash length bytes of an open file starting at offset."""
+        while length > 0:
+            data = os.pread(f.fileno(), min(HASH_BLOCK, length), offset)
+            if not data:
+                break
+            self.update(data)
+            offset += len(data)
+            length -= len(data)
+    
+    def hexdigests(self) -> dict:
+        return {name: h.hexdigest() for name, h in self._hashes.items()}
+
+
+def digest_fields(transfer: dict) -> dict:
+    """The digest and verification fields of a transfer record, for metadata."""
+    return {k: transfer[k] for k in ('sha256', 'xxh64', 'md5', 'verified') if k in transfer}
+
+
+def check(path, digests: dict, expected_size: int = None, etag: str = None) -> dict:
+    """Compare a finished transfer against what the server reported.
+    
+    Returns the verification record for metadata; raises IntegrityError
+    on a mismatch.
+    """
+    size = Path(path).stat().st_size
+    verified = {}
+    if expected_size is not None:
+        if size != expected_size:
+            raise IntegrityError(f"{path}: size {size} != remote size {expected_size}")
+        verified['size'] = True
+    expected_md5 = etag_md5(etag)
+    if expected_md5 and 'md5' in digests:
+        if digests['md5'] != expected_md5:
+            raise IntegrityError(f"{path}: md5 {digests['md5']} != ETag {expected_md5}")
+        verified['md5'] = True
+    return verified
+
+
+def hash_file(path) -> dict:
+    """Digests of a file on disk (used by --verify)."""
+    digester = Digester()
+    with open(path, 'rb') as f:
+        digester.update_from_file(f, os.fstat(f.fileno()).st_size)
+    return digester.hexdigests()
+
+
+def _verify_one(args):
+    path, expected = args
+    if not Path(path).exists():
+        return path, 'missing'
+    if Path(path).stat().st_size != expected.get('size_bytes', Path(path).stat().st_size):
+        return path, 'size mismatch'
+    return path, 'ok' if hash_file(path)['sha256'] == expected['sha256'] else 'checksum mismatch'
+
+
+def verify_files(download_dir, workers: int = None) -> dict:
+    """Re-hash every file recorded in download_dir/metadata.json across processes."""
+    download_dir = Path(download_dir)
+    with open(download_dir / "metadata.json") as f:
+        metadata = json.load(f)
+    
+    jobs = [(str(download_dir / entry['filename']), entry)
+            for entry in metadata.get('files', []) if entry.get('sha256')]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        outcomes = dict(executor.map(_verify_one, jobs))
+    
+    failed = {Path(path).name: status for path, status in outcomes.items() if status != 'ok'}
+    return {
+        'checked': len(outcomes),
+        'ok': len(outcomes) - len(failed),
+        'failed': failed,
+        'unrecorded': sum(1 for entry in metadata.get('files', []) if not entry.get('sha256'))
+    }
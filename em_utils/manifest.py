@@ -0,0 +1,278 @@
+"""
+Shared work manifest for spreading one download over many processes and nodes
+Work items are split into shard files on a shared filesystem; a worker claims a
+shard by renaming it, which is atomic on POSIX filesystems and NFS, so no lock
+server or database is needed
+"""
+
+import os
+import json
+import time
+import zlib
+import socket
+import threading
+from pathlib import Path
+from datetime import datetime
+
+from em_utils.instrument import METRICS
+
+# Fields of partial metadata that add up across shards
+SUM_FIELDS = ('files_downloaded', 'total_size_mb', 'blocks_fetched', 'blocks_requested')
+
+# Per-process fields, kept per worker instead of merged
+WORKER_FIELDS = ('instrumentation', 'concurrency', 'cache')
+
+
+def worker_id() -> str:
+    """host-pid, unique among the nodes sharing a manifest."""
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def write_json(path: Path, data):
+    """Write JSON so readers on other nodes never see a partial file."""
+    tmp_path = path.with_name(f'.{path.name}.{worker_id()}.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def read_json(path: Path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def merge_metadata(partials: list) -> dict:
+    """Combine the metadata.json dicts of several shards of one dataset.
+    
+    Descriptive fields come from the first shard, counters are summed,
+    files and files_failed are concatenated and per-process fields
+    (instrumentation, concurrency, cache) are dropped.
+    """
+    merged = {k: v for k, v in partials[0].items() if k not in WORKER_FIELDS} if partials else {}
+    for field in SUM_FIELDS:
+        if field in merged:
+            merged[field] = sum(p.get(field, 0) for p in partials)
+    merged['files'] = [f for p in partials for f in p.get('files', [])]
+    merged['files_failed'] = [f for p in partials for f in p.get('files_failed', [])]
+    merged['created'] = datetime.now().isoformat()
+    return merged
+
+
+class Manifest:
+    """Work items for one dataset, split into shards under root:
+        
+        manifest.json                  dataset, parameters and shard count
+        todo/00000.json                unclaimed shards (lists of work items)
+        claimed/00000.<worker>.json    shards in progress; the mtime is a heartbeat
+        done/00000.<worker>.json       finished shards
+        results/00000.json             partial metadata of each finished shard
+    
+    A shard whose worker stops heartbeating is put back in todo by the
+    next worker that runs out of work. If the original worker was only
+    slow, the shard is downloaded twice and the later result replaces
+    the earlier one, so results never hold duplicates.
+    """
+    
+    def __init__(self, root):
+        self.root = Path(root)
+        self.info = read_json(self.root / "manifest.json")
+    
+    @classmethod
+    def create(cls, root, dataset: str, items: list, shard_size: int, params: dict = None,
+               metadata: dict = None, output_dir: str = None) -> 'Manifest':
+        """Write items in shards of shard_size.
+        
+        params are the options the workers download with; metadata is
+        added to the merged metadata.json (e.g. totals over a listing).
+        """
+        root = Path(root)
+        if (root / "manifest.json").exists():
+            raise FileExistsError(f"{root} already holds a manifest")
+        for name in ('todo', 'claimed', 'done', 'results'):
+            (root / name).mkdir(parents=True, exist_ok=True)
+        
+        shards = [items[i:i + shard_size] for i in range(0, len(items), shard_size)]
+        for n, shard in enumerate(shards):
+            write_json(root / 'todo' / f"{n:05d}.json", shard)
+        # Written last, so a manifest.json means every shard is in place
+        write_json(root / "manifest.json", {
+            'dataset': dataset,
+            'items': len(items),
+            'shards': len(shards),
+            'shard_size': shard_size,
+            'output_dir': output_dir,
+            'params': params or {},
+            'metadata': metadata or {},
+            'created': datetime.now().isoformat()
+        })
+        return cls(root)
+    
+    def _claim_path(self, shard: str, worker: str) -> Path:
+        return self.root / 'claimed' / f"{shard}.{worker}.json"
+    
+    def claim(self, worker: str):
+        """Claim an unclaimed shard and return (shard, items), or None if there are none left."""
+        todo = sorted((self.root / 'todo').glob('*.json'))
+        if not todo:
+            return None
+        # Workers start at different shards so they rarely race for the same rename
+        start = zlib.crc32(worker.encode()) % len(todo)
+        for path in todo[start:] + todo[:start]:
+            target = self._claim_path(path.stem, worker)
+            try:
+                os.rename(path, target)
+            except FileNotFoundError:
+                # Another worker renamed it first, unless an NFS retransmit reported our own rename as failed
+                if not target.exists():
+                    continue
+            os.utime(target)
+            METRICS.event('shard_claimed', shard=path.stem, worker=worker)
+            return path.stem, read_json(target)
+        return None
+    
+    def heartbeat(self, shard: str, worker: str):
+        """Mark a claimed shard as still in progress."""
+        os.utime(self._claim_path(shard, worker))
+    
+    def complete(self, shard: str, worker: str, metadata: dict, started: float):
+        """Record a shard's partial metadata and move it to done."""
+        write_json(self.root / 'results' / f"{shard}.json", {
+            'shard': shard,
+            'worker': worker,
+            'started': started,
+            'finished': time.time(),
+            'metadata': metadata
+        })
+        try:
+            os.rename(self._claim_path(shard, worker), self.root / 'done' / f"{shard}.{worker}.json")
+        except FileNotFoundError:
+            # Reclaimed as stale while we were still working; our result stands
+            pass
+        METRICS.event('shard_done', shard=shard, worker=worker, files=len(metadata.get('files', [])))
+    
+    def release(self, shard: str, worker: str):
+        """Return a claimed shard to todo (its worker is giving up on it)."""
+        try:
+            os.rename(self._claim_path(shard, worker), self.root / 'todo' / f"{shard}.json")
+        except FileNotFoundError:
+            pass
+    
+    def _server_time(self) -> float:
+        """Current time as the shared filesystem sees it, so clock skew between nodes does not matter."""
+        probe = self.root / f'.clock.{worker_id()}'
+        probe.touch()
+        now = probe.stat().st_mtime
+        probe.unlink()
+        return now
+    
+    def reclaim(self, stale_seconds: float) -> int:
+        """Put shards whose claim has not been heartbeated for stale_seconds back in todo."""
+        now = self._server_time()
+        reclaimed = 0
+        for path in (self.root / 'claimed').glob('*.json'):
+            shard = path.name.split('.', 1)[0]
+            try:
+                if now - path.stat().st_mtime < stale_seconds:
+                    continue
+                os.rename(path, self.root / 'todo' / f"{shard}.json")
+            except FileNotFoundError:
+                # Finished or reclaimed by someone else in the meantime
+                continue
+            METRICS.event('shard_reclaimed', shard=shard, claim=path.name)
+            reclaimed += 1
+        return reclaimed
+    
+    def status(self) -> dict:
+        """Shard counts, plus the age of each claim in progress."""
+        now = self._server_time()
+        claimed = {}
+        for path in (self.root / 'claimed').glob('*.json'):
+            shard, worker = path.name[:-len('.json')].split('.', 1)
+            try:
+                claimed[shard] = {'worker': worker, 'heartbeat_age_s': round(now - path.stat().st_mtime, 1)}
+            except FileNotFoundError:
+                continue
+        return {
+            'dataset': self.info['dataset'],
+            'items': self.info['items'],
+            'shards': self.info['shards'],
+            'todo': len(list((self.root / 'todo').glob('*.json'))),
+            'claimed': claimed,
+            'done': len(list((self.root / 'results').glob('*.json')))
+        }
+    
+    def merge(self) -> dict:
+        """Metadata for the whole manifest from the shards finished so far.
+        
+        status is 'complete' only when every shard is done and no file failed.
+        """
+        results = [read_json(path) for path in sorted((self.root / 'results').glob('*.json'))]
+        metadata = merge_metadata([r['metadata'] for r in results])
+        metadata.update(self.info['metadata'])
+        
+        done = {r['shard'] for r in results}
+        missing = [f"{n:05d}" for n in range(self.info['shards']) if f"{n:05d}" not in done]
+        metadata['status'] = 'complete' if not missing and not metadata['files_failed'] else 'partial'
+        
+        # Instrumentation is cumulative per process, so each worker's latest shard covers all of its shards
+        workers = {}
+        for result in sorted(results, key=lambda r: r['finished']):
+            worker = workers.setdefault(result['worker'], {'shards': []})
+            worker['shards'].append(result['shard'])
+            for field in WORKER_FIELDS:
+                if field in result['metadata']:
+                    worker[field] = result['metadata'][field]
+        
+        elapsed = max(r['finished'] for r in results) - min(r['started'] for r in results) if results else 0
+        metadata['manifest'] = {
+            'path': str(self.root),
+            'items': self.info['items'],
+            'shards': self.info['shards'],
+            'shards_missing': missing,
+            'workers': len(workers),
+            'elapsed_s': round(elapsed, 3),
+            'aggregate_mb_s': round(metadata.get('total_size_mb', 0) / elapsed, 3) if elapsed else None
+        }
+        metadata['workers'] = workers
+        return metadata
+
+
+def work(manifest: Manifest, process, worker: str = None, stale_seconds: float = 600,
+         heartbeat_seconds: float = 30) -> int:
+    """Claim and process shards until none are left; returns how many this worker finished.
+    
+    process(items) downloads one shard's items and returns its partial
+    metadata. A shard whose process call raises is released for another
+    worker and the error is re-raised.
+    """
+    worker = worker or worker_id()
+    finished = 0
+    while True:
+        claimed = manifest.claim(worker)
+        if claimed is None:
+            # Nothing unclaimed; pick up shards abandoned by dead workers before exiting
+            if manifest.reclaim(stale_seconds):
+                continue
+            return finished
+        shard, items = claimed
+        
+        stop = threading.Event()
+        
+        def beat():
+            while not stop.wait(heartbeat_seconds):
+                try:
+                    manifest.heartbeat(shard, worker)
+                except FileNotFoundError:
+                    return
+        
+        threading.Thread(target=beat, daemon=True).start()
+        started = time.time()
+        try:
+            metadata = process(items)
+        except BaseException:
+            manifest.release(shard, worker)
+            raise
+        finally:
+            stop.set()
+        manifest.complete(shard, worker, metadata, started)
+        finished += 1
@@ -0,0 +1,109 @@
+"""
+Scale selection for multiresolution volumes (zarr multiscales and precomputed mips)
+Picks the coarsest scale that still meets a requested resolution and translates
+voxel boxes between scales
+"""
+
+import math
+from urllib.parse import urlsplit
+
+import requests
+
+from em_utils.retry import POLICY, retry_call
+
+# Multiples of a nanometer for the units used in zarr multiscale metadata
+UNITS_NM = {
+    'nanometer': 1.0, 'nm': 1.0,
+    'micrometer': 1000.0, 'um': 1000.0, 'µm': 1000.0,
+    'angstrom': 0.1,
+    'millimeter': 1e6, 'mm': 1e6,
+}
+
+
+def coarsest_scale(resolutions, target_nm) -> int:
+    """Index of the coarsest resolution that is at least as fine as target_nm on every axis.
+    
+    target_nm is one value for all axes or one per axis, in the same
+    order as each resolution. If no scale is fine enough, the finest is
+    returned.
+    """
+    resolutions = [[float(r) for r in res] for res in resolutions]
+    targets = [float(t) for t in target_nm] if isinstance(target_nm, (list, tuple)) else [float(target_nm)]
+    if len(targets) == 1:
+        targets = targets * len(resolutions[0])
+    
+    volume = lambda i: math.prod(resolutions[i])
+    # A little slack for resolutions like 3.24 nm that are not exact multiples
+    candidates = [i for i, res in enumerate(resolutions) if all(r <= t * 1.001 for r, t in zip(res, targets))]
+    if not candidates:
+        return min(range(len(resolutions)), key=volume)
+    return max(candidates, key=volume)
+
+
+def _transforms(dataset: dict, ndim: int):
+    """(scale, translation) of one multiscales dataset entry, in its own units."""
+    if 'coordinateTransformations' in dataset:
+        # OME-NGFF 0.4
+        scale, translation = [1.0] * ndim, [0.0] * ndim
+        for transform in dataset['coordinateTransformations']:
+            if transform['type'] == 'scale':
+                scale = transform['scale']
+            elif transform['type'] == 'translation':
+                translation = transform['translation']
+        return scale, translation
+    # Older CellMap / N5-style "transform"
+    transform = dataset.get('transform', {})
+    return transform.get('scale', [1.0] * ndim), transform.get('translate', [0.0] * ndim)
+
+
+def read_multiscales(group_url: str, timeout=None) -> list:
+    """Scales of a zarr multiscale group from its .zattrs, finest first.
+    
+    Each scale is {'path', 'resolution_nm', 'translation_nm'} with
+    spatial axes in array order. Both OME-NGFF coordinateTransformations
+    and the older "transform" form used by OpenOrganelle are understood.
+    """
+    def fetch():
+        response = requests.get(f"{group_url}/.zattrs", timeout=timeout or POLICY.timeout)
+        response.raise_for_status()
+        return response.json()
+    attrs = retry_call(fetch, urlsplit(group_url).netloc)
+    multiscale = attrs['multiscales'][0]
+    
+    axes = multiscale.get('axes')
+    datasets = multiscale['datasets']
+    ndim = len(axes) if axes else len(_transforms(datasets[0], 3)[0])
+    if axes and isinstance(axes[0], dict):
+        spatial = [i for i, axis in enumerate(axes) if axis.get('type', 'space') == 'space']
+        units = [axes[i].get('unit', 'nanometer') for i in spatial]
+    else:
+        spatial = list(range(ndim))
+        units = None
+    
+    scales = []
+    for dataset in datasets:
+        scale, translation = _transforms(dataset, ndim)
+        dataset_units = units or dataset.get('transform', {}).get('units') or ['nm'] * ndim
+        factors = [UNITS_NM.get(unit, 1.0) for unit in dataset_units]
+        scales.append({
+            'path': dataset['path'],
+            'resolution_nm': [scale[i] * f for i, f in zip(spatial, factors)],
+            'translation_nm': [translation[i] * f for i, f in zip(spatial, factors)]
+        })
+    return sorted(scales, key=lambda s: math.prod(s['resolution_nm']))
+
+
+def rescale_box(start, stop, source: dict, target: dict):
+    """Translate the voxel box [start, stop) from one scale to another.
+    
+    Scales are dicts with resolution_nm and (optionally) translation_nm.
+    The result covers the same physical extent, rounded outward.
+    """
+    src_res, dst_res = source['resolution_nm'], target['resolution_nm']
+    src_t = source.get('translation_nm') or [0.0] * len(start)
+    dst_t = target.get('translation_nm') or [0.0] * len(start)
+    axes = list(zip(src_res, src_t, dst_res, dst_t))
+    # Physical position in the target scale's voxels; the epsilon absorbs float error at exact boundaries
+    lo = [max(0, math.floor((s * r + t - u) / d + 1e-6)) for s, (r, t, d, u) in zip(start, axes)]
+    hi = [math.ceil((s * r + t - u) / d - 1e-6) for s, (r, t, d, u) in zip(stop, axes)]
+    return lo, [max(a + 1, b) for a, b in zip(lo, hi)]
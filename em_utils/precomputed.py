@@ -0,0 +1,211 @@
+"""
+Pipelined reads of unsharded Neuroglancer precomputed volumes (raw or JPEG chunks)
+Chunks are fetched asynchronously, decoded in a process pool and written by the
+decoding process straight into the .npy memmaps of every box that overlaps them
+"""
+
+import time
+import threading
+import multiprocessing
+from urllib.parse import urlsplit
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from em_utils.async_http import AsyncChunkFetcher
+from em_utils.cache import get_cache
+from em_utils.stats import StreamingStats
+from em_utils.instrument import METRICS
+
+# Encodings decoded here; anything else (compressed_segmentation, png, jxl, ...) is left to CloudVolume
+ENCODINGS = ('raw', 'jpeg')
+
+_decoders = None
+_decoders_lock = threading.Lock()
+
+
+def chunk_layout(em_vol):
+    """Chunk grid of em_vol's mip as a dict, or None if this reader cannot handle it.
+    
+    Sharded scales, multi-channel volumes, encodings other than raw and
+    JPEG and non-HTTP sources are read through CloudVolume instead.
+    """
+    scale = em_vol.meta.scale(em_vol.mip)
+    base_url = em_vol.meta.cloudpath
+    if ('sharding' in scale or scale['encoding'] not in ENCODINGS or int(em_vol.num_channels) != 1
+            or urlsplit(base_url).scheme not in ('http', 'https')):
+        return None
+    return {
+        'url': f"{base_url.rstrip('/')}/{scale['key']}",
+        'encoding': scale['encoding'],
+        'dtype': str(np.dtype(em_vol.dtype)),
+        'chunk_size': [int(c) for c in scale['chunk_sizes'][0]],
+        'voxel_offset': [int(o) for o in scale['voxel_offset']],
+        'size': [int(s) for s in scale['size']]
+    }
+
+
+def chunk_bounds(layout: dict, index):
+    """(lo, hi) voxel corners (x, y, z) of a grid chunk, clipped to the volume."""
+    lo = [o + i * c for o, i, c in zip(layout['voxel_offset'], index, layout['chunk_size'])]
+    hi = [min(a + c, o + s) for a, c, o, s in zip(lo, layout['chunk_size'], layout['voxel_offset'], layout['size'])]
+    return lo, hi
+
+
+def chunk_url(layout: dict, index) -> str:
+    lo, hi = chunk_bounds(layout, index)
+    return f"{layout['url']}/{'_'.join(f'{a}-{b}' for a, b in zip(lo, hi))}"
+
+
+def decode_chunk(encoding: str, data: bytes, shape, dtype) -> np.ndarray:
+    """Decode one chunk into an (x, y, z) array of the given shape."""
+    x, y, z = shape
+    if encoding == 'jpeg':
+        # Installed with CloudVolume; decodes with libjpeg-turbo
+        import simplejpeg
+        # JPEG chunks are stored as one x-by-(y * z) grayscale image
+        image = simplejpeg.decode_jpeg(data, colorspace='GRAY')
+        return image.reshape(z, y, x).transpose(2, 1, 0)
+    return np.frombuffer(data, dtype=np.dtype(dtype)).reshape((x, y, z), order='F')
+
+
+def decode_into(encoding: str, data: bytes, shape, dtype, windows) -> tuple:
+    """Decode a chunk and write its overlap with each output (runs in a decoder process).
+    
+    windows are (output path, source slices, destination slices); returns
+    the decode time and the statistics of each window written.
+    """
+    started = time.perf_counter()
+    chunk = decode_chunk(encoding, data, shape, dtype)
+    seconds = time.perf_counter() - started
+    stats = []
+    for path, src, dst in windows:
+        window = chunk[src]
+        # Mapping an output is cheap next to decoding, and a file rewritten by a later run is never stale
+        np.load(path, mmap_mode='r+')[dst] = window
+        block = StreamingStats()
+        block.update(window)
+        stats.append(block)
+    return seconds, stats
+
+
+def get_decoders(workers: int) -> ProcessPoolExecutor:
+    """Return the process-wide decoder pool, so processes are started once per run rather than per batch."""
+    global _decoders
+    with _decoders_lock:
+        if _decoders is None or _decoders[0] != workers:
+            if _decoders is not None:
+                _decoders[1].shutdown()
+            # Fetcher threads are running, so decoders are spawned rather than forked
+            _decoders = (workers, ProcessPoolExecutor(max_workers=workers,
+                                                      mp_context=multiprocessing.get_context('spawn')))
+        return _decoders[1]
+
+
+def close_decoders():
+    """Stop the decoder processes started by get_decoders."""
+    global _decoders
+    with _decoders_lock:
+        decoders, _decoders = _decoders, None
+    if decoders is not None:
+        decoders[1].shutdown()
+
+
+class ChunkPipeline:
+    """Fetch, decode and assemble the chunks overlapping a set of boxes.
+    
+    Fetching runs on the event loop, decoding in `decode_workers`
+    processes; a fetched chunk waits for a decoder slot while holding its
+    connection slot, so a CPU-bound run slows the network down instead of
+    buffering every chunk in memory.
+    """
+    
+    def __init__(self, layout: dict, concurrency: int = 32, decode_workers: int = None, max_pending: int = None):
+        self.layout = layout
+        self.concurrency = concurrency
+        self.decode_workers = decode_workers or multiprocessing.cpu_count()
+        self.max_pending = max_pending or 2 * self.decode_workers
+        self.host = urlsplit(layout['url']).netloc
+    
+    def windows(self, index, boxes, members) -> list:
+        """(box, source slices, destination slices) of a chunk for each box it overlaps."""
+        lo, hi = chunk_bounds(self.layout, index)
+        windows = []
+        for m in members:
+            box_lo, box_hi = boxes[m]
+            a = [max(lo[i], box_lo[i]) for i in range(3)]
+            b = [min(hi[i], box_hi[i]) for i in range(3)]
+            if any(a[i] >= b[i] for i in range(3)):
+                continue
+            windows.append((m, tuple(slice(a[i] - lo[i], b[i] - lo[i]) for i in range(3)),
+                            tuple(slice(a[i] - box_lo[i], b[i] - box_lo[i]) for i in range(3))))
+        return windows
+    
+    def run(self, chunks: dict, boxes, paths, stats=None) -> dict:
+        """Fill the .npy files at paths (x, y, z, already created) for boxes.
+        
+        chunks maps each grid index to the boxes it overlaps. Every chunk
+        must exist; a missing one raises like CloudVolume without fill_missing.
+        """
+        urls = {index: chunk_url(self.layout, index) for index in chunks}
+        pending = threading.BoundedSemaphore(self.max_pending)
+        futures = []
+        lock = threading.Lock()
+        decoded = {'chunks': 0, 'decode_seconds': 0.0}
+        
+        def done(members, future):
+            pending.release()
+            if future.exception() is not None:
+                return
+            seconds, window_stats = future.result()
+            METRICS.observe('decode_seconds', seconds, host=self.host)
+            METRICS.count('chunks_decoded', host=self.host)
+            with lock:
+                decoded['chunks'] += 1
+                decoded['decode_seconds'] += seconds
+            if stats is not None:
+                for m, block in zip(members, window_stats):
+                    stats[m].merge(block)
+        
+        def submit(index, data):
+            if data is None:
+                raise FileNotFoundError(f"Missing chunk {urls[index]}")
+            lo, hi = chunk_bounds(self.layout, index)
+            windows = self.windows(index, boxes, chunks[index])
+            pending.acquire()
+            future = executor.submit(decode_into, self.layout['encoding'], data, [b - a for a, b in zip(lo, hi)],
+                                     self.layout['dtype'], [(str(paths[m]), src, dst) for m, src, dst in windows])
+            with lock:
+                futures.append(future)
+            future.add_done_callback(partial(done, [m for m, _, _ in windows]))
+        
+        executor = get_decoders(self.decode_workers)
+        started = time.perf_counter()
+        try:
+            # Cached chunks are revalidated with a conditional request and only transferred if changed
+            fetched = AsyncChunkFetcher(concurrency=self.concurrency).run_into(
+                [(index, urls[index]) for index in chunks], submit, cache=get_cache())
+        finally:
+            # Nothing may still be writing into the outputs when this returns, even after a failure
+            for future in list(futures):
+                future.exception()
+        for future in futures:
+            future.result()
+        elapsed = time.perf_counter() - started
+        cached = sum(1 for r in fetched if r['cached'])
+        bytes_fetched = sum(r['size_bytes'] for r in fetched if not r['cached'])
+        
+        return {
+            'chunks_total': len(chunks),
+            'chunks_fetched': len(chunks) - cached,
+            'chunks_cached': cached,
+            'bytes_fetched': bytes_fetched,
+            'decode_workers': self.decode_workers,
+            'decode_seconds': round(decoded['decode_seconds'], 3),
+            'elapsed_s': round(elapsed, 3),
+            'chunks_s': round(decoded['chunks'] / elapsed, 2) if elapsed else None,
+            # Near 1 the run is CPU-bound (add cores); well below 1 it is waiting on the network
+            'decode_utilization': round(decoded['decode_seconds'] / (elapsed * self.decode_workers), 3)
+            if elapsed else None
+        }
@@ -0,0 +1,147 @@
+"""
+Lazy, memory-mapped access to downloaded datasets by name
+"""
+
+import json
+from pathlib import Path
+
+import numpy as np
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+# Dataset name -> data directory (as written by each downloader)
+DATASETS = {
+    'epfl': 'epfl_hippocampus/epfl_data',
+    'hemibrain': 'flyem_hemibrain/hemibrain_data',
+    'empiar': 'empiar_11759/empiar_data',
+    'idr': 'idr_0086/idr_data',
+    'openorganelle': 'openorganelle_jrc/openorganelle_data',
+}
+
+
+class TiffVolume:
+    """Sliceable view of a multi-page TIFF that decodes only the pages a slice touches.
+    
+    Used for compressed or non-contiguous TIFFs that tifffile cannot memory-map.
+    """
+    
+    def __init__(self, path):
+        import tifffile
+        self._tif = tifffile.TiffFile(path)
+        series = self._tif.series[0]
+        self.pages = series.pages
+        self.shape = tuple(series.shape)
+        self.dtype = series.dtype
+        self.ndim = len(self.shape)
+    
+    def __len__(self):
+        return self.shape[0]
+    
+    def __getitem__(self, key):
+        if self.ndim == 2:
+            return self.pages[0].asarray()[key]
+        key = key if isinstance(key, tuple) else (key,)
+        first, rest = key[0], key[1:]
+        if isinstance(first, (int, np.integer)):
+            return self.pages[int(first)].asarray()[rest]
+        planes = [self.pages[i].asarray()[rest] for i in range(self.shape[0])[first]]
+        return np.stack(planes) if planes else np.empty((0,) + self.pages[0].asarray()[rest].shape, self.dtype)
+    
+    def close(self):
+        self._tif.close()
+
+
+def open_tiff(path):
+    """Memory-map an uncompressed contiguous TIFF, else fall back to per-page decoding."""
+    import tifffile
+    try:
+        return tifffile.memmap(path, mode='r')
+    except ValueError:
+        return TiffVolume(path)
+
+
+def open_array(path, zarray: dict = None):
+    """Open one downloaded file as a lazy array according to its type.
+    
+    .npy files are memory-mapped, TIFFs are memory-mapped or decoded per
+    page, OME-Zarr groups open their full-resolution level, DM3/DM4 files
+    are read lazily through hyperspy, and loose zarr chunk blobs are
+    decoded with the array's .zarray metadata.
+    """
+    path = Path(path)
+    suffix = path.suffix.lower()
+    if suffix == '.npy':
+        return np.load(path, mmap_mode='r')
+    if suffix in ('.tif', '.tiff'):
+        return open_tiff(path)
+    if path.is_dir():
+        import zarr
+        group = zarr.open(str(path), mode='r')
+        return group['0'] if hasattr(group, 'group_keys') else group
+    if suffix in ('.dm3', '.dm4'):
+        import hyperspy.api as hs
+        return hs.load(str(path), lazy=True).data
+    if suffix == '.zarr' and zarray is not None:
+        from em_utils.zarr_region import decode_chunk
+        return decode_chunk(zarray, path.read_bytes())
+    raise ValueError(f"Don't know how to open {path.name}")
+
+
+class Dataset:
+    """A downloaded dataset: its metadata.json and lazy arrays for its files."""
+    
+    def __init__(self, data_dir):
+        self.data_dir = Path(data_dir)
+        with open(self.data_dir / 'metadata.json') as f:
+            self.metadata = json.load(f)
+        self.name = self.metadata.get('dataset', self.data_dir.name)
+        self._records = {record['filename']: record for record in self.metadata.get('files', [])
+                         if not record.get('missing')}
+    
+    @property
+    def files(self) -> list:
+        return list(self._records)
+    
+    @property
+    def resolution_nm(self):
+        return self.metadata.get('resolution_nm')
+    
+    def __len__(self):
+        return len(self._records)
+    
+    def path(self, filename: str) -> Path:
+        return self.data_dir / filename
+    
+    def array(self, filename: str = None, prefer_zarr: bool = True):
+        """Lazy array for filename (default: the first file).
+        
+        When the file was also converted to OME-Zarr on ingest, the chunked
+        copy is opened instead unless prefer_zarr is False.
+        """
+        filename = filename or self.files[0]
+        record = self._records[filename]
+        converted = record.get('zarr') or {}
+        if prefer_zarr and converted.get('path') and Path(converted['path']).exists():
+            return open_array(converted['path'])
+        zarray = (self.metadata.get('arrays') or {}).get(record.get('chunk_type'))
+        return open_array(self.path(filename), zarray)
+    
+    def arrays(self, prefer_zarr: bool = True) -> dict:
+        return {filename: self.array(filename, prefer_zarr) for filename in self.files}
+
+
+def open_dataset(name, root=REPO_ROOT) -> Dataset:
+    """Open a downloaded dataset by short name ('epfl', 'hemibrain', ...) or data directory."""
+    if name in DATASETS:
+        return Dataset(Path(root) / DATASETS[name])
+    path = Path(name)
+    if (path / 'metadata.json').exists():
+        return Dataset(path)
+    # Fall back to matching the 'dataset' field of any known metadata.json
+    for data_dir in DATASETS.values():
+        metadata_path = Path(root) / data_dir / 'metadata.json'
+        if metadata_path.exists():
+            with open(metadata_path) as f:
+                if json.load(f).get('dataset', '').lower().startswith(str(name).lower()):
+                    return Dataset(metadata_path.parent)
+    raise KeyError(f"No downloaded dataset named {name!r}")
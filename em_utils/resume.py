@@ -0,0 +1,223 @@
+"""
+Resumable downloads through .part files with a journal of committed bytes
+"""
+
+import os
+import json
+import time
+import ftplib
+from pathlib import Path
+from urllib.parse import urlsplit
+
+import requests
+
+from em_utils.integrity import Digester, IntegrityError, check, etag_md5
+from em_utils.scheduler import connection_slot, throttle
+from em_utils.instrument import METRICS, first_byte
+from em_utils.retry import POLICY
+
+# Bytes written between journal checkpoints
+JOURNAL_INTERVAL = 8 * 1024 * 1024
+CHUNK_SIZE = 1024 * 1024
+
+
+class PartialFile:
+    """Target file written through `<name>.part` and committed by atomic rename.
+    
+    The journal `<name>.part.json` records the byte offset known to be on
+    disk, so an interrupted transfer resumes from there instead of zero.
+    Digests are updated in the write callback; on resume the existing
+    prefix is hashed once when the file is opened.
+    """
+    
+    def __init__(self, path, source: str = None, size: int = None, etag: str = None,
+                 journal_interval: int = JOURNAL_INTERVAL):
+        self.path = Path(path)
+        self.part_path = self.path.with_name(self.path.name + '.part')
+        self.journal_path = self.path.with_name(self.path.name + '.part.json')
+        self.source = source
+        self.size = size
+        self.etag = etag
+        self.journal_interval = journal_interval
+        self.md5 = False
+        
+        self.offset = self._recover()
+        self._journaled = self.offset
+        self._file = None
+        self.digester = None
+    
+    def _recover(self) -> int:
+        """Return the committed offset of a previous attempt, or 0."""
+        if not self.part_path.exists() or not self.journal_path.exists():
+            return 0
+        try:
+            with open(self.journal_path) as f:
+                journal = json.load(f)
+        except (OSError, ValueError):
+            return 0
+        
+        # The remote file changed since the partial transfer started
+        if journal.get('source') != self.source:
+            return 0
+        for key in ('size', 'etag'):
+            if getattr(self, key) is not None and journal.get(key) not in (None, getattr(self, key)):
+                return 0
+        self.size = self.size if self.size is not None else journal.get('size')
+        self.etag = self.etag if self.etag is not None else journal.get('etag')
+        
+        if self.size is not None and journal.get('offset', 0) > self.size:
+            return 0
+        # Bytes past the last checkpoint may not have reached the disk
+        return min(journal.get('offset', 0), self.part_path.stat().st_size)
+    
+    def __enter__(self):
+        self._file = open(self.part_path, 'r+b' if self.offset else 'wb')
+        self._file.truncate(self.offset)
+        self._file.seek(self.offset)
+        self.digester = Digester(md5=self.md5)
+        self.digester.update_from_file(self._file, self.offset)
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        if self._file is not None:
+            self.checkpoint()
+            self._file.close()
+            self._file = None
+        return False
+    
+    @property
+    def complete(self) -> bool:
+        return self.size is not None and self.offset >= self.size
+    
+    def write(self, data: bytes):
+        """Append data and checkpoint the journal every journal_interval bytes."""
+        throttle(len(data))
+        start = time.perf_counter()
+        self._file.write(data)
+        METRICS.add_phase('write', time.perf_counter() - start)
+        self.digester.update(data)
+        self.offset += len(data)
+        if self.offset - self._journaled >= self.journal_interval:
+            self.checkpoint()
+    
+    def restart(self):
+        """Discard partial data, e.g. when the server ignored the range request."""
+        self._file.seek(0)
+        self._file.truncate()
+        self.offset = 0
+        self.digester = Digester(md5=self.md5)
+        self.checkpoint()
+    
+    def checkpoint(self):
+        """Flush written bytes to disk and record the offset in the journal."""
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        journal = {'source': self.source, 'offset': self.offset, 'size': self.size, 'etag': self.etag}
+        tmp_path = self.journal_path.with_name(self.journal_path.name + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(journal, f)
+        os.replace(tmp_path, self.journal_path)
+        self._journaled = self.offset
+    
+    def commit(self) -> dict:
+        """Verify the .part file, move it into place and drop the journal."""
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._file = None
+        return finalize(self.part_path, self.path, self.journal_path, self.digester.hexdigests(),
+                        self.size, self.etag)
+
+
+def finalize(part_path: Path, path: Path, journal_path: Path, digests: dict, size: int = None,
+             etag: str = None) -> dict:
+    """Check a completed .part file and rename it into place.
+    
+    Returns the transfer record (size, digests, verification). A file that
+    fails verification is discarded so the next attempt starts clean.
+    """
+    try:
+        verified = check(part_path, digests, size, etag)
+    except IntegrityError:
+        part_path.unlink(missing_ok=True)
+        journal_path.unlink(missing_ok=True)
+        raise
+    os.replace(part_path, path)
+    journal_path.unlink(missing_ok=True)
+    return dict(size_bytes=path.stat().st_size, verified=verified, **digests)
+
+
+def http_validators(url: str, session=None, timeout=None) -> tuple:
+    """(ETag, Content-Length) from a HEAD request, for checking a cached copy; either may be None."""
+    response = (session or requests).head(url, allow_redirects=True, timeout=timeout or POLICY.timeout)
+    response.raise_for_status()
+    length = response.headers.get('Content-Length')
+    if 'Content-Encoding' in response.headers:
+        # The length of the encoded body, not of the file written
+        length = None
+    return response.headers.get('ETag'), int(length) if length is not None else None
+
+
+def http_download(url: str, path, session=None, timeout=None, chunk_size: int = CHUNK_SIZE) -> dict:
+    """Download url to path, resuming a previous partial transfer with Range.
+    
+    timeout defaults to the shared retry policy's (connect, read) timeouts.
+    Returns the transfer record from PartialFile.commit.
+    """
+    part = PartialFile(path, source=url)
+    headers = {}
+    if part.offset:
+        headers['Range'] = f'bytes={part.offset}-'
+        if part.etag:
+            headers['If-Range'] = part.etag
+    
+    with connection_slot(urlsplit(url).netloc):
+        response = (session or requests).get(url, headers=headers, stream=True, timeout=timeout or POLICY.timeout)
+        METRICS.observe('ttfb_seconds', response.elapsed.total_seconds(), host=urlsplit(url).netloc)
+        part.md5 = etag_md5(response.headers.get('ETag', part.etag)) is not None
+        with response, part:
+            if response.status_code == 416 and part.offset:
+                # Everything was already received before the interruption
+                return part.commit()
+            response.raise_for_status()
+            
+            if part.offset and response.status_code != 206:
+                part.restart()
+            part.etag = response.headers.get('ETag', part.etag)
+            length = response.headers.get('Content-Length')
+            if length is not None and response.status_code != 206:
+                part.size = int(length)
+            elif length is not None:
+                part.size = part.offset + int(length)
+            
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                if chunk:
+                    part.write(chunk)
+            return part.commit()
+
+
+def ftp_size(ftp: ftplib.FTP, remote_path: str):
+    """Return the remote file size, or None if the server does not report it."""
+    try:
+        ftp.voidcmd('TYPE I')
+        return ftp.size(remote_path)
+    except ftplib.error_perm:
+        return None
+
+
+def ftp_download(ftp: ftplib.FTP, remote_path: str, path, source: str = None,
+                 size: int = None, blocksize: int = CHUNK_SIZE) -> dict:
+    """Download remote_path over an open session, resuming with REST.
+    
+    Returns the transfer record from PartialFile.commit.
+    """
+    if size is None:
+        size = ftp_size(ftp, remote_path)
+    part = PartialFile(path, source=source or f'ftp://{ftp.host}{remote_path}', size=size)
+    
+    with part:
+        if not part.complete:
+            ftp.retrbinary(f'RETR {remote_path}', first_byte(part.write, ftp.host), blocksize,
+                           rest=part.offset or None)
+        return part.commit()
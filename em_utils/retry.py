@@ -0,0 +1,162 @@
+"""
+Retry policy with jittered exponential backoff, network timeouts and per-host circuit breakers
+"""
+
+import time
+import random
+import socket
+import ftplib
+import threading
+
+import requests
+
+from em_utils.integrity import IntegrityError
+from em_utils.instrument import METRICS
+
+# HTTP statuses worth retrying; anything else (403, 404, ...) fails immediately
+RETRY_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+
+
+class CircuitOpenError(IOError):
+    """Requests to a host are suspended after repeated failures."""
+
+
+def is_transient(exc: BaseException) -> bool:
+    """Return True if a retry may succeed (timeouts, dropped connections, 5xx, FTP 4xx)."""
+    if isinstance(exc, CircuitOpenError):
+        return False
+    if isinstance(exc, requests.HTTPError):
+        return exc.response is not None and exc.response.status_code in RETRY_STATUSES
+    status = getattr(exc, 'status', None)
+    if isinstance(status, int):
+        # aiohttp.ClientResponseError
+        return status in RETRY_STATUSES
+    if isinstance(exc, ftplib.error_perm):
+        return False
+    # A short or corrupted transfer is re-fetched (resuming where possible)
+    return isinstance(exc, (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError,
+                            ftplib.error_temp, ftplib.error_reply, ftplib.error_proto, socket.timeout,
+                            TimeoutError, ConnectionError, EOFError, IntegrityError)) or \
+        type(exc).__module__.startswith('aiohttp')
+
+
+def retry_after(exc: BaseException):
+    """Seconds requested by a Retry-After header on a 429/503 response, if any."""
+    response = getattr(exc, 'response', None)
+    headers = getattr(response, 'headers', None) or getattr(exc, 'headers', None) or {}
+    try:
+        return float(headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+
+class CircuitBreaker:
+    """Per-host breaker: after `threshold` consecutive failures a host is skipped for `cooldown`
+    seconds, then one probe is let through (half-open) before it closes again.
+    """
+    
+    def __init__(self, threshold: int = 10, cooldown: float = 30.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._failures = {}
+        self._opened = {}
+        self._probing = set()
+        self._lock = threading.Lock()
+    
+    def check(self, host: str):
+        """Raise CircuitOpenError if host is open; otherwise allow the call."""
+        with self._lock:
+            opened = self._opened.get(host)
+            if opened is None:
+                return
+            if time.monotonic() - opened < self.cooldown or host in self._probing:
+                raise CircuitOpenError(f"Circuit open for {host} after {self._failures[host]} failures")
+            self._probing.add(host)
+    
+    def success(self, host: str):
+        with self._lock:
+            self._failures.pop(host, None)
+            self._probing.discard(host)
+            if self._opened.pop(host, None) is not None:
+                METRICS.event('circuit_closed', host=host)
+    
+    def failure(self, host: str):
+        with self._lock:
+            self._failures[host] = self._failures.get(host, 0) + 1
+            self._probing.discard(host)
+            if self._failures[host] >= self.threshold:
+                if host not in self._opened:
+                    METRICS.count('circuit_opened', host=host)
+                self._opened[host] = time.monotonic()
+    
+    def state(self) -> dict:
+        with self._lock:
+            return {host: 'open' for host in self._opened}
+
+
+class RetryPolicy:
+    """Attempts, backoff and timeouts shared by every network path.
+    
+    Delays use full jitter: a uniform draw from [0, min(cap, base * 2^attempt)],
+    so workers that failed together do not retry together.
+    """
+    
+    def __init__(self, attempts: int = 5, base: float = 0.5, cap: float = 30.0, connect_timeout: float = 15.0,
+                 read_timeout: float = 60.0, breaker: CircuitBreaker = None):
+        self.attempts = attempts
+        self.base = base
+        self.cap = cap
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.breaker = breaker or CircuitBreaker()
+    
+    @property
+    def timeout(self) -> tuple:
+        """(connect, read) timeout for requests."""
+        return self.connect_timeout, self.read_timeout
+    
+    def delay(self, attempt: int, exc: BaseException = None) -> float:
+        wait = random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+        requested = retry_after(exc) if exc is not None else None
+        return max(wait, min(requested, self.cap)) if requested is not None else wait
+    
+    def call(self, fn, host: str = None):
+        """Call fn() until it succeeds, a non-transient error occurs or attempts run out."""
+        for attempt in range(self.attempts):
+            if host:
+                self.breaker.check(host)
+            try:
+                result = fn()
+            except Exception as exc:
+                if host and is_transient(exc):
+                    self.breaker.failure(host)
+                if attempt == self.attempts - 1 or not is_transient(exc):
+                    raise
+                METRICS.count('retries', host=host or '')
+                time.sleep(self.delay(attempt, exc))
+            else:
+                if host:
+                    self.breaker.success(host)
+                return result
+
+
+POLICY = RetryPolicy()
+
+
+def retry_call(fn, host: str = None):
+    """Call fn() under the shared policy."""
+    return POLICY.call(fn, host)
+
+
+def add_arguments(parser):
+    """Add the shared retry options to a downloader's argument parser."""
+    parser.add_argument('--retries', type=int, default=POLICY.attempts - 1,
+                        help='Retries per file after the first attempt')
+    parser.add_argument('--timeout', type=float, default=POLICY.read_timeout,
+                        help='Seconds without data before a transfer is abandoned and retried')
+
+
+def configure(args):
+    """Apply the options added by add_arguments."""
+    POLICY.attempts = args.retries + 1
+    POLICY.read_timeout = args.timeout
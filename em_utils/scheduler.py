@@ -0,0 +1,251 @@
+"""
+Shared scheduler: connection, per-host and bandwidth limits across all downloaders
+"""
+
+import time
+import asyncio
+import threading
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+
+
+class ConnectionLimits:
+    """Counts open connections against a global and a per-host cap."""
+    
+    def __init__(self, max_connections: int = 16, per_host: dict = None, default_per_host: int = 4):
+        self.max_connections = max_connections
+        self.per_host = dict(per_host or {})
+        self.default_per_host = default_per_host
+        self._open = {}
+        self._total = 0
+        self._cond = threading.Condition()
+    
+    def host_limit(self, host: str) -> int:
+        return min(self.per_host.get(host, self.default_per_host), self.max_connections)
+    
+    def available(self, host: str) -> bool:
+        with self._cond:
+            return self._total < self.max_connections and self._open.get(host, 0) < self.host_limit(host)
+    
+    @contextmanager
+    def slot(self, host: str):
+        """Hold one connection to host for the duration of the block."""
+        with self._cond:
+            while not (self._total < self.max_connections and self._open.get(host, 0) < self.host_limit(host)):
+                self._cond.wait()
+            self._total += 1
+            self._open[host] = self._open.get(host, 0) + 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._total -= 1
+                self._open[host] -= 1
+                self._cond.notify_all()
+
+
+class BandwidthLimiter:
+    """Token bucket shared by every transfer in the process."""
+    
+    def __init__(self, bytes_per_second: float, burst_seconds: float = 1.0):
+        self.rate = bytes_per_second
+        self.capacity = bytes_per_second * burst_seconds
+        self._tokens = self.capacity
+        self._stamp = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def reserve(self, nbytes: int) -> float:
+        """Take nbytes of budget; returns how long the caller should wait."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+            self._tokens -= nbytes
+            return max(0.0, -self._tokens / self.rate)
+
+
+class Scheduler:
+    """Runs download tasks from all datasets on one pool under shared limits.
+    
+    Ready tasks are dispatched fairly across datasets (the dataset with the
+    fewest running tasks goes first) and, within a dataset, largest first.
+    Tasks whose host has no free connection wait without holding a worker.
+    """
+    
+    def __init__(self, limits: ConnectionLimits, bandwidth: BandwidthLimiter = None, workers: int = None):
+        self.limits = limits
+        self.bandwidth = bandwidth
+        self.workers = workers or limits.max_connections
+        self._pending = []
+        self._running = {}
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._closed = False
+        self._threads = [threading.Thread(target=self._worker, daemon=True) for _ in range(self.workers)]
+        for thread in self._threads:
+            thread.start()
+    
+    def _next_task(self):
+        """Pick the best runnable task, or None if nothing can run now."""
+        best = None
+        for task in self._pending:
+            if not self.limits.available(task['host']):
+                continue
+            key = (self._running.get(task['dataset'], 0), -task['size'], task['seq'])
+            if best is None or key < best[0]:
+                best = (key, task)
+        return best[1] if best else None
+    
+    def _worker(self):
+        while True:
+            with self._cond:
+                task = self._next_task()
+                while task is None:
+                    if self._closed and not self._pending:
+                        return
+                    self._cond.wait(0.1)
+                    task = self._next_task()
+                self._pending.remove(task)
+                if not task['future'].set_running_or_notify_cancel():
+                    # Cancelled after another task of the same map failed
+                    continue
+                self._running[task['dataset']] = self._running.get(task['dataset'], 0) + 1
+            try:
+                task['future'].set_result(task['fn'](task['item']))
+            except BaseException as exc:
+                task['future'].set_exception(exc)
+            finally:
+                with self._cond:
+                    self._running[task['dataset']] -= 1
+                    self._cond.notify_all()
+    
+    def submit(self, fn, item, dataset: str, host: str, size: int = 0) -> Future:
+        future = Future()
+        with self._cond:
+            self._seq += 1
+            self._pending.append({'fn': fn, 'item': item, 'dataset': dataset, 'host': host,
+                                  'size': size or 0, 'seq': self._seq, 'future': future})
+            self._cond.notify_all()
+        return future
+    
+    def map(self, fn, items, dataset: str, host: str, sizes=None, failures: list = None) -> list:
+        """Run fn over items on the shared pool; results are returned in order.
+        
+        Each item is queued as soon as it is produced, so items may be a
+        generator that is still discovering work. See run_tasks for failures.
+        """
+        futures = {self.submit(fn, item, dataset, host, size): (index, item)
+                   for index, (item, size) in enumerate(with_sizes(items, sizes))}
+        return collect(futures, failures)
+    
+    def shutdown(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+
+_active = None
+_byte_hooks = []
+
+
+def with_sizes(items, sizes=None):
+    """Pair items with sizes given as a sequence, a callable or None."""
+    if sizes is None:
+        return ((item, 0) for item in items)
+    if callable(sizes):
+        return ((item, sizes(item)) for item in items)
+    return zip(items, sizes)
+
+
+def install(scheduler: Scheduler):
+    """Make scheduler the process-wide scheduler used by run_tasks and the transfer layers."""
+    global _active
+    _active = scheduler
+
+
+def active():
+    return _active
+
+
+def failure_record(item, exc: BaseException) -> dict:
+    return {'item': item, 'error': f'{type(exc).__name__}: {exc}'}
+
+
+def collect(futures: dict, failures: list = None) -> list:
+    """Gather {future: (index, item)} as they complete; results are returned in index order.
+    
+    Without a failures list the first error cancels what has not started
+    and is raised. With one, each failed item is appended to it as
+    {'item', 'error'} and left out of the results.
+    """
+    results = {}
+    for future in as_completed(futures):
+        index, item = futures[future]
+        try:
+            results[index] = future.result()
+        except Exception as exc:
+            if failures is None:
+                for other in futures:
+                    other.cancel()
+                raise
+            failures.append(failure_record(item, exc))
+    return [results[index] for index in sorted(results)]
+
+
+def run_tasks(fn, items, max_workers, dataset: str, host: str, sizes=None, failures: list = None) -> list:
+    """executor.map replacement that defers to the shared scheduler when one is installed.
+    
+    max_workers is a thread count or an AIMDController. items may be a
+    generator; work starts as each item is produced. sizes (a sequence or
+    a callable on items) orders work under the scheduler. Passing a
+    failures list keeps going past failed items (see collect).
+    """
+    if _active is not None:
+        return _active.map(fn, items, dataset, host, sizes, failures)
+    if hasattr(max_workers, 'map'):
+        # An adaptive controller sizes the pool itself
+        return max_workers.map(fn, items, failures)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(fn, item): (index, item) for index, item in enumerate(items)}
+        return collect(futures, failures)
+
+
+def add_byte_hook(hook):
+    """Call hook(nbytes) for every block received by the transfer layers."""
+    _byte_hooks.append(hook)
+
+
+def remove_byte_hook(hook):
+    _byte_hooks.remove(hook)
+
+
+def connection_slot(host: str):
+    """Context manager holding a connection slot for host (no-op without a scheduler)."""
+    return _active.limits.slot(host) if _active is not None else nullcontext()
+
+
+def host_limit(host: str, default: int) -> int:
+    """Connections allowed to host, or default without a scheduler."""
+    return _active.limits.host_limit(host) if _active is not None else default
+
+
+def throttle(nbytes: int):
+    """Block until nbytes fit in the shared bandwidth budget."""
+    for hook in _byte_hooks:
+        hook(nbytes)
+    if _active is not None and _active.bandwidth is not None:
+        delay = _active.bandwidth.reserve(nbytes)
+        if delay:
+            time.sleep(delay)
+
+
+async def async_throttle(nbytes: int):
+    """Asynchronous variant of throttle."""
+    for hook in _byte_hooks:
+        hook(nbytes)
+    if _active is not None and _active.bandwidth is not None:
+        delay = _active.bandwidth.reserve(nbytes)
+        if delay:
+            await asyncio.sleep(delay)
@@ -0,0 +1,355 @@
+"""
+Segmented parallel download of single large files over HTTP ranges and FTP REST
+"""
+
+import os
+import json
+import math
+import time
+import ftplib
+import threading
+from pathlib import Path
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from em_utils.resume import CHUNK_SIZE, JOURNAL_INTERVAL, ftp_size, http_download, ftp_download, finalize
+from em_utils.integrity import HASH_BLOCK, Digester, etag_md5
+from em_utils.scheduler import connection_slot, throttle
+from em_utils.instrument import METRICS
+from em_utils.retry import POLICY
+
+MIN_SEGMENT_SIZE = 16 * 1024 * 1024
+MAX_SEGMENTS = 8
+# A segment should take about this long at the observed per-stream rate
+TARGET_SEGMENT_SECONDS = 20
+
+
+class SegmentPlanner:
+    """Choose a segment count from file size and observed per-stream throughput."""
+    
+    def __init__(self, min_segment_size: int = MIN_SEGMENT_SIZE, max_segments: int = MAX_SEGMENTS,
+                 target_seconds: float = TARGET_SEGMENT_SECONDS, default_segments: int = 4):
+        self.min_segment_size = min_segment_size
+        self.max_segments = max_segments
+        self.target_seconds = target_seconds
+        self.default_segments = default_segments
+        self._rates = {}  # host -> smoothed bytes/s of a single stream
+        self._lock = threading.Lock()
+    
+    def record(self, host: str, nbytes: int, seconds: float):
+        """Fold one stream's throughput into the running estimate for host."""
+        if seconds <= 0 or nbytes <= 0:
+            return
+        rate = nbytes / seconds
+        with self._lock:
+            previous = self._rates.get(host)
+            self._rates[host] = rate if previous is None else 0.7 * previous + 0.3 * rate
+    
+    def rate(self, host: str):
+        with self._lock:
+            return self._rates.get(host)
+    
+    def segments(self, host: str, size: int) -> int:
+        """Number of segments to split a file of size bytes into."""
+        limit = min(self.max_segments, size // self.min_segment_size)
+        if limit <= 1:
+            return 1
+        rate = self.rate(host)
+        if rate is None:
+            return min(limit, self.default_segments)
+        # Slow streams get more segments, fast ones need fewer
+        return max(1, min(limit, math.ceil(size / (rate * self.target_seconds))))
+
+
+PLANNER = SegmentPlanner()
+
+
+class Segment:
+    """Byte range [start, end) of a file, of which [start, pos) is on disk."""
+    
+    __slots__ = ('start', 'end', 'pos')
+    
+    def __init__(self, start: int, end: int, pos: int = None):
+        self.start = start
+        self.end = end
+        self.pos = start if pos is None else pos
+    
+    @property
+    def done(self) -> bool:
+        return self.pos >= self.end
+
+
+class SegmentedFile:
+    """Preallocated `<name>.part` file filled concurrently with os.pwrite.
+    
+    The journal shares its location and `offset` field with PartialFile, so
+    single-stream and segmented transfers can resume each other's progress.
+    Digests are computed over the contiguous written prefix as it grows,
+    reading back bytes that were just written (still in the page cache).
+    """
+    
+    def __init__(self, path, source: str, size: int, num_segments: int, etag: str = None,
+                 journal_interval: int = JOURNAL_INTERVAL):
+        self.path = Path(path)
+        self.part_path = self.path.with_name(self.path.name + '.part')
+        self.journal_path = self.path.with_name(self.path.name + '.part.json')
+        self.source = source
+        self.size = size
+        self.etag = etag
+        self.journal_interval = journal_interval
+        
+        self.segments = self._recover(num_segments) or self._plan(0, num_segments)
+        self._lock = threading.Lock()
+        self._unjournaled = 0
+        self._fd = None
+        
+        self.digester = Digester(md5=etag_md5(etag) is not None)
+        self._hashed = 0
+        self._hash_lock = threading.Lock()
+    
+    def _plan(self, offset: int, num_segments: int) -> list:
+        """Split [offset, size) into num_segments ranges."""
+        step = math.ceil((self.size - offset) / max(1, num_segments))
+        segments = [Segment(0, offset, offset)] if offset else []
+        for start in range(offset, self.size, step):
+            segments.append(Segment(start, min(start + step, self.size)))
+        return segments
+    
+    def _recover(self, num_segments: int) -> list:
+        """Return segments left by a previous attempt, or None."""
+        if not self.part_path.exists() or not self.journal_path.exists():
+            return None
+        try:
+            with open(self.journal_path) as f:
+                journal = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if journal.get('source') != self.source or journal.get('size') != self.size:
+            return None
+        if self.etag and journal.get('etag') not in (None, self.etag):
+            return None
+        
+        if 'segments' in journal:
+            return [Segment(*seg) for seg in journal['segments']]
+        # Progress from a single-stream transfer becomes a finished first segment
+        offset = min(journal.get('offset', 0), self.part_path.stat().st_size)
+        return self._plan(offset, num_segments) if offset else None
+    
+    def pending(self) -> list:
+        return [seg for seg in self.segments if not seg.done]
+    
+    def __enter__(self):
+        self._fd = os.open(self.part_path, os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(self._fd).st_size != self.size:
+            os.ftruncate(self._fd, self.size)
+            if hasattr(os, 'posix_fallocate'):
+                try:
+                    os.posix_fallocate(self._fd, 0, self.size)
+                except OSError:
+                    pass
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        if self._fd is not None:
+            self.checkpoint()
+            os.close(self._fd)
+            self._fd = None
+        return False
+    
+    def write(self, seg: Segment, data: bytes):
+        """Write data at the current position of seg."""
+        throttle(len(data))
+        start = time.perf_counter()
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(self._fd, view, seg.pos)
+            seg.pos += written
+            view = view[written:]
+        METRICS.add_phase('write', time.perf_counter() - start)
+        with self._lock:
+            self._unjournaled += len(data)
+            due = self._unjournaled >= self.journal_interval
+        if due:
+            self.checkpoint()
+        self._hash_prefix(block=False)
+    
+    def _contiguous(self) -> int:
+        """Length of the prefix of the file that has been written."""
+        for seg in self.segments:
+            if not seg.done:
+                return seg.pos
+        return self.size
+    
+    def _hash_prefix(self, block: bool):
+        """Feed newly contiguous bytes to the digester.
+        
+        Only one thread hashes at a time; others skip unless block is set.
+        """
+        if not self._hash_lock.acquire(blocking=block):
+            return
+        try:
+            while self._hashed < self._contiguous():
+                data = os.pread(self._fd, min(HASH_BLOCK, self._contiguous() - self._hashed), self._hashed)
+                self.digester.update(data)
+                self._hashed += len(data)
+        finally:
+            self._hash_lock.release()
+    
+    def checkpoint(self):
+        """Flush to disk and record every segment's position in the journal."""
+        with self._lock:
+            # Snapshot positions first so the journal never runs ahead of the fsync
+            segments = [[seg.start, seg.end, seg.pos] for seg in self.segments]
+            offset = next((pos for _, end, pos in segments if pos < end), self.size)
+            os.fsync(self._fd)
+            journal = {
+                'source': self.source,
+                'offset': offset,
+                'size': self.size,
+                'etag': self.etag,
+                'segments': segments
+            }
+            tmp_path = self.journal_path.with_name(self.journal_path.name + '.tmp')
+            with open(tmp_path, 'w') as f:
+                json.dump(journal, f)
+            os.replace(tmp_path, self.journal_path)
+            self._unjournaled = 0
+    
+    def commit(self) -> dict:
+        """Verify the completed file, move it into place and drop the journal."""
+        self._hash_prefix(block=True)
+        os.fsync(self._fd)
+        os.close(self._fd)
+        self._fd = None
+        return finalize(self.part_path, self.path, self.journal_path, self.digester.hexdigests(),
+                        self.size, self.etag)
+
+
+def _run_segments(part: SegmentedFile, fetch, host: str, planner: SegmentPlanner):
+    """Fetch all pending segments concurrently and record their throughput."""
+    def timed(seg):
+        start_pos, started = seg.pos, time.monotonic()
+        fetch(seg)
+        planner.record(host, seg.pos - start_pos, time.monotonic() - started)
+    
+    pending = part.pending()
+    if not pending:
+        return
+    with ThreadPoolExecutor(max_workers=len(pending)) as executor:
+        for future in [executor.submit(timed, seg) for seg in pending]:
+            future.result()
+
+
+def content_range(header: str) -> tuple:
+    """(first, last) byte positions of a 'bytes first-last/size' Content-Range header."""
+    try:
+        unit, spec = header.split(' ', 1)
+        first, last = spec.split('/', 1)[0].split('-')
+        if unit != 'bytes':
+            raise ValueError(unit)
+        return int(first), int(last)
+    except (AttributeError, ValueError):
+        raise IOError(f"Unusable Content-Range {header!r} on a 206 response") from None
+
+
+_sessions = threading.local()
+
+
+def _session() -> requests.Session:
+    """Per-thread requests session so segment workers keep their connections."""
+    if not hasattr(_sessions, 'session'):
+        _sessions.session = requests.Session()
+    return _sessions.session
+
+
+def http_segmented_download(url: str, path, planner: SegmentPlanner = PLANNER, timeout=None,
+                            chunk_size: int = CHUNK_SIZE) -> dict:
+    """Download url to path in parallel byte ranges, falling back to one stream.
+    
+    Returns the transfer record (size, digests, verification).
+    """
+    host = urlsplit(url).netloc
+    timeout = timeout or POLICY.timeout
+    head = _session().head(url, allow_redirects=True, timeout=timeout)
+    METRICS.observe('ttfb_seconds', head.elapsed.total_seconds(), host=host)
+    size = int(head.headers.get('Content-Length', 0))
+    num_segments = planner.segments(host, size) if head.ok else 1
+    if num_segments <= 1 or head.headers.get('Accept-Ranges', '').lower() != 'bytes':
+        return http_download(head.url, path, session=_session(), timeout=timeout, chunk_size=chunk_size)
+    
+    def fetch_range(seg):
+        """One range request from seg.pos; the server may return less than the rest of the segment."""
+        headers = {'Range': f'bytes={seg.pos}-{seg.end - 1}'}
+        if part.etag:
+            headers['If-Range'] = part.etag
+        with connection_slot(host), \
+                _session().get(head.url, headers=headers, stream=True, timeout=timeout) as response:
+            METRICS.observe('ttfb_seconds', response.elapsed.total_seconds(), host=host)
+            response.raise_for_status()
+            if response.status_code != 206:
+                raise IOError(f"Server ignored range request for {url}")
+            first, last = content_range(response.headers.get('Content-Range'))
+            if first != seg.pos or last < first:
+                raise IOError(f"Server returned bytes {first}-{last} of {url} for a request from {seg.pos}")
+            stop = min(last + 1, seg.end)
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                if chunk:
+                    part.write(seg, chunk[:stop - seg.pos])
+                if seg.pos >= stop:
+                    break
+            if seg.pos < stop:
+                raise EOFError(f"Range {first}-{last} of {url} ended early at {seg.pos}")
+    
+    def fetch(seg):
+        # A shorter Content-Range than requested is legal; ask again for the rest
+        while not seg.done:
+            fetch_range(seg)
+    
+    part = SegmentedFile(path, url, size, num_segments, etag=head.headers.get('ETag'))
+    with part:
+        _run_segments(part, fetch, host, planner)
+        return part.commit()
+
+
+def _ftp_segment(ftp: ftplib.FTP, remote_path: str, part: SegmentedFile, seg: Segment, blocksize: int):
+    """Retrieve one segment with REST, stopping the transfer at its end."""
+    ftp.voidcmd('TYPE I')
+    started = time.perf_counter()
+    with ftp.transfercmd(f'RETR {remote_path}', rest=seg.pos or None) as conn:
+        while not seg.done:
+            data = conn.recv(min(blocksize, seg.end - seg.pos))
+            if not data:
+                break
+            if started is not None:
+                METRICS.observe('ttfb_seconds', time.perf_counter() - started, host=ftp.host)
+                started = None
+            part.write(seg, data)
+    try:
+        ftp.voidresp()
+    except (ftplib.error_temp, ftplib.error_perm):
+        # 426/451 after closing the data connection before the end of the file
+        if not seg.done:
+            raise
+    if not seg.done:
+        raise EOFError(f"Transfer of {remote_path} ended early")
+
+
+def ftp_segmented_download(pool, remote_path: str, path, source: str = None, cwd: str = None,
+                           planner: SegmentPlanner = PLANNER, blocksize: int = CHUNK_SIZE) -> dict:
+    """Download remote_path in parallel REST segments over pooled sessions.
+    
+    Returns the transfer record (size, digests, verification).
+    """
+    source = source or f'ftp://{pool.host}{remote_path}'
+    size = pool.run(lambda ftp: ftp_size(ftp, remote_path), cwd)
+    num_segments = planner.segments(pool.host, size) if size else 1
+    if num_segments <= 1:
+        return pool.run(lambda ftp: ftp_download(ftp, remote_path, path, source, size, blocksize), cwd)
+    
+    part = SegmentedFile(path, source, size, num_segments)
+    with part:
+        _run_segments(part, lambda seg: pool.run(
+            lambda ftp: _ftp_segment(ftp, remote_path, part, seg, blocksize), cwd), pool.host, planner)
+        return part.commit()
@@ -0,0 +1,111 @@
+"""
+Single-pass, mergeable intensity statistics for volumes written block by block
+"""
+
+import threading
+
+import numpy as np
+
+# Elements per bincount call; bounds the temporary intp copy numpy makes
+BINCOUNT_STEP = 1 << 20
+
+
+class StreamingStats:
+    """Running min, max, mean, variance and (for uint8) a 256-bin histogram.
+    
+    Partial results from separate blocks are combined with the parallel
+    variance formula (Chan et al.), so blocks can arrive in any order and
+    from any thread.
+    """
+    
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+        self.histogram = None
+        self._lock = threading.Lock()
+    
+    def __getstate__(self):
+        # Partial statistics are returned from worker processes; the lock is not picklable
+        state = dict(self.__dict__)
+        del state['_lock']
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def _block(values: np.ndarray):
+        """(count, min, max, mean, m2, histogram) of one block."""
+        n = values.size
+        if values.dtype == np.uint8:
+            hist = np.zeros(256, dtype=np.int64)
+            for i in range(0, n, BINCOUNT_STEP):
+                hist += np.bincount(values[i:i + BINCOUNT_STEP], minlength=256)
+            present = np.flatnonzero(hist)
+            levels = np.arange(256, dtype=np.float64)
+            mean = float(hist @ levels) / n
+            m2 = float(hist @ (levels - mean) ** 2)
+            return n, int(present[0]), int(present[-1]), mean, m2, hist
+        mean = float(values.mean(dtype=np.float64))
+        m2 = float(values.var(dtype=np.float64)) * n
+        return n, values.min().item(), values.max().item(), mean, m2, None
+    
+    def _merge(self, n, vmin, vmax, mean, m2, hist):
+        with self._lock:
+            total = self.count + n
+            delta = mean - self.mean
+            self.m2 += m2 + delta * delta * self.count * n / total
+            self.mean += delta * n / total
+            self.count = total
+            self.min = vmin if self.min is None else min(self.min, vmin)
+            self.max = vmax if self.max is None else max(self.max, vmax)
+            if hist is not None:
+                self.histogram = hist.copy() if self.histogram is None else self.histogram + hist
+    
+    def update(self, block):
+        """Fold one block (any shape) into the running statistics."""
+        values = np.asarray(block).ravel()
+        if values.size:
+            self._merge(*self._block(values))
+    
+    def update_constant(self, value, count: int, dtype=np.uint8):
+        """Fold in count voxels of a single value (e.g. missing zarr chunks)."""
+        if count <= 0:
+            return
+        hist = None
+        if np.dtype(dtype) == np.uint8:
+            hist = np.zeros(256, dtype=np.int64)
+            hist[int(value)] = count
+        self._merge(count, value, value, float(value), 0.0, hist)
+    
+    def merge(self, other: 'StreamingStats'):
+        """Combine the statistics of another instance into this one."""
+        if other.count:
+            self._merge(other.count, other.min, other.max, other.mean, other.m2, other.histogram)
+    
+    def to_dict(self) -> dict:
+        stats = {
+            'min': self.min,
+            'max': self.max,
+            'mean': self.mean,
+            'std': (self.m2 / self.count) ** 0.5 if self.count else 0.0,
+            'count': self.count
+        }
+        if self.histogram is not None:
+            stats['histogram'] = self.histogram.tolist()
+        return stats
+
+
+def tiff_stats(path) -> dict:
+    """Statistics of a (multi-page) TIFF, decoding one page at a time."""
+    import tifffile
+    
+    stats = StreamingStats()
+    with tifffile.TiffFile(path) as tif:
+        for page in tif.pages:
+            stats.update(page.asarray())
+    return stats.to_dict()
@@ -0,0 +1,124 @@
+"""
+Download the zarr v2 chunks intersecting a bounding box into one memory-mapped array
+"""
+
+import itertools
+import threading
+from pathlib import Path
+from urllib.parse import urlsplit
+
+import numpy as np
+import requests
+from numcodecs import get_codec
+
+from em_utils.async_http import AsyncChunkFetcher
+from em_utils.cache import get_cache
+from em_utils.stats import StreamingStats
+from em_utils.retry import POLICY, retry_call
+
+
+def read_zarray(array_url: str, timeout=None) -> dict:
+    """Fetch the .zarray metadata of a zarr v2 array."""
+    def fetch():
+        response = requests.get(f"{array_url}/.zarray", timeout=timeout or POLICY.timeout)
+        response.raise_for_status()
+        return response.json()
+    return retry_call(fetch, urlsplit(array_url).netloc)
+
+
+def intersecting_chunks(meta: dict, start, stop) -> list:
+    """Chunk grid indices that overlap the box [start, stop)."""
+    ranges = [range(lo // c, (hi - 1) // c + 1) for lo, hi, c in zip(start, stop, meta['chunks'])]
+    return list(itertools.product(*ranges))
+
+
+def chunk_url(array_url: str, meta: dict, index) -> str:
+    separator = meta.get('dimension_separator', '.')
+    return f"{array_url}/{separator.join(str(i) for i in index)}"
+
+
+def decode_chunk(meta: dict, data: bytes) -> np.ndarray:
+    """Decompress and unfilter one chunk into an array of the chunk shape."""
+    if meta.get('compressor'):
+        data = get_codec(meta['compressor']).decode(data)
+    for config in reversed(meta.get('filters') or []):
+        data = get_codec(config).decode(data)
+    chunk = np.frombuffer(data, dtype=np.dtype(meta['dtype']))
+    return chunk.reshape(meta['chunks'], order=meta.get('order', 'C'))
+
+
+class RegionAssembler:
+    """Writes decoded chunks into the matching window of an output array."""
+    
+    def __init__(self, meta: dict, start, stop, out):
+        self.meta = meta
+        self.start = list(start)
+        self.stop = list(stop)
+        self.out = out
+        self.chunks_written = 0
+        self.chunks_missing = 0
+        self.stats = StreamingStats()
+        self._lock = threading.Lock()
+    
+    def window(self, index):
+        """(source slices in the chunk, destination slices in the output)."""
+        src, dst = [], []
+        for i, c, lo, hi in zip(index, self.meta['chunks'], self.start, self.stop):
+            chunk_lo = i * c
+            a, b = max(lo, chunk_lo), min(hi, chunk_lo + c)
+            src.append(slice(a - chunk_lo, b - chunk_lo))
+            dst.append(slice(a - lo, b - lo))
+        return tuple(src), tuple(dst)
+    
+    def write(self, index, data):
+        """Decode one chunk (None for a missing chunk) and write its overlap."""
+        src, dst = self.window(index)
+        if data is None:
+            # The output was pre-filled with the array's fill value
+            size = int(np.prod([s.stop - s.start for s in dst]))
+            self.stats.update_constant(self.meta.get('fill_value') or 0, size, self.meta['dtype'])
+            with self._lock:
+                self.chunks_missing += 1
+            return
+        window = decode_chunk(self.meta, data)[src]
+        self.out[dst] = window
+        self.stats.update(window)
+        with self._lock:
+            self.chunks_written += 1
+
+
+def download_region(array_url: str, start, stop, out_path, concurrency: int = 64, meta: dict = None) -> dict:
+    """Fetch every chunk overlapping [start, stop) and stitch them into an .npy memmap.
+    
+    Only about `concurrency` chunks are held in memory at a time.
+    """
+    meta = meta or read_zarray(array_url)
+    shape = meta['shape']
+    if len(start) != len(shape) or any(lo < 0 or hi > n or lo >= hi for lo, hi, n in zip(start, stop, shape)):
+        raise ValueError(f"Bounding box {list(start)}-{list(stop)} is outside array shape {shape}")
+    
+    out_shape = tuple(hi - lo for lo, hi in zip(start, stop))
+    out = np.lib.format.open_memmap(Path(out_path), mode='w+', dtype=np.dtype(meta['dtype']), shape=out_shape)
+    if meta.get('fill_value'):
+        out[...] = meta['fill_value']
+    assembler = RegionAssembler(meta, start, stop, out)
+    
+    indices = intersecting_chunks(meta, start, stop)
+    urls = {index: chunk_url(array_url, meta, index) for index in indices}
+    
+    # Cached chunks are revalidated with a conditional request and only transferred if changed
+    fetched = AsyncChunkFetcher(concurrency=concurrency).run_into(
+        [(index, urls[index]) for index in indices], assembler.write, cache=get_cache())
+    out.flush()
+    cached = sum(1 for r in fetched if r['cached'])
+    
+    return {
+        'shape': list(out_shape),
+        'dtype': str(out.dtype),
+        'chunks_total': len(indices),
+        'chunks_fetched': len(indices) - cached,
+        'chunks_cached': cached,
+        'chunks_missing': assembler.chunks_missing,
+        'bytes_fetched': sum(r['size_bytes'] for r in fetched if not r['cached']),
+        'stats': assembler.stats.to_dict()
+    }
@@ -3,64 +3,104 @@
 EMPIAR-11759 Data Downloader
 """
 
+import sys
 import json
 import argparse
-import ftplib
 from pathlib import Path
 from datetime import datetime
-from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from em_utils.ftp_pool import get_pool
+from em_utils.ftp_index import FTPIndex
+from em_utils.segmented import PLANNER, ftp_segmented_download
+from em_utils.cache import get_cache, disable_cache, cached_download
+from em_utils.integrity import digest_fields, verify_files
+from em_utils.convert import Converter
+from em_utils.scheduler import run_tasks
+from em_utils.adaptive import AIMDController, threads_arg, concurrency_report
+from em_utils import instrument
+from em_utils.instrument import METRICS
+from em_utils import retry
+from em_utils.retry import retry_call
 
 class EMPIARDownloader:
     """FTP downloader for EMPIAR-11759 dataset."""
     
-    def __init__(self):
+    def __init__(self, max_sessions: int = 4, index: FTPIndex = None, convert: bool = False,
+                 convert_workers: int = None):
         # Create data directory relative to this script
         self.download_dir = Path(__file__).parent / "empiar_data"
         self.download_dir.mkdir(exist_ok=True)
         self.ftp_host = "ftp.ebi.ac.uk"
         self.ftp_path = "/empiar/world_availability/11759/data"
-    
-    def get_dm3_files(self) -> list:
-        """Get list of DM3 files from FTP server."""
-        ftp = ftplib.FTP(self.ftp_host)
-        ftp.login()
-        ftp.cwd(self.ftp_path)
         
-        files = []
-        file_list = ftp.nlst()
-        for filename in file_list:
-            if filename.endswith('.dm3'):
-                files.append(filename)
+        # Logged-in sessions are shared across worker threads
+        self.pool = get_pool(self.ftp_host, max_sessions=max_sessions)
+        # Listings (with sizes) persist between runs
+        self.index = index or FTPIndex()
+        self.failures = []
         
-        ftp.quit()
-        return sorted(files)
+        # Completed DM3s are converted to OME-Zarr while other files download
+        self.converter = Converter(self.download_dir / "zarr", [8, 8, 50], convert_workers) if convert else None
     
-    def download_file(self, filename: str) -> dict:
-        """Download a single DM3 file."""
-        local_path = self.download_dir / filename
-        
-        ftp = ftplib.FTP(self.ftp_host)
-        ftp.login()
-        ftp.cwd(self.ftp_path)
+    def get_dm3_files(self, refresh: bool = False, offline: bool = False, max_size: int = None) -> list:
+        """Get DM3 files (name, size, modify) sorted by name from the listing index.
         
-        with open(local_path, 'wb') as f:
-            ftp.retrbinary(f'RETR {filename}', f.write)
+        The index is brought up to date first unless offline is set; refresh
+        forces a full re-listing.
+        """
+        if not offline:
+            retry_call(lambda: self.index.refresh(self.pool, self.ftp_path, force=refresh), self.pool.host)
+        return self.index.files(FTPIndex.host_key(self.pool), self.ftp_path, suffix='.dm3', max_size=max_size)
+    
+    def download_file(self, filename: str, size: int = None) -> dict:
+        """Download a single DM3 file; size from the listing invalidates a stale cached copy."""
+        local_path = self.download_dir / filename
         
-        ftp.quit()
+        source = f'ftp://{self.ftp_host}{self.ftp_path}/{filename}'
+        with METRICS.track_file('empiar', filename) as track:
+            # A retry resumes from the journaled .part file
+            transfer = retry_call(lambda: cached_download(source, local_path, lambda: ftp_segmented_download(
+                self.pool, filename, local_path, source, cwd=self.ftp_path), size=size), self.pool.host)
+            track.update(bytes=local_path.stat().st_size, cached=transfer['cached'])
         
+        if self.converter is not None:
+            self.converter.submit(local_path)
         return {
             'filename': filename,
+            'cached': transfer['cached'],
+            'seconds': track['seconds'],
             'size_bytes': local_path.stat().st_size,
-            'size_mb': local_path.stat().st_size / (1024 * 1024)
+            'size_mb': local_path.stat().st_size / (1024 * 1024),
+            **digest_fields(transfer)
         }
     
-    def download(self, num_files: int = 16, max_workers: int = 4) -> int:
-        """Download specified number of DM3 files in parallel."""
-        dm3_files = self.get_dm3_files()
-        files_to_download = dm3_files[:num_files]
-        
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            results = list(executor.map(self.download_file, files_to_download))
+    @staticmethod
+    def listing_fields(dm3_files) -> dict:
+        """Totals over the whole listing, for metadata.json."""
+        return {
+            'total_available_files': len(dm3_files),
+            'total_available_mb': sum(f['size'] or 0 for f in dm3_files) / (1024 * 1024)
+        }
+    
+    def download_items(self, items, max_workers=4, listing: dict = None) -> dict:
+        """Download (name, size) items in parallel and return their metadata without writing it."""
+        # Largest first, so the longest transfer does not start last
+        by_size = sorted(items, key=lambda item: item[1] or 0, reverse=True)
+        if max_workers == 'auto':
+            max_workers = AIMDController()
+        # Files that still fail after retries are recorded; the rest are kept
+        failures = []
+        sizes = dict(by_size)
+        results = run_tasks(lambda name: self.download_file(name, sizes[name]), [name for name, _ in by_size],
+                            max_workers, 'empiar', self.ftp_host, [size or 0 for _, size in by_size], failures)
+        self.failures = sorted(({'filename': f['item'], 'error': f['error']} for f in failures),
+                               key=lambda f: f['filename'])
+        results.sort(key=lambda r: r['filename'])
+        if self.converter is not None:
+            conversions = self.converter.results()
+            for result in results:
+                result['zarr'] = conversions.get(result['filename'])
         
         # Create metadata
         metadata = {
@@ -70,28 +110,74 @@ class EMPIARDownloader:
             'sample': 'Zebrafish retina (55 hours post fertilization)',
             'resolution_nm': [8, 8, 50],
             'format': 'DM3 (Digital Micrograph)',
-            'total_available_files': len(dm3_files),
+            **(listing or {}),
+            'status': 'partial' if self.failures else 'complete',
             'files_downloaded': len(results),
             'total_size_mb': sum(r['size_mb'] for r in results),
             'files': results,
+            'files_failed': self.failures,
+            'concurrency': concurrency_report(max_workers),
+            'instrumentation': METRICS.summary('empiar'),
             'created': datetime.now().isoformat()
         }
+        if get_cache() is not None:
+            metadata['cache'] = get_cache().stats()
+        return metadata
+    
+    def download(self, num_files: int = 16, max_workers=4, refresh: bool = False, offline: bool = False,
+                 max_size: int = None) -> int:
+        """Download specified number of DM3 files in parallel."""
+        dm3_files = self.get_dm3_files(refresh, offline, max_size)
+        items = [(f['name'], f['size']) for f in dm3_files[:num_files]]
+        metadata = self.download_items(items, max_workers, self.listing_fields(dm3_files))
         
         with open(self.download_dir / "metadata.json", 'w') as f:
             json.dump(metadata, f, indent=2)
         
-        return len(results)
+        return metadata['files_downloaded']
 
 def main():
     """Download EMPIAR-11759 DM3 files."""
     parser = argparse.ArgumentParser(description="Download DM3 files from EMPIAR-11759")
     parser.add_argument('--files', '-f', type=int, default=16)
-    parser.add_argument('--threads', '-t', type=int, default=4)
+    parser.add_argument('--threads', '-t', type=threads_arg, default=4, help="Parallel download threads, or 'auto'")
+    parser.add_argument('--max-sessions', type=int, default=4, help='Maximum open FTP sessions')
+    parser.add_argument('--max-segments', type=int, default=PLANNER.max_segments, help='Parallel REST segments per large file')
+    parser.add_argument('--no-cache', action='store_true', help='Bypass the local download cache')
+    parser.add_argument('--verify', action='store_true', help='Re-check downloaded files against metadata.json')
+    parser.add_argument('--refresh-listing', action='store_true', help='Re-list the FTP directory even if the index is fresh')
+    parser.add_argument('--offline', action='store_true', help='Use the listing index without contacting the server')
+    parser.add_argument('--max-size-gb', type=float, help='Skip files larger than this')
+    parser.add_argument('--list', action='store_true', help='Print the selected files from the index and exit')
+    parser.add_argument('--convert', action='store_true', help='Also write each file as a chunked OME-Zarr pyramid')
+    parser.add_argument('--convert-workers', type=int, help='Conversion processes (default: CPU count)')
+    instrument.add_arguments(parser)
+    retry.add_arguments(parser)
     
     args = parser.parse_args()
+    instrument.configure(args)
+    retry.configure(args)
+    PLANNER.max_segments = args.max_segments
+    if args.no_cache:
+        disable_cache()
     
-    downloader = EMPIARDownloader()
-    downloader.download(args.files, args.threads)
+    downloader = EMPIARDownloader(args.max_sessions, convert=args.convert, convert_workers=args.convert_workers)
+    if args.verify:
+        summary = verify_files(downloader.download_dir)
+        print(json.dumps(summary, indent=2))
+        sys.exit(1 if summary['failed'] else 0)
+    max_size = int(args.max_size_gb * 1024 ** 3) if args.max_size_gb else None
+    if args.list:
+        for entry in downloader.get_dm3_files(args.refresh_listing, args.offline, max_size)[:args.files]:
+            print(f"{entry['name']}\t{entry['size']}\t{entry['modify']}")
+    else:
+        downloader.download(args.files, args.threads, args.refresh_listing, args.offline, max_size)
+    downloader.pool.close()
+    if downloader.converter is not None:
+        downloader.converter.close()
+    if downloader.failures:
+        print(f"{len(downloader.failures)} files failed; see metadata.json")
+        sys.exit(1)
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
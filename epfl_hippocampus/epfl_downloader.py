@@ -3,21 +3,40 @@
 EPFL Hippocampus Data Downloader
 """
 
+import sys
 import json
 import argparse
-import requests
 from pathlib import Path
 from datetime import datetime
-from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from em_utils.segmented import PLANNER, http_segmented_download
+from em_utils.resume import http_validators
+from em_utils.cache import get_cache, disable_cache, cached_download
+from em_utils.stats import tiff_stats
+from em_utils.convert import Converter
+from em_utils.integrity import digest_fields, verify_files
+from em_utils.scheduler import run_tasks
+from em_utils.adaptive import AIMDController, threads_arg, concurrency_report
+from em_utils import instrument
+from em_utils.instrument import METRICS
+from em_utils import retry
+from em_utils.retry import retry_call
 
 class EPFLDownloader:
     """Downloader for EPFL hippocampus dataset."""
     
-    def __init__(self):
+    def __init__(self, compute_stats: bool = False, convert: bool = False, convert_workers: int = None):
+        self.compute_stats = compute_stats
+        
         # Create data directory relative to this script
         self.download_dir = Path(__file__).parent / "epfl_data"
         self.download_dir.mkdir(exist_ok=True)
         
+        # Completed TIFFs are converted to OME-Zarr while other files download
+        self.converter = Converter(self.download_dir / "zarr", [5, 5, 5], convert_workers) if convert else None
+        
         self.base_url = "https://documents.epfl.ch/groups/c/cv/cvlab-unit/www/data/%20ElectronMicroscopy_Hippocampus/"
         
         self.files = [
@@ -29,31 +48,49 @@ class EPFLDownloader:
         ]
         
         self.urls = [f"{self.base_url}{filename}" for filename in self.files]
+        self.failures = []
     
     def download_file(self, url_filename: tuple) -> dict:
         """Download a single TIFF file."""
         url, filename = url_filename
         local_path = self.download_dir / filename
         
-        response = requests.get(url, stream=True)
-        
-        with open(local_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk:
-                    f.write(chunk)
+        with METRICS.track_file('epfl', filename) as track:
+            # A retry resumes from the journaled .part file; a cached copy is revalidated against a HEAD
+            transfer = retry_call(lambda: cached_download(url, local_path, lambda: http_segmented_download(
+                url, local_path), *http_validators(url)), urlsplit(url).netloc)
+            track.update(bytes=local_path.stat().st_size, cached=transfer['cached'])
         
-        return {
+        result = {
             'filename': filename,
+            'cached': transfer['cached'],
+            'seconds': track['seconds'],
             'size_bytes': local_path.stat().st_size,
-            'size_mb': local_path.stat().st_size / (1024 * 1024)
+            'size_mb': local_path.stat().st_size / (1024 * 1024),
+            **digest_fields(transfer)
         }
+        if self.compute_stats:
+            # Pages are decoded while the file is still in the page cache
+            result['stats'] = tiff_stats(local_path)
+        if self.converter is not None:
+            self.converter.submit(local_path)
+        return result
     
-    def download(self, num_files: int = 5, max_workers: int = 3) -> int:
+    def download(self, num_files: int = 5, max_workers=3) -> int:
         """Download specified number of TIFF files in parallel."""
         files_to_download = list(zip(self.urls[:num_files], self.files[:num_files]))
         
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            results = list(executor.map(self.download_file, files_to_download))
+        if max_workers == 'auto':
+            max_workers = AIMDController()
+        # Files that still fail after retries are recorded; the rest are kept
+        failures = []
+        results = run_tasks(self.download_file, files_to_download, max_workers,
+                            'epfl', urlsplit(self.base_url).netloc, failures=failures)
+        self.failures = [{'filename': f['item'][1], 'error': f['error']} for f in failures]
+        if self.converter is not None:
+            conversions = self.converter.results()
+            for result in results:
+                result['zarr'] = conversions.get(result['filename'])
         
         # Create metadata
         metadata = {
@@ -62,11 +99,17 @@ class EPFLDownloader:
             'technique': 'Transmission Electron Microscopy (TEM)',
             'sample': 'CA1 hippocampus region',
             'resolution_nm': [5, 5, 5],
+            'status': 'partial' if self.failures else 'complete',
             'files_downloaded': len(results),
             'total_size_mb': sum(r['size_mb'] for r in results),
             'files': results,
+            'files_failed': self.failures,
+            'concurrency': concurrency_report(max_workers),
+            'instrumentation': METRICS.summary('epfl'),
             'created': datetime.now().isoformat()
         }
+        if get_cache() is not None:
+            metadata['cache'] = get_cache().stats()
         
         with open(self.download_dir / "metadata.json", 'w') as f:
             json.dump(metadata, f, indent=2)
@@ -77,12 +120,34 @@ def main():
     """Download EPFL hippocampus TIFF files."""
     parser = argparse.ArgumentParser(description="Download EPFL hippocampus dataset")
     parser.add_argument('--files', '-f', type=int, default=5, help='Number of files to download')
-    parser.add_argument('--threads', '-t', type=int, default=3, help='Parallel download threads')
+    parser.add_argument('--threads', '-t', type=threads_arg, default=3, help="Parallel download threads, or 'auto'")
+    parser.add_argument('--max-segments', type=int, default=PLANNER.max_segments, help='Parallel ranges per large file')
+    parser.add_argument('--no-cache', action='store_true', help='Bypass the local download cache')
+    parser.add_argument('--stats', action='store_true', help='Record per-file intensity statistics')
+    parser.add_argument('--verify', action='store_true', help='Re-check downloaded files against metadata.json')
+    parser.add_argument('--convert', action='store_true', help='Also write each file as a chunked OME-Zarr pyramid')
+    parser.add_argument('--convert-workers', type=int, help='Conversion processes (default: CPU count)')
+    instrument.add_arguments(parser)
+    retry.add_arguments(parser)
     
     args = parser.parse_args()
+    instrument.configure(args)
+    retry.configure(args)
+    PLANNER.max_segments = args.max_segments
+    if args.no_cache:
+        disable_cache()
     
-    downloader = EPFLDownloader()
+    downloader = EPFLDownloader(compute_stats=args.stats, convert=args.convert, convert_workers=args.convert_workers)
+    if args.verify:
+        summary = verify_files(downloader.download_dir)
+        print(json.dumps(summary, indent=2))
+        sys.exit(1 if summary['failed'] else 0)
     downloader.download(args.files, args.threads)
+    if downloader.converter is not None:
+        downloader.converter.close()
+    if downloader.failures:
+        print(f"{len(downloader.failures)} files failed; see metadata.json")
+        sys.exit(1)
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -3,14 +3,30 @@
 FlyEM Hemibrain Dataset Downloader
 """
 
+import os
+import sys
 import json
+import time
 import random
 import argparse
+import itertools
 import numpy as np
 from pathlib import Path
 from datetime import datetime
+from urllib.parse import urlsplit
 from cloudvolume import CloudVolume
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from em_utils.cache import get_cache, disable_cache
+from em_utils.stats import StreamingStats
+from em_utils.multiscale import coarsest_scale
+from em_utils.precomputed import ChunkPipeline, chunk_layout, close_decoders
+from em_utils.scheduler import run_tasks, connection_slot, host_limit
+from em_utils import instrument
+from em_utils.instrument import METRICS
+from em_utils import retry
+from em_utils.retry import retry_call
+
 class HemibrainDownloader:
     """Downloads random 1000x1000x1000 pixel crops from hemibrain EM data."""
     
@@ -20,45 +36,242 @@ class HemibrainDownloader:
         self.output_dir = script_dir / output_dir
         self.output_dir.mkdir(parents=True, exist_ok=True)
         self.data_url = 'precomputed://https://neuroglancer-janelia-flyem-hemibrain.storage.googleapis.com/emdata/clahe_yz/jpeg'
+        self.host = urlsplit(self.data_url.split('://', 1)[1]).netloc
+        # Decoder processes for the pipelined reader (None: all cores, 0: decode inside CloudVolume)
+        self.decode_workers = None
+        self.concurrency = 32
+    
+    @staticmethod
+    def block_shape(em_vol, memory_budget_mb: int, workers: int):
+        """Largest chunk-aligned block and worker count that fit the memory budget.
+        
+        Each in-flight block is held about three times (downloaded chunks,
+        the assembled cutout and the slice being copied out).
+        """
+        chunk = [int(c) for c in em_vol.chunk_size]
+        itemsize = np.dtype(em_vol.dtype).itemsize * int(em_vol.num_channels)
+        chunk_bytes = chunk[0] * chunk[1] * chunk[2] * itemsize * 3
+        budget = memory_budget_mb * 1024 * 1024
+        
+        workers = max(1, min(workers, budget // chunk_bytes))
+        scale = 1
+        while workers * chunk_bytes * (2 * scale) ** 3 <= budget:
+            scale *= 2
+        return [c * scale for c in chunk], workers
+    
+    @staticmethod
+    def plan_blocks(em_vol, boxes, block_shape) -> dict:
+        """Map each grid-aligned block index to the crop boxes (x, y, z) it overlaps."""
+        offset = [int(o) for o in em_vol.voxel_offset]
+        blocks = {}
+        for n, (lo, hi) in enumerate(boxes):
+            ranges = [range((lo[a] - offset[a]) // block_shape[a], (hi[a] - 1 - offset[a]) // block_shape[a] + 1)
+                      for a in range(3)]
+            for index in itertools.product(*ranges):
+                blocks.setdefault(index, []).append(n)
+        return blocks
+    
+    @staticmethod
+    def fetch_block(em_vol, index, block_shape, boxes, members, outputs, stats=None, host=None):
+        """Fetch one block and copy its overlap into every crop output that needs it."""
+        offset = [int(o) for o in em_vol.voxel_offset]
+        block_lo = [offset[a] + index[a] * block_shape[a] for a in range(3)]
+        block_hi = [block_lo[a] + block_shape[a] for a in range(3)]
+        
+        # Only the part of the block that some crop needs
+        lo = [max(block_lo[a], min(boxes[m][0][a] for m in members)) for a in range(3)]
+        hi = [min(block_hi[a], max(boxes[m][1][a] for m in members)) for a in range(3)]
+        with connection_slot(host):
+            started = time.perf_counter()
+            # Every block is needed for the crops to be complete, so failures are retried, not skipped
+            cutout = retry_call(lambda: np.asarray(em_vol[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]]), host)
+        # CloudVolume does its own I/O, so blocks are counted as decoded voxels
+        METRICS.observe('block_seconds', time.perf_counter() - started, host=host)
+        METRICS.add_bytes(cutout.nbytes)
+        if cutout.ndim == 4:
+            cutout = cutout[:, :, :, 0]
+        
+        for m in members:
+            crop_lo, crop_hi = boxes[m]
+            a = [max(lo[i], crop_lo[i]) for i in range(3)]
+            b = [min(hi[i], crop_hi[i]) for i in range(3)]
+            if any(a[i] >= b[i] for i in range(3)):
+                continue
+            window = cutout[tuple(slice(a[i] - lo[i], b[i] - lo[i]) for i in range(3))]
+            outputs[m][tuple(slice(a[i] - crop_lo[i], b[i] - crop_lo[i]) for i in range(3))] = window
+            if stats is not None:
+                stats[m].update(window)
+    
+    def fetch_crops(self, em_vol, boxes, outputs, block_shape, workers, stats=None):
+        """Fill outputs (x, y, z arrays) for boxes, fetching blocks in parallel."""
+        blocks = self.plan_blocks(em_vol, boxes, block_shape)
+        block_bytes = int(np.prod(block_shape)) * np.dtype(em_vol.dtype).itemsize
+        fetch = lambda block: self.fetch_block(em_vol, block[0], block_shape, boxes, block[1], outputs, stats, self.host)
+        run_tasks(fetch, blocks.items(), workers, 'hemibrain', self.host, [block_bytes] * len(blocks))
+        return len(blocks)
+    
+    def pipeline(self, em_vol, memory_budget_mb: int):
+        """ChunkPipeline for em_vol's mip, or None when CloudVolume has to decode (sharded, not JPEG/raw, ...)."""
+        layout = chunk_layout(em_vol) if self.decode_workers != 0 else None
+        if layout is None:
+            return None
+        # Each decoder holds about one decoded chunk and the windows cut from it
+        chunk_bytes = int(np.prod(layout['chunk_size'])) * np.dtype(em_vol.dtype).itemsize * 2
+        budget_workers = memory_budget_mb * 1024 * 1024 // chunk_bytes
+        decode_workers = max(1, min(self.decode_workers or os.cpu_count(), budget_workers))
+        return ChunkPipeline(layout, host_limit(self.host, self.concurrency), decode_workers)
+    
+    def open_volume(self, mip: int = 0):
+        """Open the EM volume at one mip level once for all crops of a run."""
+        # Reuse precomputed chunks fetched by earlier crops
+        cache = get_cache()
+        return CloudVolume(self.data_url, mip=mip, cache=str(cache.root / 'cloudvolume') if cache else False,
+                           progress=False)
+    
+    def select_mip(self, target_nm) -> int:
+        """Coarsest mip that is at least as fine as target_nm (one value, or z y x)."""
+        if target_nm is None:
+            return 0
+        if isinstance(target_nm, (list, tuple)):
+            # The precomputed info lists resolutions as (x, y, z)
+            target_nm = list(target_nm)[::-1]
+        scales = self.open_volume().meta.scales
+        return coarsest_scale([scale['resolution'] for scale in scales], target_nm)
+    
+    @staticmethod
+    def mip_factor(em_vol) -> list:
+        """Mip-0 voxels per voxel of em_vol's mip, as (z, y, x)."""
+        return [em_vol.meta.resolution(em_vol.mip)[a] / em_vol.meta.resolution(0)[a] for a in (2, 1, 0)]
+    
+    def scaled_crop_size(self, em_vol, crop_size: int) -> int:
+        """Crop edge at em_vol's mip covering crop_size mip-0 voxels (crops stay cubes; x sets the size)."""
+        return max(1, round(crop_size / self.mip_factor(em_vol)[2]))
+    
+    @staticmethod
+    def place_crops(em_vol, num_crops: int, crop_size: int, rng, placement: str = 'random') -> list:
+        """Choose crop start corners (z, y, x).
         
-    def download(self, crop_size: int = 1000):
-        """Download random EM crop from hemibrain."""
-        em_vol = CloudVolume(self.data_url)
+        placement is 'random', 'non-overlap' (rejection sampling) or
+        'stratified' (one crop per cell of a regular grid over the volume).
+        """
         shape = [em_vol.shape[2], em_vol.shape[1], em_vol.shape[0]]
+        offset = [int(em_vol.voxel_offset[2]), int(em_vol.voxel_offset[1]), int(em_vol.voxel_offset[0])]
+        span = [shape[i] - crop_size for i in range(3)]
+        if min(span) < 0:
+            raise ValueError(f"Crop size {crop_size} exceeds volume shape {shape}")
         
-        start = [random.randint(0, shape[i] - crop_size) for i in range(3)]
-        end = [start[i] + crop_size for i in range(3)]
+        if placement == 'stratified':
+            per_axis = 1
+            while per_axis ** 3 < num_crops:
+                per_axis += 1
+            cells = rng.sample(list(itertools.product(range(per_axis), repeat=3)), num_crops)
+            starts = []
+            for cell in cells:
+                lo = [cell[i] * span[i] // per_axis for i in range(3)]
+                hi = [(cell[i] + 1) * span[i] // per_axis for i in range(3)]
+                starts.append([offset[i] + rng.randint(lo[i], hi[i]) for i in range(3)])
+            return starts
         
-        data = em_vol[start[2]:end[2], start[1]:end[1], start[0]:end[0]]
-        data = np.array(data)
+        starts = []
+        attempts = 0
+        while len(starts) < num_crops:
+            start = [offset[i] + rng.randint(0, span[i]) for i in range(3)]
+            if placement == 'non-overlap' and any(
+                    all(abs(start[i] - other[i]) < crop_size for i in range(3)) for other in starts):
+                attempts += 1
+                if attempts > 1000 * num_crops:
+                    raise ValueError(f"Could not place {num_crops} non-overlapping {crop_size}^3 crops")
+                continue
+            starts.append(start)
+        return starts
+    
+    def write_crops(self, em_vol, starts, crop_size: int, filenames, memory_budget_mb: int, workers: int) -> dict:
+        """Stream crops at starts (z, y, x) into .npy memmaps in (x, y, z) order.
         
-        if data.ndim == 4:
-            data = data[:,:,:,0]
-        if data.shape != (crop_size, crop_size, crop_size):
-            data = np.transpose(data, (2, 1, 0))
+        Each chunk-aligned block is fetched once and copied into every crop
+        that overlaps it; intensity statistics are accumulated on the way.
+        """
+        boxes = [([z, y, x], [z + crop_size, y + crop_size, x + crop_size]) for z, y, x in starts]
+        boxes = [(lo[::-1], hi[::-1]) for lo, hi in boxes]
+        outputs = [np.lib.format.open_memmap(self.output_dir / filename, mode='w+', dtype=np.dtype(em_vol.dtype),
+                                             shape=(crop_size, crop_size, crop_size))
+                   for filename in filenames]
+        stats = [StreamingStats() for _ in outputs]
+        pipeline = self.pipeline(em_vol, memory_budget_mb)
+        if pipeline is not None:
+            # Raw chunks are fetched and decoded here, one precomputed chunk per block
+            block_shape = pipeline.layout['chunk_size']
+        else:
+            block_shape, workers = self.block_shape(em_vol, memory_budget_mb, workers)
+        label = filenames[0] if len(filenames) == 1 else f'{len(filenames)} crops'
+        with METRICS.track_file('hemibrain', label) as track:
+            if pipeline is not None:
+                chunks = self.plan_blocks(em_vol, boxes, block_shape)
+                # Decoder processes write into the files, so the headers must be on disk first
+                for data in outputs:
+                    data.flush()
+                pipelined = pipeline.run(chunks, boxes, [self.output_dir / f for f in filenames], stats)
+                blocks = len(chunks)
+            else:
+                blocks = self.fetch_crops(em_vol, boxes, outputs, block_shape, workers, stats)
+            for data in outputs:
+                data.flush()
+            track['bytes'] = sum(data.nbytes for data in outputs)
+        
+        written = {
+            'outputs': outputs,
+            'stats': [s.to_dict() for s in stats],
+            'reader': 'pipelined' if pipeline is not None else 'cloudvolume',
+            'block_shape': block_shape,
+            'blocks_fetched': blocks,
+            'blocks_requested': sum(len(self.plan_blocks(em_vol, [box], block_shape)) for box in boxes)
+        }
+        if pipeline is not None:
+            written['pipeline'] = pipelined
+        return written
+    
+    def download(self, crop_size: int = 1000, memory_budget_mb: int = 1024, workers: int = 8,
+                 target_resolution_nm=None):
+        """Download random EM crop from hemibrain, streaming blocks to disk.
+        
+        crop_size is in mip-0 voxels; with target_resolution_nm the crop is
+        read from the coarsest mip at least that fine, covering the same extent.
+        """
+        em_vol = self.open_volume(self.select_mip(target_resolution_nm))
+        requested_size, crop_size = crop_size, self.scaled_crop_size(em_vol, crop_size)
+        start = self.place_crops(em_vol, 1, crop_size, random)[0]
+        end = [start[i] + crop_size for i in range(3)]
         
-        crop_file = self.output_dir / f"hemibrain_crop_{crop_size}x{crop_size}x{crop_size}.npy"
-        np.save(crop_file, data)
+        suffix = f"_mip{em_vol.mip}" if em_vol.mip else ""
+        crop_file = self.output_dir / f"hemibrain_crop_{crop_size}x{crop_size}x{crop_size}{suffix}.npy"
+        written = self.write_crops(em_vol, [start], crop_size, [crop_file.name], memory_budget_mb, workers)
+        data = written['outputs'][0]
+        factor = self.mip_factor(em_vol)
         
         metadata = {
             'dataset': 'FlyEM Hemibrain Drosophila Connectome',
             'source': self.data_url,
             'technique': 'Focused Ion Beam Scanning Electron Microscopy (FIB-SEM)',
             'sample': 'Adult Drosophila brain hemisphere',
-            'resolution_nm': [8, 8, 8],
+            'resolution_nm': em_vol.meta.resolution(em_vol.mip).tolist(),
             'format': 'Random crops from 3D volume',
+            'mip': em_vol.mip,
             'crop_size': crop_size,
+            'crop_size_mip0': requested_size,
             'coordinates': {'start': start, 'end': end},
+            'coordinates_mip0': {'start': [round(s * f) for s, f in zip(start, factor)],
+                                 'end': [round(e * f) for e, f in zip(end, factor)]},
+            'reader': written['reader'],
+            'block_shape': written['block_shape'],
+            'pipeline': written.get('pipeline'),
+            'memory_budget_mb': memory_budget_mb,
+            'instrumentation': METRICS.summary('hemibrain'),
             'files': [{
-                'filename': f"hemibrain_crop_{crop_size}x{crop_size}x{crop_size}.npy",
+                'filename': crop_file.name,
                 'shape': list(data.shape),
                 'dtype': str(data.dtype),
                 'size_mb': data.nbytes / (1024 * 1024),
-                'stats': {
-                    'min': int(data.min()),
-                    'max': int(data.max()),
-                    'mean': float(data.mean())
-                }
+                'stats': written['stats'][0]
             }],
             'created': datetime.now().isoformat()
         }
@@ -67,17 +280,120 @@ class HemibrainDownloader:
             json.dump(metadata, f, indent=2)
         
         return str(crop_file)
+    
+    @staticmethod
+    def crop_filename(n: int, start, crop_size: int, mip: int = 0) -> str:
+        z, y, x = start
+        suffix = f"_mip{mip}" if mip else ""
+        return f"hemibrain_crop_{crop_size}x{crop_size}x{crop_size}_{n:04d}_z{z}_y{y}_x{x}{suffix}.npy"
+    
+    def download_crops(self, em_vol, crops, crop_size: int = 1000, seed: int = None, placement: str = 'random',
+                       memory_budget_mb: int = 1024, workers: int = 8) -> dict:
+        """Write (n, start) crops, numbered n, and return their metadata without writing it.
+        
+        starts and crop_size are in voxels of em_vol's mip.
+        """
+        starts = [start for _, start in crops]
+        filenames = [self.crop_filename(n, start, crop_size, em_vol.mip) for n, start in crops]
+        written = self.write_crops(em_vol, starts, crop_size, filenames, memory_budget_mb, workers)
+        factor = self.mip_factor(em_vol)
+        
+        files = []
+        for filename, start, data, stats in zip(filenames, starts, written['outputs'], written['stats']):
+            end = [start[i] + crop_size for i in range(3)]
+            entry = {
+                'filename': filename,
+                'coordinates': {'start': start, 'end': end},
+                'shape': list(data.shape),
+                'dtype': str(data.dtype),
+                'size_mb': data.nbytes / (1024 * 1024),
+                'stats': stats
+            }
+            if em_vol.mip:
+                entry['coordinates_mip0'] = {'start': [round(s * f) for s, f in zip(start, factor)],
+                                             'end': [round(e * f) for e, f in zip(end, factor)]}
+            files.append(entry)
+        
+        metadata = {
+            'dataset': 'FlyEM Hemibrain Drosophila Connectome',
+            'source': self.data_url,
+            'technique': 'Focused Ion Beam Scanning Electron Microscopy (FIB-SEM)',
+            'sample': 'Adult Drosophila brain hemisphere',
+            'resolution_nm': em_vol.meta.resolution(em_vol.mip).tolist(),
+            'format': 'Batch of crops from 3D volume',
+            'mip': em_vol.mip,
+            'crop_size': crop_size,
+            'seed': seed,
+            'placement': placement,
+            'reader': written['reader'],
+            'block_shape': written['block_shape'],
+            'blocks_fetched': written['blocks_fetched'],
+            'blocks_requested': written['blocks_requested'],
+            'pipeline': written.get('pipeline'),
+            'memory_budget_mb': memory_budget_mb,
+            'files_downloaded': len(files),
+            'total_size_mb': sum(f['size_mb'] for f in files),
+            'files': files,
+            'instrumentation': METRICS.summary('hemibrain'),
+            'created': datetime.now().isoformat()
+        }
+        return metadata
+    
+    def download_batch(self, num_crops: int, crop_size: int = 1000, seed: int = None, placement: str = 'random',
+                       memory_budget_mb: int = 1024, workers: int = 8, target_resolution_nm=None) -> list:
+        """Download num_crops crops from one open volume, sharing overlapping chunks.
+        
+        crop_size is in mip-0 voxels, as in download.
+        """
+        em_vol = self.open_volume(self.select_mip(target_resolution_nm))
+        crop_size = self.scaled_crop_size(em_vol, crop_size)
+        starts = self.place_crops(em_vol, num_crops, crop_size, random.Random(seed), placement)
+        metadata = self.download_crops(em_vol, list(enumerate(starts)), crop_size, seed, placement,
+                                       memory_budget_mb, workers)
+        
+        with open(self.output_dir / "metadata.json", 'w') as f:
+            json.dump(metadata, f, indent=2)
+        
+        return [str(self.output_dir / f['filename']) for f in metadata['files']]
 
 def main():
     """Main function."""
-    parser = argparse.ArgumentParser(description="Download random hemibrain EM crop")
+    parser = argparse.ArgumentParser(description="Download random hemibrain EM crops")
     parser.add_argument('--output', '-o', default='hemibrain_data', help='Output directory')
     parser.add_argument('--size', '-s', type=int, default=1000, help='Crop size (default: 1000)')
+    parser.add_argument('--memory-budget-mb', type=int, default=1024, help='Peak memory for in-flight blocks')
+    parser.add_argument('--workers', '-w', type=int, default=8, help='Parallel block fetches through CloudVolume')
+    parser.add_argument('--decode-workers', type=int,
+                        help='Processes decoding JPEG chunks (default: all cores; 0 decodes inside CloudVolume)')
+    parser.add_argument('--concurrency', type=int, default=32, help='Concurrent chunk requests when pipelined')
+    parser.add_argument('--num-crops', '-n', type=int, default=1, help='Number of crops to sample in one run')
+    parser.add_argument('--seed', type=int, help='Random seed for crop placement')
+    parser.add_argument('--placement', choices=['random', 'non-overlap', 'stratified'], default='random',
+                        help='How to place multiple crops')
+    parser.add_argument('--target-resolution-nm', type=float, nargs='+', metavar='NM',
+                        help='Read from the coarsest mip at least this fine (one value, or z y x); '
+                             '--size stays in full-resolution voxels')
+    parser.add_argument('--no-cache', action='store_true', help='Bypass the local chunk cache')
+    instrument.add_arguments(parser)
+    retry.add_arguments(parser)
     
     args = parser.parse_args()
+    instrument.configure(args)
+    retry.configure(args)
+    if args.no_cache:
+        disable_cache()
     
     downloader = HemibrainDownloader(args.output)
-    downloader.download(args.size)
+    downloader.decode_workers = args.decode_workers
+    downloader.concurrency = args.concurrency
+    if args.num_crops > 1:
+        downloader.download_batch(args.num_crops, args.size, args.seed, args.placement,
+                                  args.memory_budget_mb, args.workers, args.target_resolution_nm)
+    else:
+        if args.seed is not None:
+            random.seed(args.seed)
+        downloader.download(args.size, args.memory_budget_mb, args.workers, args.target_resolution_nm)
+    close_decoders()
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
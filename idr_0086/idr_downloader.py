@@ -1,77 +1,208 @@
 #!/usr/bin/env python3
 """
-IDR-0086 Data Downloader
-Downloads specific Figure S3B FIB-SEM files from IDR-0086
+IDR Data Downloader
+Crawls an IDR study over FTP and downloads matching files; by default the
+Figure S3B FIB-SEM files from IDR-0086
 """
 
+import sys
 import json
 import argparse
-import ftplib
+from functools import partial
 from pathlib import Path
 from datetime import datetime
-from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from em_utils.ftp_pool import get_pool
+from em_utils.ftp_crawl import FTPCrawler
+from em_utils.segmented import PLANNER, ftp_segmented_download
+from em_utils.cache import get_cache, disable_cache, cached_download
+from em_utils.stats import tiff_stats
+from em_utils.convert import Converter
+from em_utils.integrity import digest_fields, verify_files
+from em_utils.scheduler import run_tasks
+from em_utils.adaptive import AIMDController, threads_arg, concurrency_report
+from em_utils import instrument
+from em_utils.instrument import METRICS
+from em_utils import retry
+from em_utils.retry import retry_call
 
 # Create data directory relative to this script
 SCRIPT_DIR = Path(__file__).parent
 DOWNLOAD_DIR = SCRIPT_DIR / "idr_data"
-BASE_PATH = "/pub/databases/IDR/idr0086-miron-micrographs"
+FTP_HOST = "ftp.ebi.ac.uk"
+FTP_PORT = 21
+IDR_ROOT = "/pub/databases/IDR"
+DEFAULT_STUDY = "idr0086-miron-micrographs"
+BASE_PATH = f"{IDR_ROOT}/{DEFAULT_STUDY}"
 
-def download_file(file_info):
-    """Download a single TIFF file."""
-    filename, remote_path = file_info
-    local_path = DOWNLOAD_DIR / filename
+# Figure S3B files, found by crawling their directory
+DEFAULT_ROOT = "20200610-ftp/experimentD/Miron_FIB-SEM/Miron_FIB-SEM_processed"
+DEFAULT_INCLUDE = ["Figure_S3B_FIB-SEM_U2OS_20x20x20nm_*.tif"]
+
+# Descriptive fields for studies we know; others get a generic record
+STUDY_INFO = {
+    DEFAULT_STUDY: {
+        'dataset': 'IDR-0086 Human Chromatin Organization (Figure S3B)',
+        'technique': 'Focused Ion Beam Scanning Electron Microscopy (FIB-SEM)',
+        'sample': 'U2OS human osteosarcoma cells',
+        'resolution_nm': [20, 20, 20],
+        'format': 'Multi-page TIFF volumes (xy and xz projections)',
+        'description': 'Figure S3B supplementary data showing FIB-SEM U2OS cell imaging',
+    }
+}
+
+def download_file(file_info, compute_stats=False, converter=None):
+    """Download a single file.
     
-    ftp = ftplib.FTP("ftp.ebi.ac.uk")
-    ftp.login()
+    file_info is (filename, remote_path[, size]); remote_path is absolute
+    or relative to BASE_PATH, and filename may contain subdirectories. A
+    converter, if given, queues the finished file for OME-Zarr conversion.
+    """
+    filename, remote_path = file_info[:2]
+    # The crawl's size invalidates a cached copy of a file replaced upstream
+    size = file_info[2] if len(file_info) > 2 else None
+    local_path = DOWNLOAD_DIR / filename
+    local_path.parent.mkdir(parents=True, exist_ok=True)
     
-    with open(local_path, 'wb') as f:
-        ftp.retrbinary(f'RETR {BASE_PATH}/{remote_path}', f.write)
-    ftp.quit()
+    full_path = remote_path if remote_path.startswith('/') else f'{BASE_PATH}/{remote_path}'
+    with METRICS.track_file('idr', filename) as track:
+        # A retry resumes from the journaled .part file
+        transfer = retry_call(lambda: cached_download(f'ftp://{FTP_HOST}{full_path}', local_path, lambda: (
+            ftp_segmented_download(get_pool(FTP_HOST, FTP_PORT), full_path, local_path)), size=size), FTP_HOST)
+        track.update(bytes=local_path.stat().st_size, cached=transfer['cached'])
     
-    return {
+    result = {
         'filename': filename,
         'remote_path': remote_path,
+        'cached': transfer['cached'],
+        'seconds': track['seconds'],
         'size_bytes': local_path.stat().st_size,
-        'size_mb': local_path.stat().st_size / (1024 * 1024)
+        'size_mb': local_path.stat().st_size / (1024 * 1024),
+        **digest_fields(transfer)
     }
+    if compute_stats and local_path.suffix.lower() in ('.tif', '.tiff'):
+        # Pages are decoded while the file is still in the page cache
+        result['stats'] = tiff_stats(local_path)
+    if converter is not None and local_path.suffix.lower() in ('.tif', '.tiff'):
+        converter.submit(local_path, filename)
+    return result
 
-def main():
-    """Download IDR-0086 Figure S3B FIB-SEM TIFF files."""
-    parser = argparse.ArgumentParser(description="Download Figure S3B FIB-SEM files from IDR-0086")
-    parser.add_argument('--threads', '-t', type=int, default=2, help='Parallel download threads')
-    
-    args = parser.parse_args()
+def make_crawler(study: str = DEFAULT_STUDY, root: str = DEFAULT_ROOT, include=DEFAULT_INCLUDE, regex: str = None,
+                 min_size: int = None, max_size: int = None, max_files: int = None,
+                 crawl_workers: int = 4) -> FTPCrawler:
+    """Crawler yielding (relative_path, remote_path, size) for matching files under study/root."""
+    return FTPCrawler(get_pool(FTP_HOST, FTP_PORT), f'{IDR_ROOT}/{study}/{root}'.rstrip('/'), include, regex,
+                      min_size, max_size, max_files, crawl_workers)
+
+def download_items(items, study: str = DEFAULT_STUDY, max_workers=2, compute_stats: bool = False,
+                   convert: bool = False, convert_workers: int = None, failures: list = None,
+                   crawler: FTPCrawler = None) -> dict:
+    """Download (filename, remote_path, size) items and return their metadata without writing it.
     
-    # Setup
+    items may be a crawler still discovering files; pass it as crawler as
+    well to record its summary. Files that still fail after retries are
+    listed in the metadata and, if a failures list is given, appended to it.
+    """
+    failures = [] if failures is None else failures
     DOWNLOAD_DIR.mkdir(exist_ok=True)
+    study_path = f'{IDR_ROOT}/{study}'
+    info = STUDY_INFO.get(study, {'dataset': f'IDR {study}'})
+    # Completed TIFFs are converted to OME-Zarr while the crawl and other downloads continue
+    converter = Converter(DOWNLOAD_DIR / "zarr", info.get('resolution_nm'), convert_workers) if convert else None
     
-    # Target specific Figure S3B files
-    target_files = [
-        ("Figure_S3B_FIB-SEM_U2OS_20x20x20nm_xy.tif", "20200610-ftp/experimentD/Miron_FIB-SEM/Miron_FIB-SEM_processed/Figure_S3B_FIB-SEM_U2OS_20x20x20nm_xy.tif"),
-        ("Figure_S3B_FIB-SEM_U2OS_20x20x20nm_xz.tif", "20200610-ftp/experimentD/Miron_FIB-SEM/Miron_FIB-SEM_processed/Figure_S3B_FIB-SEM_U2OS_20x20x20nm_xz.tif")
-    ]
-    
-    # Download files in parallel
-    with ThreadPoolExecutor(max_workers=args.threads) as executor:
-        results = list(executor.map(download_file, target_files))
+    if max_workers == 'auto':
+        max_workers = AIMDController()
+    failed = []
+    # Files are handed to the workers as soon as the crawl finds them
+    results = run_tasks(partial(download_file, compute_stats=compute_stats, converter=converter), items,
+                        max_workers, 'idr', FTP_HOST, lambda item: item[2] or 0, failed)
+    failures.extend({'filename': f['item'][0], 'remote_path': f['item'][1], 'error': f['error']} for f in failed)
+    if converter is not None:
+        conversions = converter.results()
+        converter.close()
+        for result in results:
+            result['zarr'] = conversions.get(result['filename'])
     
     # Create metadata
-    metadata = {
-        'dataset': 'IDR-0086 Human Chromatin Organization (Figure S3B)',
-        'source': f'ftp://ftp.ebi.ac.uk{BASE_PATH}',
-        'technique': 'Focused Ion Beam Scanning Electron Microscopy (FIB-SEM)',
-        'sample': 'U2OS human osteosarcoma cells',
-        'resolution_nm': [20, 20, 20],
-        'format': 'Multi-page TIFF volumes (xy and xz projections)',
-        'description': 'Figure S3B supplementary data showing FIB-SEM U2OS cell imaging',
+    metadata = dict(info)
+    metadata['source'] = f'ftp://{FTP_HOST}{study_path}'
+    if crawler is not None:
+        metadata['crawl'] = crawler.summary()
+    metadata.update({
+        'status': 'partial' if failures or (crawler is not None and crawler.dirs_failed) else 'complete',
         'files_downloaded': len(results),
         'total_size_mb': sum(r['size_mb'] for r in results),
         'files': results,
+        'files_failed': failures,
+        'concurrency': concurrency_report(max_workers),
+        'instrumentation': METRICS.summary('idr'),
         'created': datetime.now().isoformat()
-    }
+    })
+    if get_cache() is not None:
+        metadata['cache'] = get_cache().stats()
+    return metadata
+
+def download(study: str = DEFAULT_STUDY, root: str = DEFAULT_ROOT, include=DEFAULT_INCLUDE, regex: str = None,
+             min_size: int = None, max_size: int = None, max_files: int = None, max_workers=2,
+             crawl_workers: int = 4, compute_stats: bool = False, convert: bool = False,
+             convert_workers: int = None, failures: list = None) -> int:
+    """Crawl study/root and download matching files while the crawl runs, then write metadata.json."""
+    crawler = make_crawler(study, root, include, regex, min_size, max_size, max_files, crawl_workers)
+    metadata = download_items(crawler, study, max_workers, compute_stats, convert, convert_workers, failures, crawler)
     
     with open(DOWNLOAD_DIR / "metadata.json", 'w') as f:
         json.dump(metadata, f, indent=2)
+    
+    return metadata['files_downloaded']
+
+def main():
+    """Download files from an IDR study (default: IDR-0086 Figure S3B FIB-SEM TIFFs)."""
+    parser = argparse.ArgumentParser(description="Crawl an IDR study over FTP and download matching files")
+    parser.add_argument('--study', default=DEFAULT_STUDY, help='Study directory under /pub/databases/IDR')
+    parser.add_argument('--root', default=DEFAULT_ROOT, help='Directory within the study to crawl')
+    parser.add_argument('--include', nargs='+', help='Glob(s) on paths relative to --root (default: Figure S3B TIFFs)')
+    parser.add_argument('--regex', help='Regular expression that relative paths must match')
+    parser.add_argument('--min-size-mb', type=float, help='Skip files smaller than this')
+    parser.add_argument('--max-size-mb', type=float, help='Skip files larger than this')
+    parser.add_argument('--files', '-f', type=int, help='Stop after this many matching files')
+    parser.add_argument('--threads', '-t', type=threads_arg, default=2, help="Parallel download threads, or 'auto'")
+    parser.add_argument('--crawl-workers', type=int, default=4, help='Directories listed in parallel')
+    parser.add_argument('--max-sessions', type=int, default=4, help='Maximum open FTP sessions')
+    parser.add_argument('--max-segments', type=int, default=PLANNER.max_segments, help='Parallel REST segments per large file')
+    parser.add_argument('--no-cache', action='store_true', help='Bypass the local download cache')
+    parser.add_argument('--stats', action='store_true', help='Record per-file intensity statistics')
+    parser.add_argument('--verify', action='store_true', help='Re-check downloaded files against metadata.json')
+    parser.add_argument('--convert', action='store_true', help='Also write each TIFF as a chunked OME-Zarr pyramid')
+    parser.add_argument('--convert-workers', type=int, help='Conversion processes (default: CPU count)')
+    instrument.add_arguments(parser)
+    retry.add_arguments(parser)
+    
+    args = parser.parse_args()
+    instrument.configure(args)
+    retry.configure(args)
+    PLANNER.max_segments = args.max_segments
+    if args.no_cache:
+        disable_cache()
+    
+    if args.verify:
+        summary = verify_files(DOWNLOAD_DIR)
+        print(json.dumps(summary, indent=2))
+        sys.exit(1 if summary['failed'] else 0)
+    
+    # Custom filters replace the default Figure S3B pattern
+    include = args.include if args.include or args.regex else DEFAULT_INCLUDE
+    mb = 1024 * 1024
+    pool = get_pool(FTP_HOST, FTP_PORT, max_sessions=args.max_sessions)
+    failures = []
+    download(args.study, args.root, include, args.regex,
+             int(args.min_size_mb * mb) if args.min_size_mb else None,
+             int(args.max_size_mb * mb) if args.max_size_mb else None,
+             args.files, args.threads, args.crawl_workers, args.stats, args.convert, args.convert_workers, failures)
+    pool.close()
+    if failures:
+        print(f"{len(failures)} files failed; see metadata.json")
+        sys.exit(1)
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
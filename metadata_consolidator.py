@@ -1,29 +1,187 @@
 #!/usr/bin/env python3
 """
-Simple EM Dataset Metadata Consolidator
+EM Dataset Metadata Consolidator
+Catalogs every metadata.json under a directory into SQLite and reports a summary
 """
 
+import os
 import json
+import sqlite3
+import hashlib
+import argparse
 from pathlib import Path
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 
-def load_metadata():
-    """Load all metadata files."""
-    paths = {
-        'EPFL': 'epfl_hippocampus/epfl_data/metadata.json',
-        'FlyEM': 'flyem_hemibrain/hemibrain_data/metadata.json', 
-        'EMPIAR': 'empiar_11759/empiar_data/metadata.json',
-        'IDR': 'idr_0086/idr_data/metadata.json',
-        'OpenOrganelle': 'openorganelle_jrc/openorganelle_data/metadata.json'
-    }
+# Short names for the downloaders' own data directories
+DATASET_NAMES = {
+    'epfl_data': 'EPFL',
+    'hemibrain_data': 'FlyEM',
+    'empiar_data': 'EMPIAR',
+    'idr_data': 'IDR',
+    'openorganelle_data': 'OpenOrganelle'
+}
+
+DEFAULT_CATALOG = 'metadata_catalog.sqlite'
+
+# Per-file fields copied from metadata.json into the catalog
+FILE_FIELDS = ['size_bytes', 'sha256', 'xxh64', 'md5']
+
+# Changed files needed before parsing moves to a process pool
+PARALLEL_THRESHOLD = 64
+
+def discover_metadata(root) -> list:
+    """Find every metadata.json under root, skipping hidden and zarr directories."""
+    found = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if not d.startswith('.') and not d.endswith('.zarr')
+                       and d not in ('__pycache__', 'zarr')]
+        if 'metadata.json' in filenames:
+            found.append(Path(dirpath) / 'metadata.json')
+    return sorted(found)
+
+def dataset_key(path: Path, root: Path) -> str:
+    """Short name for the dataset a metadata.json belongs to."""
+    return DATASET_NAMES.get(path.parent.name, str(path.parent.relative_to(root)))
+
+def parse_metadata(path) -> tuple:
+    """Read one metadata.json; returns (sha256, summary without the file list, file records)."""
+    raw = Path(path).read_bytes()
+    data = json.loads(raw)
+    files = data.pop('files', []) or []
+    return hashlib.sha256(raw).hexdigest(), data, files
+
+def open_catalog(path) -> sqlite3.Connection:
+    db = sqlite3.connect(path)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS sources (
+            path TEXT PRIMARY KEY,
+            mtime_ns INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            sha256 TEXT NOT NULL,
+            dataset_key TEXT NOT NULL,
+            dataset TEXT,
+            technique TEXT,
+            created TEXT,
+            summary TEXT NOT NULL
+        )""")
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS files (
+            source TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            dataset_key TEXT NOT NULL,
+            dataset TEXT,
+            technique TEXT,
+            res_x REAL,
+            res_y REAL,
+            res_z REAL,
+            size_bytes INTEGER,
+            sha256 TEXT,
+            xxh64 TEXT,
+            md5 TEXT,
+            record TEXT NOT NULL,
+            PRIMARY KEY (source, filename)
+        )""")
+    for column in ['dataset_key', 'technique', 'res_x, res_y, res_z', 'size_bytes', 'sha256']:
+        name = column.split(',')[0]
+        db.execute(f'CREATE INDEX IF NOT EXISTS files_{name} ON files ({column})')
+    db.commit()
+    return db
+
+def _store(db, path: str, stat, key: str, sha256: str, summary: dict, files: list):
+    """Replace the catalog rows of one metadata.json."""
+    res = (list(summary.get('resolution_nm') or []) + [None] * 3)[:3]
+    db.execute('DELETE FROM files WHERE source = ?', (path,))
+    db.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', [
+        (path, record.get('filename', ''), key, summary.get('dataset'), summary.get('technique'), *res,
+         *(record.get(field) for field in FILE_FIELDS), json.dumps(record))
+        for record in files
+    ])
+    db.execute('INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+               (path, stat.st_mtime_ns, stat.st_size, sha256, key, summary.get('dataset'),
+                summary.get('technique'), summary.get('created'), json.dumps(summary)))
+
+def update_catalog(root='.', catalog=DEFAULT_CATALOG, workers: int = None) -> dict:
+    """Bring the catalog up to date with the metadata.json files under root.
+    
+    Files whose mtime and size are unchanged are skipped without being
+    read; changed ones are parsed in parallel and their rows replaced, and
+    files that disappeared are dropped.
+    """
+    root = Path(root).resolve()
+    db = open_catalog(catalog)
+    known = {path: (mtime_ns, size, sha256) for path, mtime_ns, size, sha256 in
+             db.execute('SELECT path, mtime_ns, size, sha256 FROM sources')}
+    
+    found = {str(path): path.stat() for path in discover_metadata(root)}
+    changed = [path for path, stat in found.items()
+               if known.get(path, (None, None))[:2] != (stat.st_mtime_ns, stat.st_size)]
+    removed = known.keys() - found.keys()
+    
+    updated = 0
+    # Parsing only pays for a process pool once there are many files
+    executor = ProcessPoolExecutor(max_workers=workers) if len(changed) >= PARALLEL_THRESHOLD else None
+    parsed = executor.map(parse_metadata, changed, chunksize=16) if executor else map(parse_metadata, changed)
+    for path, (sha256, summary, files) in zip(changed, parsed):
+        if path in known and known[path][2] == sha256:
+            # Touched but identical; only the stat changes
+            db.execute('UPDATE sources SET mtime_ns = ?, size = ? WHERE path = ?',
+                       (found[path].st_mtime_ns, found[path].st_size, path))
+            continue
+        _store(db, path, found[path], dataset_key(Path(path), root), sha256, summary, files)
+        updated += 1
+    if executor:
+        executor.shutdown()
+    for path in removed:
+        db.execute('DELETE FROM files WHERE source = ?', (path,))
+        db.execute('DELETE FROM sources WHERE path = ?', (path,))
+    db.commit()
+    db.close()
+    return {'discovered': len(found), 'updated': updated, 'unchanged': len(found) - updated, 'removed': len(removed)}
+
+def load_metadata(catalog=DEFAULT_CATALOG):
+    """Load the most recent metadata of each dataset from the catalog.
     
+    Files without a 'dataset' field (not written by a downloader) are
+    catalogued but left out of the summary.
+    """
+    db = open_catalog(catalog)
     datasets = {}
-    for name, path in paths.items():
-        if Path(path).exists():
-            with open(path) as f:
-                datasets[name] = json.load(f)
+    for key, summary in db.execute('SELECT dataset_key, summary FROM sources WHERE dataset IS NOT NULL ORDER BY created'):
+        datasets[key] = json.loads(summary)
+    db.close()
     return datasets
 
+def query_files(catalog=DEFAULT_CATALOG, dataset: str = None, technique: str = None, max_resolution_nm: float = None,
+                min_size_mb: float = None, sha256: str = None, limit: int = None) -> list:
+    """Query catalogued files across all runs; returns per-file records with their dataset."""
+    sql = 'SELECT source, dataset_key, record FROM files WHERE 1 = 1'
+    params = []
+    if dataset:
+        sql += ' AND dataset_key = ?'
+        params.append(dataset)
+    if technique:
+        sql += ' AND technique LIKE ?'
+        params.append(f'%{technique}%')
+    if max_resolution_nm is not None:
+        sql += ' AND res_x <= ? AND res_y <= ? AND res_z <= ?'
+        params += [max_resolution_nm] * 3
+    if min_size_mb is not None:
+        sql += ' AND size_bytes >= ?'
+        params.append(int(min_size_mb * 1024 * 1024))
+    if sha256:
+        sql += ' AND sha256 = ?'
+        params.append(sha256)
+    if limit is not None:
+        sql += ' LIMIT ?'
+        params.append(limit)
+    db = open_catalog(catalog)
+    rows = [dict(json.loads(record), source=source, dataset_key=key)
+            for source, key, record in db.execute(sql, params)]
+    db.close()
+    return rows
+
 def extract_common_fields(datasets):
     """Extract and analyze key fields."""
     extracted = {}
@@ -100,11 +258,35 @@ def generate_table(extracted, analysis):
 
 def main():
     """Main consolidation function."""
+    parser = argparse.ArgumentParser(description="Consolidate metadata.json files into a catalog and summary")
+    parser.add_argument('--root', default='.', help='Directory to search for metadata.json files')
+    parser.add_argument('--catalog', default=DEFAULT_CATALOG, help='SQLite catalog path')
+    parser.add_argument('--workers', type=int, help='Parallel parser processes')
+    parser.add_argument('--query', action='store_true', help='Query catalogued files instead of reporting')
+    parser.add_argument('--dataset', help='Query: dataset short name (EPFL, FlyEM, ...)')
+    parser.add_argument('--technique', help='Query: substring of the imaging technique')
+    parser.add_argument('--max-resolution-nm', type=float, help='Query: coarsest voxel size on any axis')
+    parser.add_argument('--min-size-mb', type=float, help='Query: smallest file size')
+    parser.add_argument('--sha256', help='Query: files with this checksum')
+    parser.add_argument('--limit', type=int, help='Query: maximum rows')
+    args = parser.parse_args()
+    
     print("EM Dataset Metadata Consolidator")
     print("=" * 40)
     
+    scan = update_catalog(args.root, args.catalog, args.workers)
+    print(f"Catalog: {scan['discovered']} metadata files, {scan['updated']} updated, {scan['removed']} removed")
+    
+    if args.query:
+        rows = query_files(args.catalog, args.dataset, args.technique, args.max_resolution_nm,
+                           args.min_size_mb, args.sha256, args.limit)
+        for row in rows:
+            print(f"{row['dataset_key']:<14} {row.get('size_bytes') or 0:>14} {row.get('sha256') or '-':<64} {row['filename']}")
+        print(f"{len(rows)} files")
+        return
+    
     # Load and process data
-    datasets = load_metadata()
+    datasets = load_metadata(args.catalog)
     print(f"Loaded {len(datasets)} datasets")
     
     extracted, analysis = extract_common_fields(datasets)
@@ -3,47 +3,98 @@
 OpenOrganelle JRC Dataset Downloader
 """
 
+import sys
 import json
 import random
-import requests
 import argparse
+import requests
 from pathlib import Path
 from datetime import datetime
+from urllib.parse import urlsplit
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from em_utils.async_http import AsyncChunkFetcher
+from em_utils.cache import get_cache, disable_cache
+from em_utils.zarr_region import read_zarray, download_region
+from em_utils.multiscale import read_multiscales, coarsest_scale, rescale_box
+from em_utils.integrity import digest_fields, verify_files
+from em_utils.scheduler import host_limit
+from em_utils import instrument
+from em_utils.instrument import METRICS
+from em_utils import retry
 
 class OpenOrganelleDownloader:
-    
+
     def __init__(self):
         self.output_dir = Path(__file__).parent / "openorganelle_data"
         self.output_dir.mkdir(exist_ok=True)
         
         self.base_url = "https://openorganelle.janelia.org/datasets/jrc_mus-liver/zarr"
+        self.host = urlsplit(self.base_url).netloc
+        
+        # Zarr arrays within the container, by chunk type
+        self.layers = {"raw_em": "em/fibsem-uint8", "nuclei": "labels/nuclei-cc"}
+        # Scale level that random chunks are sampled from
+        self.sample_scales = {"raw_em": "s0", "nuclei": "s2"}
+        # Multiscale entries of sample_scales once chosen by resolution (select_scales)
+        self.scales = {}
         
         # Available chunk ranges
         self.raw_em_dims = (9, 40, 41)  # z, y, x
         self.nuclei_dims = (2, 5, 6)   # z, y, x
+        self.failures = []
     
-    def download_chunk(self, chunk_type, z, y, x):
-        """Download a single zarr chunk."""
-        if chunk_type == "raw_em":
-            url = f"{self.base_url}/jrc_mus-liver.zarr/em/fibsem-uint8/s0/{z}/{y}/{x}"
-            filename = f"raw_em_{z}_{y}_{x}.zarr"
-        else:  # nuclei
-            url = f"{self.base_url}/jrc_mus-liver.zarr/labels/nuclei-cc/s2/{z}/{y}/{x}"
-            filename = f"nuclei_{z}_{y}_{x}.zarr"
-        
-        local_path = self.output_dir / filename
-        response = requests.get(url)
-        
-        with open(local_path, 'wb') as f:
-            f.write(response.content)
-        
-        return {
-            'filename': filename,
-            'chunk_type': chunk_type,
-            'coordinates': [z, y, x],
-            'size_bytes': local_path.stat().st_size,
-            'size_kb': local_path.stat().st_size / 1024
-        }
+    def group_url(self, chunk_type):
+        """URL of a layer's multiscale group."""
+        return f"{self.base_url}/jrc_mus-liver.zarr/{self.layers[chunk_type]}"
+    
+    def array_url(self, chunk_type, scale):
+        """URL of one scale level of a layer."""
+        return f"{self.group_url(chunk_type)}/{scale}"
+    
+    def select_scales(self, target_nm) -> dict:
+        """Sample every layer from its coarsest scale that is at least as fine as target_nm.
+        
+        Scales come from each group's multiscale metadata and the chunk
+        grids from the chosen arrays' .zarray.
+        """
+        for chunk_type in self.layers:
+            scales = read_multiscales(self.group_url(chunk_type))
+            scale = scales[coarsest_scale([s['resolution_nm'] for s in scales], target_nm)]
+            meta = read_zarray(self.array_url(chunk_type, scale['path']))
+            self.sample_scales[chunk_type] = scale['path']
+            self.scales[chunk_type] = scale
+            setattr(self, f"{chunk_type}_dims", tuple(-(-s // c) for s, c in zip(meta['shape'], meta['chunks'])))
+        return self.scales
+    
+    def chunk_source(self, chunk_type, z, y, x):
+        """Return (url, filename) for a zarr chunk."""
+        scale = self.sample_scales[chunk_type]
+        url = f"{self.array_url(chunk_type, scale)}/{z}/{y}/{x}"
+        # Chunks from a scale chosen by resolution are named by it, so runs at different scales do not collide
+        filename = f"{chunk_type}_{scale}_{z}_{y}_{x}.zarr" if self.scales else f"{chunk_type}_{z}_{y}_{x}.zarr"
+        return url, filename
+    
+    def array_metadata(self, chunk_types) -> dict:
+        """The .zarray of each sampled layer, so saved chunk blobs can be decoded offline."""
+        arrays = {}
+        for chunk_type in chunk_types:
+            try:
+                arrays[chunk_type] = read_zarray(self.array_url(chunk_type, self.sample_scales[chunk_type]))
+            except requests.RequestException:
+                pass
+        return arrays
+    
+    @staticmethod
+    def _sample_coords(dims, count):
+        """Sample distinct (z, y, x) chunk coordinates from a chunk grid."""
+        total = dims[0] * dims[1] * dims[2]
+        coords = []
+        for index in random.sample(range(total), min(count, total)):
+            z, rest = divmod(index, dims[1] * dims[2])
+            y, x = divmod(rest, dims[2])
+            coords.append((z, y, x))
+        return coords
     
     def get_random_chunks(self, num_chunks=4):
         """Generate random chunk coordinates."""
@@ -54,31 +105,57 @@ class OpenOrganelleDownloader:
         nuclei_count = max(1, num_chunks - raw_count)
         
         # Random raw_em chunks
-        for _ in range(raw_count):
-            z = random.randint(0, self.raw_em_dims[0] - 1)
-            y = random.randint(0, self.raw_em_dims[1] - 1)
-            x = random.randint(0, self.raw_em_dims[2] - 1)
+        for z, y, x in self._sample_coords(self.raw_em_dims, raw_count):
             chunks.append(("raw_em", z, y, x))
         
         # Random nuclei chunks
-        for _ in range(nuclei_count):
-            z = random.randint(0, self.nuclei_dims[0] - 1)
-            y = random.randint(0, self.nuclei_dims[1] - 1)
-            x = random.randint(0, self.nuclei_dims[2] - 1)
+        for z, y, x in self._sample_coords(self.nuclei_dims, nuclei_count):
             chunks.append(("nuclei", z, y, x))
         
         return chunks
     
-    def download(self, num_chunks=4):
-        """Download random zarr chunks."""
-        chunks_to_download = self.get_random_chunks(num_chunks)
+    def download_items(self, chunks_to_download, concurrency=64) -> dict:
+        """Download (chunk_type, z, y, x) chunks concurrently and return their metadata without writing it."""
+        sources = [self.chunk_source(*chunk) for chunk in chunks_to_download]
+        
+        # Cached chunks are revalidated with a conditional request and only transferred if changed
+        cache = get_cache()
+        # Under the shared scheduler the host's connection cap applies
+        fetcher = AsyncChunkFetcher(concurrency=host_limit(self.host, concurrency))
+        # Chunks are small, so the batch is timed as a whole; latencies are per request
+        with METRICS.track_file('openorganelle', f'{len(sources)} chunks') as track:
+            results = fetcher.run([(url, self.output_dir / filename) for url, filename in sources],
+                                  return_exceptions=True, cache=cache)
+            track['bytes'] = sum(r['size_bytes'] for r in results if not isinstance(r, BaseException)
+                                 and not r['cached'])
+        # Chunks that still fail after retries are recorded; the rest are kept
+        self.failures = []
+        fetched = [None] * len(sources)
+        for i, result in enumerate(results):
+            if isinstance(result, BaseException):
+                self.failures.append({'filename': sources[i][1], 'error': f'{type(result).__name__}: {result}'})
+                continue
+            fetched[i] = result
         
         file_results = []
         total_size = 0
         
-        for chunk_type, z, y, x in chunks_to_download:
-            result = self.download_chunk(chunk_type, z, y, x)
-            file_results.append(result)
+        for (chunk_type, z, y, x), (_, filename), result in zip(chunks_to_download, sources, fetched):
+            if result is None:
+                continue
+            file_result = {
+                'filename': filename,
+                'chunk_type': chunk_type,
+                'coordinates': [z, y, x],
+                'cached': result['cached'],
+                'size_bytes': result['size_bytes'],
+                'size_kb': result['size_bytes'] / 1024,
+                **digest_fields(result)
+            }
+            if result['missing']:
+                # Zarr stores omit chunks that only contain the fill value
+                file_result['missing'] = True
+            file_results.append(file_result)
             total_size += result['size_bytes']
         
         # Create metadata
@@ -87,27 +164,125 @@ class OpenOrganelleDownloader:
             'source': self.base_url,
             'technique': 'Enhanced Focused Ion Beam Scanning Electron Microscopy (FIB-SEM)',
             'sample': 'Mouse liver (C57BL/6J)',
-            'resolution_nm': [4, 4, 4],
+            # (x, y, z) like the other datasets; multiscale metadata is in array order
+            'resolution_nm': self.scales['raw_em']['resolution_nm'][::-1] if self.scales else [4, 4, 4],
             'format': 'Zarr chunks (random sampling)',
+            'scales': dict(self.sample_scales),
+            'status': 'partial' if self.failures else 'complete',
             'files_downloaded': len(file_results),
             'total_size_mb': total_size / (1024 * 1024),
             'files': file_results,
+            'files_failed': self.failures,
+            'arrays': self.array_metadata(sorted({chunk[0] for chunk in chunks_to_download})),
+            'instrumentation': METRICS.summary('openorganelle'),
+            'created': datetime.now().isoformat()
+        }
+        if cache is not None:
+            metadata['cache'] = cache.stats()
+        return metadata
+    
+    def download(self, num_chunks=4, concurrency=64):
+        """Download random zarr chunks concurrently."""
+        metadata = self.download_items(self.get_random_chunks(num_chunks), concurrency)
+        
+        with open(self.output_dir / "metadata.json", 'w') as f:
+            json.dump(metadata, f, indent=2)
+        
+        return metadata['files_downloaded']
+    
+    def download_region(self, start, stop, chunk_type="raw_em", scale="s0", concurrency=64, target_resolution_nm=None):
+        """Download a voxel bounding box [start, stop) (z, y, x) as one contiguous array.
+        
+        With target_resolution_nm the box (given in scale's voxels) is read
+        from the coarsest scale at least that fine, covering the same extent.
+        """
+        requested = {'scale': scale, 'start': list(start), 'stop': list(stop)}
+        scales = read_multiscales(self.group_url(chunk_type))
+        chosen = next((s for s in scales if s['path'] == scale), None)
+        if chosen is None:
+            raise ValueError(f"Unknown scale {scale!r} for {chunk_type}; available: "
+                             f"{', '.join(s['path'] for s in scales)}")
+        if target_resolution_nm is not None:
+            source = chosen
+            chosen = scales[coarsest_scale([s['resolution_nm'] for s in scales], target_resolution_nm)]
+            start, stop = rescale_box(start, stop, source, chosen)
+            scale = chosen['path']
+        array_url = self.array_url(chunk_type, scale)
+        meta = read_zarray(array_url)
+        stop = [min(hi, size) for hi, size in zip(stop, meta['shape'])]
+        
+        box = "_".join(f"{axis}{lo}-{hi}" for axis, lo, hi in zip("zyx", start, stop))
+        filename = f"{chunk_type}_{scale}_{box}.npy"
+        with METRICS.track_file('openorganelle', filename) as track:
+            region = download_region(array_url, start, stop, self.output_dir / filename,
+                                     concurrency=host_limit(self.host, concurrency), meta=meta)
+            track['bytes'] = (self.output_dir / filename).stat().st_size
+        
+        cache = get_cache()
+        metadata = {
+            'dataset': 'OpenOrganelle JRC Mouse Liver',
+            'source': array_url,
+            'technique': 'Enhanced Focused Ion Beam Scanning Electron Microscopy (FIB-SEM)',
+            'sample': 'Mouse liver (C57BL/6J)',
+            # (x, y, z) like the other datasets; multiscale metadata is in array order
+            'resolution_nm': chosen['resolution_nm'][::-1],
+            'format': 'Contiguous subvolume (memory-mappable .npy)',
+            'scale': scale,
+            'array_shape': meta['shape'],
+            'array_chunks': meta['chunks'],
+            'bbox': {'start': list(start), 'stop': list(stop)},
+            'bbox_requested': requested,
+            'files_downloaded': 1,
+            'total_size_mb': (self.output_dir / filename).stat().st_size / (1024 * 1024),
+            'files': [dict(filename=filename, chunk_type=chunk_type, **region)],
+            'instrumentation': METRICS.summary('openorganelle'),
             'created': datetime.now().isoformat()
         }
+        if cache is not None:
+            metadata['cache'] = cache.stats()
         
         with open(self.output_dir / "metadata.json", 'w') as f:
             json.dump(metadata, f, indent=2)
         
-        return len(chunks_to_download)
+        return str(self.output_dir / filename)
 
 def main():
-    parser = argparse.ArgumentParser(description="Download random OpenOrganelle JRC chunks")
+    parser = argparse.ArgumentParser(description="Download random OpenOrganelle JRC chunks or a bounding box")
     parser.add_argument('--chunks', '-c', type=int, default=4, help='Number of chunks to download')
+    parser.add_argument('--concurrency', type=int, default=64, help='Concurrent chunk requests')
+    parser.add_argument('--bbox', type=int, nargs=6, metavar=('Z0', 'Y0', 'X0', 'Z1', 'Y1', 'X1'),
+                        help='Download this voxel box as one contiguous array instead of random chunks')
+    parser.add_argument('--scale', default='s0', help='Scale level for --bbox (s0, s1, s2, ...)')
+    parser.add_argument('--layer', choices=['raw_em', 'nuclei'], default='raw_em', help='Layer for --bbox')
+    parser.add_argument('--target-resolution-nm', type=float, nargs='+', metavar='NM',
+                        help='Use the coarsest scale at least this fine (one value, or z y x); '
+                             '--bbox stays in --scale voxels')
+    parser.add_argument('--no-cache', action='store_true', help='Bypass the local download cache')
+    parser.add_argument('--verify', action='store_true', help='Re-check downloaded files against metadata.json')
+    instrument.add_arguments(parser)
+    retry.add_arguments(parser)
     
     args = parser.parse_args()
+    instrument.configure(args)
+    retry.configure(args)
+    if args.no_cache:
+        disable_cache()
     
     downloader = OpenOrganelleDownloader()
-    downloader.download(args.chunks)
+    if args.verify:
+        summary = verify_files(downloader.output_dir)
+        print(json.dumps(summary, indent=2))
+        sys.exit(1 if summary['failed'] else 0)
+    if args.bbox:
+        downloader.download_region(args.bbox[:3], args.bbox[3:], args.layer, args.scale, args.concurrency,
+                                   args.target_resolution_nm)
+    else:
+        if args.target_resolution_nm:
+            downloader.select_scales(args.target_resolution_nm)
+        downloader.download(args.chunks, args.concurrency)
+        if downloader.failures:
+            print(f"{len(downloader.failures)} chunks failed; see metadata.json")
+            sys.exit(1)
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
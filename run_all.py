@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+Download all datasets concurrently under shared connection and bandwidth limits
+"""
+
+import sys
+import json
+import time
+import argparse
+import threading
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent
+sys.path.insert(0, str(ROOT))
+for dataset_dir in ['epfl_hippocampus', 'flyem_hemibrain', 'empiar_11759', 'idr_0086', 'openorganelle_jrc']:
+    sys.path.insert(0, str(ROOT / dataset_dir))
+
+from em_utils.ftp_pool import get_pool, close_all
+from em_utils.segmented import PLANNER
+from em_utils.cache import disable_cache
+from em_utils.scheduler import ConnectionLimits, BandwidthLimiter, Scheduler, install
+from em_utils import instrument
+from em_utils.instrument import METRICS
+from em_utils import retry
+
+FTP_HOST = "ftp.ebi.ac.uk"
+
+# Per-host connection caps; other hosts get --default-per-host
+DEFAULT_PER_HOST = {
+    FTP_HOST: 4,
+    "documents.epfl.ch": 4,
+    "neuroglancer-janelia-flyem-hemibrain.storage.googleapis.com": 8,
+    "openorganelle.janelia.org": 8,
+}
+
+DATASETS = ['epfl', 'hemibrain', 'empiar', 'idr', 'openorganelle']
+
+
+# Each job returns (files downloaded, files that failed after retries)
+
+def run_epfl(args):
+    from epfl_downloader import EPFLDownloader
+    downloader = EPFLDownloader()
+    return downloader.download(args.epfl_files), downloader.failures
+
+
+def run_hemibrain(args):
+    from hemibrain_downloader import HemibrainDownloader
+    HemibrainDownloader().download(args.hemibrain_size)
+    return 1, []
+
+
+def run_empiar(args):
+    from empiar_downloader import EMPIARDownloader
+    downloader = EMPIARDownloader()
+    return downloader.download(args.empiar_files), downloader.failures
+
+
+def run_idr(args):
+    import idr_downloader
+    failures = []
+    return idr_downloader.download(max_files=args.idr_files, failures=failures), failures
+
+
+def run_openorganelle(args):
+    from openorganelle_downloader import OpenOrganelleDownloader
+    downloader = OpenOrganelleDownloader()
+    return downloader.download(args.openorganelle_chunks), downloader.failures
+
+
+JOBS = {
+    'epfl': run_epfl,
+    'hemibrain': run_hemibrain,
+    'empiar': run_empiar,
+    'idr': run_idr,
+    'openorganelle': run_openorganelle,
+}
+
+
+def parse_host_limits(values) -> dict:
+    """Parse repeated HOST=N options."""
+    limits = dict(DEFAULT_PER_HOST)
+    for value in values or []:
+        host, _, count = value.partition('=')
+        limits[host] = int(count)
+    return limits
+
+
+def main():
+    """Run the selected downloaders against one shared scheduler."""
+    parser = argparse.ArgumentParser(description="Download all EM datasets in parallel")
+    parser.add_argument('--datasets', nargs='+', choices=DATASETS, default=DATASETS, help='Datasets to download')
+    parser.add_argument('--max-connections', type=int, default=16, help='Total open connections across all hosts')
+    parser.add_argument('--per-host', action='append', metavar='HOST=N', help='Connection cap for one host')
+    parser.add_argument('--default-per-host', type=int, default=4, help='Connection cap for unlisted hosts')
+    parser.add_argument('--bandwidth-mbps', type=float, help='Aggregate bandwidth cap in MB/s')
+    parser.add_argument('--max-segments', type=int, default=PLANNER.max_segments, help='Parallel ranges per large file')
+    parser.add_argument('--no-cache', action='store_true', help='Bypass the local download cache')
+    parser.add_argument('--epfl-files', type=int, default=4)
+    parser.add_argument('--hemibrain-size', type=int, default=100)
+    parser.add_argument('--empiar-files', type=int, default=3)
+    parser.add_argument('--idr-files', type=int, default=2)
+    parser.add_argument('--openorganelle-chunks', type=int, default=5)
+    instrument.add_arguments(parser)
+    retry.add_arguments(parser)
+    
+    args = parser.parse_args()
+    instrument.configure(args)
+    retry.configure(args)
+    PLANNER.max_segments = args.max_segments
+    if args.no_cache:
+        disable_cache()
+    
+    limits = ConnectionLimits(args.max_connections, parse_host_limits(args.per_host), args.default_per_host)
+    bandwidth = BandwidthLimiter(args.bandwidth_mbps * 1024 * 1024) if args.bandwidth_mbps else None
+    scheduler = Scheduler(limits, bandwidth)
+    install(scheduler)
+    # EMPIAR and IDR share one FTP host and therefore one session pool
+    get_pool(FTP_HOST, max_sessions=limits.host_limit(FTP_HOST))
+    
+    summary = {}
+    
+    def run(name):
+        start = time.time()
+        try:
+            count, failures = JOBS[name](args)
+            # Completed files are kept and recorded even when some others failed
+            summary[name] = {'status': 'partial' if failures else 'ok', 'files': count, 'failed': len(failures)}
+        except Exception as exc:
+            summary[name] = {'status': 'failed', 'error': f'{type(exc).__name__}: {exc}'}
+        summary[name]['elapsed_s'] = round(time.time() - start, 2)
+        print(f"{name}: {summary[name]['status']} in {summary[name]['elapsed_s']}s", flush=True)
+    
+    # Each dataset runs in its own thread; their transfers share the scheduler's workers
+    threads = [threading.Thread(target=run, args=(name,)) for name in args.datasets]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    scheduler.shutdown()
+    close_all()
+    summary['instrumentation'] = METRICS.summary()
+    print(json.dumps(summary, indent=2))
+    sys.exit(1 if any(s['status'] != 'ok' for name, s in summary.items() if name in JOBS) else 0)
+
+if __name__ == "__main__":
+    main()
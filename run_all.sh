@@ -8,11 +8,7 @@ pip3 install -r requirements.txt
 
 echo "Downloading datasets..."
 
-# Download commands
-python3 epfl_hippocampus/epfl_downloader.py --files 4 --threads 2
-python3 flyem_hemibrain/hemibrain_downloader.py --size 100
-python3 empiar_11759/empiar_downloader.py --files 3 --threads 2
-python3 idr_0086/idr_downloader.py --files 2 --threads 2
-python3 openorganelle_jrc/openorganelle_downloader.py --chunks 5
+# All datasets run concurrently under shared connection/bandwidth limits
+python3 run_all.py --epfl-files 4 --hemibrain-size 100 --empiar-files 3 --idr-files 2 --openorganelle-chunks 5 "$@"
 
 echo "Download complete. Check dataset directories for data and metadata files." 
\ No newline at end of file
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+"""
+Spread one dataset download over many processes and nodes through a shared work manifest
+`create` lists the work items into shards on a shared filesystem, `work` claims and downloads
+shards (run it on as many nodes as you like) and `merge` writes the combined metadata.json
+"""
+
+import sys
+import json
+import random
+import argparse
+import subprocess
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent
+sys.path.insert(0, str(ROOT))
+for dataset_dir in ['flyem_hemibrain', 'empiar_11759', 'idr_0086', 'openorganelle_jrc']:
+    sys.path.insert(0, str(ROOT / dataset_dir))
+
+from em_utils.manifest import Manifest, work, worker_id
+from em_utils.ftp_pool import close_all
+from em_utils.precomputed import close_decoders
+from em_utils.segmented import PLANNER
+from em_utils.cache import disable_cache
+from em_utils.adaptive import threads_arg
+from em_utils import instrument
+from em_utils import retry
+
+DATASETS = ['empiar', 'idr', 'openorganelle', 'hemibrain']
+
+# Where each downloader writes when the manifest has no --output-dir
+DEFAULT_DIRS = {
+    'empiar': ROOT / 'empiar_11759' / 'empiar_data',
+    'idr': ROOT / 'idr_0086' / 'idr_data',
+    'openorganelle': ROOT / 'openorganelle_jrc' / 'openorganelle_data',
+    'hemibrain': ROOT / 'flyem_hemibrain' / 'hemibrain_data',
+}
+
+
+# Listing: each returns (items, params for the workers, extra fields for the merged metadata)
+
+def list_empiar(args):
+    from empiar_downloader import EMPIARDownloader
+    downloader = EMPIARDownloader()
+    max_size = int(args.max_size_gb * 1024 ** 3) if args.max_size_gb else None
+    dm3_files = downloader.get_dm3_files(args.refresh_listing, max_size=max_size)
+    downloader.pool.close()
+    items = [[f['name'], f['size']] for f in dm3_files[:args.files]]
+    return items, {}, EMPIARDownloader.listing_fields(dm3_files)
+
+
+def list_idr(args):
+    import idr_downloader
+    study = args.study or idr_downloader.DEFAULT_STUDY
+    include = args.include if args.include or args.regex else idr_downloader.DEFAULT_INCLUDE
+    crawler = idr_downloader.make_crawler(study, args.root or idr_downloader.DEFAULT_ROOT, include, args.regex,
+                                          max_files=args.files)
+    items = [list(item) for item in crawler]
+    return items, {'study': study}, {'crawl': crawler.summary()}
+
+
+def list_openorganelle(args):
+    from openorganelle_downloader import OpenOrganelleDownloader
+    downloader = OpenOrganelleDownloader()
+    if args.target_resolution_nm:
+        downloader.select_scales(args.target_resolution_nm)
+    random.seed(args.seed)
+    chunks = downloader.get_random_chunks(args.chunks)
+    return [list(chunk) for chunk in chunks], {'scales': downloader.scales}, {'seed': args.seed}
+
+
+def list_hemibrain(args):
+    from hemibrain_downloader import HemibrainDownloader
+    downloader = HemibrainDownloader()
+    em_vol = downloader.open_volume(downloader.select_mip(args.target_resolution_nm))
+    crop_size = downloader.scaled_crop_size(em_vol, args.size)
+    starts = downloader.place_crops(em_vol, args.num_crops, crop_size, random.Random(args.seed), args.placement)
+    params = {'mip': em_vol.mip, 'crop_size': crop_size, 'seed': args.seed, 'placement': args.placement}
+    return [[n, start] for n, start in enumerate(starts)], params, {}
+
+
+# Workers: each returns a function downloading one shard's items and returning its metadata
+
+def empiar_worker(params, args, output_dir):
+    from empiar_downloader import EMPIARDownloader
+    downloader = EMPIARDownloader(args.max_sessions)
+    downloader.download_dir = output_dir
+    return lambda items: downloader.download_items(items, args.threads)
+
+
+def idr_worker(params, args, output_dir):
+    import idr_downloader
+    from em_utils.ftp_pool import get_pool
+    idr_downloader.DOWNLOAD_DIR = output_dir
+    get_pool(idr_downloader.FTP_HOST, idr_downloader.FTP_PORT, max_sessions=args.max_sessions)
+    return lambda items: idr_downloader.download_items(items, params['study'], args.threads)
+
+
+def openorganelle_worker(params, args, output_dir):
+    from openorganelle_downloader import OpenOrganelleDownloader
+    downloader = OpenOrganelleDownloader()
+    downloader.output_dir = output_dir
+    # Chunk coordinates in the manifest refer to the scales chosen at create time
+    downloader.scales = params.get('scales', {})
+    downloader.sample_scales.update({chunk_type: scale['path'] for chunk_type, scale in downloader.scales.items()})
+    return lambda items: downloader.download_items(items, args.concurrency)
+
+
+def hemibrain_worker(params, args, output_dir):
+    from hemibrain_downloader import HemibrainDownloader
+    downloader = HemibrainDownloader(str(output_dir))
+    downloader.decode_workers = args.decode_workers
+    downloader.concurrency = args.concurrency
+    em_vol = downloader.open_volume(params.get('mip', 0))
+    return lambda items: downloader.download_crops(em_vol, items, params['crop_size'], params['seed'],
+                                                   params['placement'], args.memory_budget_mb, args.workers)
+
+
+LISTERS = {
+    'empiar': list_empiar,
+    'idr': list_idr,
+    'openorganelle': list_openorganelle,
+    'hemibrain': list_hemibrain,
+}
+
+WORKERS = {
+    'empiar': empiar_worker,
+    'idr': idr_worker,
+    'openorganelle': openorganelle_worker,
+    'hemibrain': hemibrain_worker,
+}
+
+
+def output_dir(manifest: Manifest) -> Path:
+    path = Path(manifest.info['output_dir'] or DEFAULT_DIRS[manifest.info['dataset']])
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def create(args):
+    items, params, metadata = LISTERS[args.dataset](args)
+    output = str(Path(args.output_dir).resolve()) if args.output_dir else None
+    manifest = Manifest.create(args.manifest, args.dataset, items, args.shard_size, params, metadata, output)
+    print(f"{manifest.info['items']} items in {manifest.info['shards']} shards under {args.manifest}")
+
+
+def run_workers(args):
+    if args.processes > 1:
+        # Local worker processes, each claiming shards like a separate node would
+        procs = [subprocess.Popen([sys.executable, __file__, *sys.argv[1:], '--processes', '1'])
+                 for _ in range(args.processes)]
+        sys.exit(max(proc.wait() for proc in procs))
+    
+    manifest = Manifest(args.manifest)
+    worker = worker_id()
+    process = WORKERS[manifest.info['dataset']](manifest.info['params'], args, output_dir(manifest))
+    try:
+        finished = work(manifest, process, worker, args.stale_seconds, args.heartbeat_seconds)
+    finally:
+        close_all()
+        close_decoders()
+    print(f"{worker}: {finished} shards", flush=True)
+
+
+def merge(args):
+    manifest = Manifest(args.manifest)
+    metadata = manifest.merge()
+    path = output_dir(manifest) / "metadata.json"
+    with open(path, 'w') as f:
+        json.dump(metadata, f, indent=2)
+    print(json.dumps(dict(metadata['manifest'], status=metadata['status'], files=len(metadata['files']),
+                          files_failed=len(metadata['files_failed']), metadata=str(path)), indent=2))
+    sys.exit(0 if metadata['status'] == 'complete' else 1)
+
+
+def main():
+    """Create, work on, inspect or merge a shared work manifest."""
+    parser = argparse.ArgumentParser(description="Distributed downloads through a shared work manifest")
+    commands = parser.add_subparsers(dest='command', required=True)
+    
+    create_parser = commands.add_parser('create', help='List work items into a new manifest')
+    create_parser.add_argument('dataset', choices=DATASETS)
+    create_parser.add_argument('--manifest', '-m', required=True, help='Manifest directory on the shared filesystem')
+    create_parser.add_argument('--shard-size', type=int, default=8, help='Work items per shard')
+    create_parser.add_argument('--output-dir', help="Shared download directory (default: the downloader's own)")
+    create_parser.add_argument('--files', '-f', type=int, help='EMPIAR/IDR: at most this many files (default: all)')
+    create_parser.add_argument('--max-size-gb', type=float, help='EMPIAR: skip files larger than this')
+    create_parser.add_argument('--refresh-listing', action='store_true', help='EMPIAR: re-list the FTP directory')
+    create_parser.add_argument('--study', help='IDR: study directory (default: IDR-0086)')
+    create_parser.add_argument('--root', help='IDR: directory within the study to crawl (default: Figure S3B)')
+    create_parser.add_argument('--include', nargs='+', help='IDR: glob(s) on paths relative to --root')
+    create_parser.add_argument('--regex', help='IDR: regular expression that relative paths must match')
+    create_parser.add_argument('--chunks', '-c', type=int, default=4, help='OpenOrganelle: number of random chunks')
+    create_parser.add_argument('--num-crops', '-n', type=int, default=8, help='Hemibrain: number of crops')
+    create_parser.add_argument('--size', '-s', type=int, default=1000,
+                               help='Hemibrain: crop size in full-resolution voxels')
+    create_parser.add_argument('--target-resolution-nm', type=float, nargs='+', metavar='NM',
+                               help='Hemibrain/OpenOrganelle: coarsest scale at least this fine (one value, or z y x)')
+    create_parser.add_argument('--placement', choices=['random', 'non-overlap', 'stratified'], default='random',
+                               help='Hemibrain: how to place crops')
+    create_parser.add_argument('--seed', type=int, help='Random seed for chunk or crop placement')
+    
+    work_parser = commands.add_parser('work', help='Claim and download shards until none are left')
+    work_parser.add_argument('--manifest', '-m', required=True)
+    work_parser.add_argument('--processes', '-p', type=int, default=1, help='Worker processes to start on this node')
+    work_parser.add_argument('--threads', '-t', type=threads_arg, default=4,
+                             help="EMPIAR/IDR: parallel downloads per process, or 'auto'")
+    work_parser.add_argument('--max-sessions', type=int, default=4, help='EMPIAR/IDR: FTP sessions per process')
+    work_parser.add_argument('--max-segments', type=int, default=PLANNER.max_segments,
+                             help='Parallel ranges per large file')
+    work_parser.add_argument('--concurrency', type=int, default=64,
+                             help='OpenOrganelle/Hemibrain: concurrent chunk requests')
+    work_parser.add_argument('--workers', '-w', type=int, default=8,
+                             help='Hemibrain: parallel block fetches through CloudVolume')
+    work_parser.add_argument('--decode-workers', type=int,
+                             help='Hemibrain: JPEG decoder processes (default: all cores; 0: CloudVolume decodes)')
+    work_parser.add_argument('--memory-budget-mb', type=int, default=1024, help='Hemibrain: peak memory for blocks')
+    work_parser.add_argument('--stale-seconds', type=float, default=600,
+                             help='Reclaim shards whose worker has not heartbeated for this long')
+    work_parser.add_argument('--heartbeat-seconds', type=float, default=30)
+    work_parser.add_argument('--no-cache', action='store_true', help='Bypass the local download cache')
+    instrument.add_arguments(work_parser)
+    retry.add_arguments(work_parser)
+    
+    status_parser = commands.add_parser('status', help='Show shard progress')
+    status_parser.add_argument('--manifest', '-m', required=True)
+    
+    merge_parser = commands.add_parser('merge', help="Write metadata.json from the finished shards")
+    merge_parser.add_argument('--manifest', '-m', required=True)
+    
+    args = parser.parse_args()
+    if args.command == 'create':
+        create(args)
+    elif args.command == 'work':
+        instrument.configure(args)
+        retry.configure(args)
+        PLANNER.max_segments = args.max_segments
+        if args.no_cache:
+            disable_cache()
+        run_workers(args)
+    elif args.command == 'status':
+        print(json.dumps(Manifest(args.manifest).status(), indent=2))
+    else:
+        merge(args)
+
+if __name__ == "__main__":
+    main()
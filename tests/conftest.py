@@ -0,0 +1,53 @@
+"""
+Shared fixtures: the local HTTP/FTP servers from benchmarks/servers.py
+"""
+
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "benchmarks"))
+from servers import start_http_server, start_ftp_server
+from em_utils import cache, retry
+from em_utils.retry import CircuitBreaker
+
+
+@pytest.fixture(autouse=True)
+def policy(monkeypatch):
+    """The shared retry policy with short backoff and a fresh circuit breaker, restored after each test."""
+    monkeypatch.setattr(retry.POLICY, 'base', 0.01)
+    monkeypatch.setattr(retry.POLICY, 'cap', 0.1)
+    monkeypatch.setattr(retry.POLICY, 'breaker', CircuitBreaker())
+    return retry.POLICY
+
+
+@pytest.fixture(autouse=True)
+def no_cache(monkeypatch):
+    """Keep tests out of the user's download cache."""
+    monkeypatch.setattr(cache, '_cache', None)
+    monkeypatch.setattr(cache, '_disabled', True)
+
+
+@pytest.fixture
+def www(tmp_path):
+    """Directory served by the http_server fixture."""
+    root = tmp_path / "www"
+    root.mkdir()
+    return root
+
+
+@pytest.fixture
+def http_server(www):
+    server = start_http_server(www)
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture
+def ftp_server(www):
+    pytest.importorskip('pyftpdlib')
+    server = start_ftp_server(www)
+    yield server
+    server.close_all()
@@ -0,0 +1,61 @@
+"""
+AIMD concurrency control against a server that refuses connections beyond a cap
+"""
+
+import pytest
+
+from servers import write_blob, start_http_server
+from em_utils.adaptive import AIMDController, threads_arg
+from em_utils.resume import http_download
+from em_utils.retry import retry_call
+
+
+def test_threads_arg():
+    assert threads_arg('4') == 4
+    assert threads_arg('auto') == 'auto'
+    with pytest.raises(ValueError):
+        threads_arg('many')
+
+
+def test_limit_backs_off_and_recovers(www, tmp_path, policy, monkeypatch):
+    files = [f"f{i:02d}.bin" for i in range(32)]
+    for i, name in enumerate(files):
+        write_blob(www / name, 256 * 1024, seed=i)
+    # Each stream takes about 0.25 s; a third concurrent request is answered with 503
+    server = start_http_server(www, stream_mbps=1, max_connections=2)
+    monkeypatch.setattr(policy, 'attempts', 50)
+    monkeypatch.setattr(policy.breaker, 'threshold', 1000)
+    
+    def fetch(name):
+        return retry_call(lambda: http_download(f"{server.url}/{name}", tmp_path / name), '127.0.0.1')
+    
+    controller = AIMDController(initial=8, maximum=8, interval=0.25)
+    try:
+        results = controller.map(fetch, files)
+    finally:
+        server.shutdown()
+    
+    assert [r['size_bytes'] for r in results] == [256 * 1024] * len(files)
+    actions = [h['action'] for h in controller.history]
+    first_cut = actions.index('decrease')
+    # 503s (retried by retry_call) cut the limit below the initial 8 ...
+    assert controller.history[first_cut]['errors'] > 0
+    assert min(h['workers'] for h in controller.history) < 8
+    # ... and it probes upwards again once the errors stop
+    assert 'increase' in actions[first_cut:]
+
+
+def test_failed_items_are_not_resubmitted():
+    calls = []
+    
+    def fn(item):
+        calls.append(item)
+        if item % 2:
+            raise ValueError(item)
+        return item
+    
+    failures = []
+    results = AIMDController(interval=0.05).map(fn, range(6), failures)
+    assert results == [0, 2, 4]
+    assert sorted(calls) == list(range(6))
+    assert sorted(f['error'] for f in failures) == [f'ValueError: {i}' for i in (1, 3, 5)]
@@ -0,0 +1,94 @@
+"""
+Shard claiming and stale-claim recovery of the shared work manifest, across processes
+"""
+
+import os
+import time
+import multiprocessing
+from collections import Counter
+
+from em_utils.manifest import Manifest, work
+
+ITEMS = 120
+
+
+def process_shard(log, items) -> dict:
+    """Record each item as processed and return partial metadata like a downloader would."""
+    with open(log, 'a') as f:
+        for item in items:
+            f.write(f"{item}\n")
+    time.sleep(0.01)
+    return {'dataset': 'test', 'files_downloaded': len(items), 'files': [{'filename': str(i)} for i in items],
+            'files_failed': []}
+
+
+def run_worker(root, worker):
+    manifest = Manifest(root)
+    return work(manifest, lambda items: process_shard(manifest.root / 'log' / f'{worker}.txt', items),
+                worker=worker, stale_seconds=60, heartbeat_seconds=1)
+
+
+def age(manifest, shard, worker, seconds):
+    """Make a claim look as if its worker stopped heartbeating seconds ago."""
+    path = manifest._claim_path(shard, worker)
+    then = path.stat().st_mtime - seconds
+    os.utime(path, (then, then))
+
+
+def test_each_item_processed_once_across_workers(tmp_path):
+    manifest = Manifest.create(tmp_path / "manifest", 'test', list(range(ITEMS)), shard_size=3)
+    (manifest.root / 'log').mkdir()
+    # A worker that died holding two shards
+    dead = [manifest.claim('dead') for _ in range(2)]
+    for shard, _ in dead:
+        age(manifest, shard, 'dead', 300)
+    
+    ctx = multiprocessing.get_context('spawn')
+    workers = [ctx.Process(target=run_worker, args=(manifest.root, f'w{n}')) for n in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(60)
+        assert worker.exitcode == 0
+    
+    processed = Counter(int(line) for log in (manifest.root / 'log').glob('*.txt')
+                        for line in log.read_text().split())
+    assert processed == Counter(range(ITEMS))
+    assert not list((manifest.root / 'claimed').glob('*.json'))
+    assert not list((manifest.root / 'todo').glob('*.json'))
+    # The dead worker's shards were finished by live ones
+    done = {path.name.split('.')[0]: path.name.split('.')[1] for path in (manifest.root / 'done').glob('*.json')}
+    assert len(done) == manifest.info['shards']
+    assert all(done[shard] != 'dead' for shard, _ in dead)
+    
+    metadata = manifest.merge()
+    assert metadata['status'] == 'complete'
+    assert metadata['files_downloaded'] == ITEMS
+    assert sorted(int(f['filename']) for f in metadata['files']) == list(range(ITEMS))
+
+
+def test_reclaim_only_takes_stale_claims(tmp_path):
+    manifest = Manifest.create(tmp_path / "manifest", 'test', list(range(6)), shard_size=2)
+    stale, _ = manifest.claim('dead')
+    live, _ = manifest.claim('slow')
+    age(manifest, stale, 'dead', 120)
+    
+    assert manifest.reclaim(60) == 1
+    assert (manifest.root / 'todo' / f'{stale}.json').exists()
+    assert manifest._claim_path(live, 'slow').exists()
+    # A heartbeat keeps a claim from being taken back
+    age(manifest, live, 'slow', 120)
+    manifest.heartbeat(live, 'slow')
+    assert manifest.reclaim(60) == 0
+    
+    # The dead worker's claim is gone, so its late completion still lands in results
+    manifest.complete(stale, 'dead', {'files': [], 'files_failed': []}, time.time())
+    assert (manifest.root / 'results' / f'{stale}.json').exists()
+
+
+def test_claim_is_exclusive(tmp_path):
+    manifest = Manifest.create(tmp_path / "manifest", 'test', list(range(10)), shard_size=1)
+    claims = [manifest.claim(f'w{n % 3}') for n in range(12)]
+    shards = [claim[0] for claim in claims if claim is not None]
+    assert sorted(shards) == [f"{n:05d}" for n in range(10)]
+    assert claims[-2:] == [None, None]
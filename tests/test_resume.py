@@ -0,0 +1,112 @@
+"""
+Resuming interrupted transfers through .part/.part.json files
+"""
+
+import os
+import json
+import ftplib
+
+import pytest
+import requests
+
+from servers import write_blob
+from em_utils.resume import http_download, ftp_download
+
+SIZE = 2 * 1024 * 1024
+
+
+def statuses(session) -> list:
+    """Record the status code of every response the session receives."""
+    seen = []
+    session.hooks['response'].append(lambda response, *args, **kwargs: seen.append(response.status_code))
+    return seen
+
+
+def interrupt(server, url, path):
+    """Run one download that the server cuts off halfway, leaving a .part file and its journal."""
+    server.handler.drop_rate = 1.0
+    with pytest.raises(requests.RequestException):
+        http_download(url, path)
+    server.handler.drop_rate = 0.0
+    part = path.with_name(path.name + '.part')
+    journal = path.with_name(path.name + '.part.json')
+    assert part.exists() and journal.exists() and not path.exists()
+    return part, journal
+
+
+def test_http_resumes_truncated_part(http_server, www, tmp_path):
+    write_blob(www / "blob.bin", SIZE)
+    path = tmp_path / "blob.bin"
+    url = f"{http_server.url}/blob.bin"
+    part, journal = interrupt(http_server, url, path)
+    offset = json.loads(journal.read_text())['offset']
+    assert 0 < offset < SIZE
+    # Bytes past the journal's offset, or lost from the end of the .part, are fetched again
+    with open(part, 'r+b') as f:
+        f.truncate(offset // 2)
+    
+    session = requests.Session()
+    seen = statuses(session)
+    record = http_download(url, path, session=session)
+    assert seen == [206]
+    assert path.read_bytes() == (www / "blob.bin").read_bytes()
+    assert record['size_bytes'] == SIZE
+    assert not part.exists() and not journal.exists()
+
+
+def test_http_restarts_when_etag_changes(http_server, www, tmp_path):
+    write_blob(www / "blob.bin", SIZE)
+    path = tmp_path / "blob.bin"
+    url = f"{http_server.url}/blob.bin"
+    part, journal = interrupt(http_server, url, path)
+    
+    # Same size, new content and mtime: the server's ETag changes, so If-Range fails
+    write_blob(www / "blob.bin", SIZE, seed=1)
+    stat = os.stat(www / "blob.bin")
+    os.utime(www / "blob.bin", (stat.st_atime, stat.st_mtime + 10))
+    session = requests.Session()
+    seen = statuses(session)
+    http_download(url, path, session=session)
+    assert seen == [200]
+    assert path.read_bytes() == (www / "blob.bin").read_bytes()
+    assert not part.exists() and not journal.exists()
+
+
+def test_journal_from_other_source_is_ignored(http_server, www, tmp_path):
+    write_blob(www / "blob.bin", SIZE)
+    path = tmp_path / "blob.bin"
+    part, journal = interrupt(http_server, f"{http_server.url}/blob.bin", path)
+    journal.write_text(json.dumps({**json.loads(journal.read_text()), 'source': 'http://elsewhere/blob.bin'}))
+    
+    session = requests.Session()
+    seen = statuses(session)
+    http_download(f"{http_server.url}/blob.bin", path, session=session)
+    assert seen == [200]
+    assert path.read_bytes() == (www / "blob.bin").read_bytes()
+
+
+def test_ftp_resumes_truncated_part(ftp_server, www, tmp_path):
+    write_blob(www / "blob.bin", SIZE)
+    data = (www / "blob.bin").read_bytes()
+    path = tmp_path / "blob.bin"
+    part = path.with_name(path.name + '.part')
+    journal = path.with_name(path.name + '.part.json')
+    source = 'ftp://test/blob.bin'
+    # A previous attempt journaled 1 MB, but only part of it reached the disk
+    part.write_bytes(data[:SIZE // 4])
+    journal.write_text(json.dumps({'source': source, 'offset': SIZE // 2, 'size': SIZE, 'etag': None}))
+    
+    ftp = ftplib.FTP()
+    ftp.connect('127.0.0.1', ftp_server.address[1])
+    ftp.login()
+    commands = []
+    sendcmd = ftp.sendcmd
+    ftp.sendcmd = lambda cmd: commands.append(cmd) or sendcmd(cmd)
+    try:
+        record = ftp_download(ftp, '/blob.bin', path, source=source)
+    finally:
+        ftp.quit()
+    assert f'REST {SIZE // 4}' in commands
+    assert path.read_bytes() == data
+    assert record['size_bytes'] == SIZE
+    assert not part.exists() and not journal.exists()
@@ -0,0 +1,120 @@
+"""
+Retry policy, circuit breaker and partial-success downloads
+"""
+
+import sys
+import json
+import time
+from pathlib import Path
+
+import pytest
+import requests
+
+from servers import write_blob, start_http_server
+from em_utils.retry import RetryPolicy, CircuitBreaker, CircuitOpenError
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "epfl_hippocampus"))
+from epfl_downloader import EPFLDownloader
+
+
+def failing(exc):
+    """A callable that always raises exc and counts its calls."""
+    def fn():
+        fn.calls += 1
+        raise exc
+    fn.calls = 0
+    return fn
+
+
+def test_policy_gives_up_after_attempts():
+    fn = failing(requests.ConnectionError('reset'))
+    with pytest.raises(requests.ConnectionError):
+        RetryPolicy(attempts=3, base=0.001, breaker=CircuitBreaker()).call(fn, 'host')
+    assert fn.calls == 3
+
+
+def test_policy_does_not_retry_permanent_errors():
+    response = requests.Response()
+    response.status_code = 404
+    fn = failing(requests.HTTPError('not found', response=response))
+    with pytest.raises(requests.HTTPError):
+        RetryPolicy(attempts=3, base=0.001, breaker=CircuitBreaker()).call(fn, 'host')
+    assert fn.calls == 1
+
+
+def test_policy_retries_until_success():
+    outcomes = [requests.Timeout('slow'), requests.ConnectionError('reset'), 'ok']
+    
+    def fn():
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+    assert RetryPolicy(attempts=3, base=0.001, breaker=CircuitBreaker()).call(fn, 'host') == 'ok'
+
+
+def test_breaker_opens_then_half_opens():
+    breaker = CircuitBreaker(threshold=3, cooldown=0.2)
+    for _ in range(3):
+        breaker.check('host')
+        breaker.failure('host')
+    with pytest.raises(CircuitOpenError):
+        breaker.check('host')
+    assert breaker.state() == {'host': 'open'}
+    # Other hosts are unaffected
+    breaker.check('other')
+    
+    time.sleep(0.25)
+    # Half-open: one probe goes through, concurrent calls are still refused
+    breaker.check('host')
+    with pytest.raises(CircuitOpenError):
+        breaker.check('host')
+    # A failed probe reopens the circuit for another cooldown
+    breaker.failure('host')
+    with pytest.raises(CircuitOpenError):
+        breaker.check('host')
+    
+    time.sleep(0.25)
+    breaker.check('host')
+    breaker.success('host')
+    assert breaker.state() == {}
+    breaker.check('host')
+    breaker.check('host')
+
+
+def test_open_circuit_fails_fast():
+    policy = RetryPolicy(attempts=10, base=0.001, breaker=CircuitBreaker(threshold=2, cooldown=60))
+    fn = failing(requests.ConnectionError('reset'))
+    with pytest.raises(CircuitOpenError):
+        policy.call(fn, 'host')
+    assert fn.calls == 2
+
+
+def test_faulty_run_writes_partial_metadata(www, tmp_path, policy, monkeypatch):
+    files = [f"volume_{i}.tif" for i in range(4)]
+    for i, name in enumerate(files[:3]):
+        write_blob(www / name, 1024 * 1024, seed=i)
+    # volume_3.tif does not exist; the others see 503s and dropped bodies on half of all requests
+    server = start_http_server(www, error_rate=0.3, drop_rate=0.2, seed=3)
+    monkeypatch.setattr(policy, 'attempts', 20)
+    monkeypatch.setattr(policy.breaker, 'threshold', 1000)
+    
+    downloader = EPFLDownloader()
+    downloader.download_dir = tmp_path / "out"
+    downloader.download_dir.mkdir()
+    downloader.files = files
+    downloader.urls = [f"{server.url}/{name}" for name in files]
+    try:
+        assert downloader.download(len(files), 2) == 3
+    finally:
+        server.shutdown()
+    
+    assert sum(server.handler.faults.values()) > 0
+    metadata = json.loads((downloader.download_dir / "metadata.json").read_text())
+    assert metadata['status'] == 'partial'
+    assert [f['filename'] for f in metadata['files_failed']] == ['volume_3.tif']
+    assert metadata['files_failed'][0]['error'].startswith('HTTPError: 404')
+    assert sorted(f['filename'] for f in metadata['files']) == files[:3]
+    for name in files[:3]:
+        assert (downloader.download_dir / name).read_bytes() == (www / name).read_bytes()
+    assert metadata['instrumentation']['run']['retries'] > 0